@@ -2,22 +2,28 @@
 """
 #!/usr/bin/python3
 """
-from queue import Queue, Full, Empty
+import argparse
+from queue import Queue
 from threading import Thread, Lock
 import _thread
 import signal
-from time import sleep
 from kubernetes import client, watch, config as k8_config
 from k8_watchers.k8_watcher_deployments import DeploymentWatcher
 from k8_watchers.k8_watcher_services import ServiceWatcher
 from k8_watchers.k8_watcher_pods import PodWatcher
-from k8_events.k8_events import process_k8_event
-from k8_helpers.k8_sync import sync_deployments, sync_pods, sync_services
-from apic_events.apic_events import process_apic_event
+from k8_watchers.k8_watcher_owners import OwnerIndexWatcher
+from event_dispatch.event_dispatcher import EventDispatcher
+from k8_helpers.k8_sync import sync_all
+from k8_helpers.k8_owners import sync_owner_index
+from k8_helpers.k8_pod_filter import get_pod_filters
 from aci_apic.aci_apic import login as apic_login  # auto calls APIC login/fresh code
 from aci_apic.aci_apic import logout as apic_logout
 from aci_apic.aci_subscription import APICWatcher
+from aci_apic import aci_plan
 from aci_helpers.aci_object import refresh_subscriptions, print_subscriptions
+from aci_helpers.aci_object import renew_subscriptions
+from reconcile.aci_reconciler import run_reconciler, request_reconcile, reconcile
+from metrics.prometheus import Gauge, start_metrics_server
 
 # TODO - Verbose logging from threads for expections, wrapper etc as sometimes
 # caught or hidden if not caught
@@ -29,78 +35,139 @@ def main():
     """
     .
     """
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--plan",
+        action="store_true",
+        help="print the APIC changes the sync and reconciliation would make, without writing",
+    )
+    args = parser.parse_args()
+    if args.plan and not aci_plan.enabled:
+        aci_plan.enable_plan_mode()
+
     k8_config.load_kube_config()
     apic_login()
+    if aci_plan.enabled:
+        plan()
+        return
+
+    # /metrics on ACI_SYNC_METRICS_PORT, if set
+    start_metrics_server()
+
     _thread.start_new_thread(refresh_subscriptions, ())
     # print_subscriptions, temp only for dev
     _thread.start_new_thread(print_subscriptions, ())
 
+    # Pod -> ReplicaSet -> Deployment resolution is served from a local
+    # index, kept current from here on by the owner index watchers.
+    rv_owner_rs, rv_owner_deps = sync_owner_index()
+    OwnerIndexWatcher("ReplicaSet", rv_owner_rs)
+    OwnerIndexWatcher("Deployment", rv_owner_deps)
+
     print("Running K8 Sync")
     # Returns the most recent revision number
     # we processed, so the watcher can start at
     # revision number.
-    rv_deps = sync_deployments()
-    rv_pods = sync_pods()
-    rv_svcs = sync_services()
+    rv_deps, rv_pods, rv_svcs = sync_all()
 
     print("Starting Event Watchers")
+    # All watchers push their events into the single dispatcher queue.
     # in_q not currently used.
-    # out_q is used to puch recieved events into the watcher thread.
+    dispatcher = EventDispatcher()
+
     deployment_in_q = Queue()
-    deployment_out_q = Queue()
+    deployment_out_q = dispatcher.source_queue("Deployment")
     deployment_out_q_lock = Lock()
     deployment_watch = DeploymentWatcher(
         deployment_in_q, deployment_out_q, deployment_out_q_lock, rv_deps
     )
 
     pod_in_q = Queue()
-    pod_out_q = Queue()
+    pod_out_q = dispatcher.source_queue("Pod")
     pod_out_q_lock = Lock()
-    pod_watch = PodWatcher(pod_in_q, pod_out_q, pod_out_q_lock, rv_pods)
+    # one pod watcher per filter namespace, the pod stream is filtered server side
+    pod_watches = []
+    for pod_filter in get_pod_filters():
+        for namespace in pod_filter.namespaces or [None]:
+            pod_watches.append(
+                PodWatcher(pod_in_q, pod_out_q, pod_out_q_lock, rv_pods, pod_filter, namespace)
+            )
 
     service_in_q = Queue()
-    service_out_q = Queue()
+    service_out_q = dispatcher.source_queue("Service")
     service_out_q_lock = Lock()
     service_watch = ServiceWatcher(service_in_q, service_out_q, service_out_q_lock, rv_svcs)
 
     apic_in_q = Queue()
-    apic_out_q = Queue()
+    apic_out_q = dispatcher.source_queue("APIC")
     apic_out_q_lock = Lock()
-    apic_watch = APICWatcher(apic_in_q, apic_out_q, apic_out_q_lock)
+    # a reopened websocket has no subscriptions, renew them all and replay
+    # the changes missed whilst disconnected
+    apic_watch = APICWatcher(apic_in_q, apic_out_q, apic_out_q_lock, renew_subscriptions)
+
+    in_queues = {
+        "Deployment-in": deployment_in_q,
+        "Pod-in": pod_in_q,
+        "Service-in": service_in_q,
+        "APIC-in": apic_in_q,
+    }
+    Gauge(
+        "aci_sync_queue_depth",
+        "Events queued, per dispatcher source, worker and watcher in_q",
+        ("queue",),
+        func=lambda: queue_depths(dispatcher, in_queues),
+    )
 
-    k8_event_q_list = [deployment_out_q, service_out_q, pod_out_q]
+    # Periodic desired state reconciliation, SIGHUP requests a run
+    _thread.start_new_thread(run_reconciler, ())
+    signal.signal(signal.SIGHUP, lambda signum, frame: request_reconcile())
 
     killer = graceful_exit()
-    while True:
-        for k8_event_kind_q in k8_event_q_list:
-            try:
-                process_k8_event(k8_event_kind_q.get(block=False))
-            except Empty as e:
-                pass
-
-        try:
-            process_apic_event(apic_out_q.get(block=False))
-        except Empty as e:
-            pass
-
-        if killer.kill_now:
-            print("\nTermninating Application")
-            # TODO - bring back in after ctrl-c or exception
-            # terminate all threads and join
-
-            # deployment_watch
-            #   send term event
-            #   deployment_watch.join()
-            # pod_watch
-            # service_watch
-            # apic_watch
-            # refresh subs
-            # print subs
-
-            apic_logout()
-            break
-
-        sleep(0.5)
+    # Blocks dispatching events until terminated
+    dispatcher.run(lambda: killer.kill_now)
+
+    print("\nTermninating Application")
+    # TODO - bring back in after ctrl-c or exception
+    # terminate all threads and join
+
+    # deployment_watch
+    #   send term event
+    #   deployment_watch.join()
+    # pod_watch
+    # service_watch
+    # apic_watch
+    # refresh subs
+    # print subs
+
+    apic_logout()
+
+
+def queue_depths(dispatcher, in_queues):
+    """
+    Returns { (queue,): events queued } for the queue depth gauge
+
+    in_queues:dict { name: Queue }
+    """
+    stats = dispatcher.stats()
+    depths = {(source,): depth for source, depth in stats["depth"].items()}
+    for i, depth in enumerate(stats["workers"]):
+        depths[("worker-{}".format(i),)] = depth
+    for name, queue in in_queues.items():
+        depths[(name,)] = queue.qsize()
+    return depths
+
+
+def plan():
+    """
+    Plan mode, run the K8 sync and a reconciliation with the APIC writes
+    recorded, print the change set and exit.
+    """
+    sync_owner_index()
+    print("Running K8 Sync (plan)")
+    sync_all()
+    reconcile()
+    aci_plan.print_plan()
+    apic_logout()
 
 
 class graceful_exit:
@@ -4,18 +4,28 @@ TODO:
     Thread alive checking
     Graceful thread termination 
     Thread Locking vars: 
-        managed_objects, apic_token, 
+        managed_objects
 
 """
 import os
-from time import sleep
+from time import sleep, monotonic
 import json
 import re
 import requests
+from requests.adapters import HTTPAdapter
+from requests.cookies import remove_cookie_by_name
 from websocket import create_connection, WebSocketException
+from threading import Lock
 import urllib3
+import socket
 import ssl
 import _thread
+from metrics.prometheus import Histogram
+from tracing import tracing
+from aci_logging.aci_logging import get_logger
+from . import aci_plan
+
+log = get_logger(__name__)
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
@@ -27,12 +37,38 @@ except KeyError as e:
     print("ACI APIC Environment Variable Missing.")
     raise
 
-apic_token = None
+# http for an APIC simulator without TLS, the websocket uses ws/wss to match
+scheme = os.environ.get("ACI_APIC_SCHEME", "https")
+websocket_scheme = "wss" if scheme == "https" else "ws"
+
+# Max number of pooled keep-alive connections held open to the APIC,
+# callers block for a free connection once the pool is exhausted.
+pool_size = int(os.environ.get("ACI_APIC_POOL_SIZE", "10"))
+
+# Seconds without a websocket frame before a ping is sent, the websocket
+# is reconnected if the ping is not answered within the same time.
+websocket_heartbeat = int(os.environ.get("ACI_WEBSOCKET_HEARTBEAT", "30"))
+
 token_refresh_time = None
 websocket = None
+# Incremented by each aaaLogin, a websocket opened under an older login is reopened
+login_generation = 0
+websocket_generation = None
 subscription_ids = set()
 subscription_refresh_time = 60
 
+# Shared HTTP session, owns the connection pool and the APIC-cookie jar.
+# The token lock only serialises token swaps, requests read the jar directly.
+_session = None
+_session_lock = Lock()
+_token_lock = Lock()
+
+apic_request_seconds = Histogram(
+    "aci_apic_request_seconds",
+    "APIC REST request latency by method, URL class and status code",
+    ("method", "url_class", "code"),
+)
+
 
 class REST_Error(Exception):
     """
@@ -52,66 +88,147 @@ def get_websocket():
     return websocket
 
 
+def get_session():
+    """
+    Returns the shared APIC HTTP session, created on first use.
+
+    The session keeps a pool of up to `pool_size` keep-alive connections
+    and holds the APIC-cookie, so a token swap applies to every caller.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+            session.mount("{}://".format(scheme), adapter)
+            session.verify = False
+            session.headers.update({"Content-Type": "application/json"})
+            _session = session
+    return _session
+
+
 def get_token():
-    return apic_token
+    """
+    Returns the current APIC token as { 'APIC-cookie': '...' } or None
+    """
+    with _token_lock:
+        token = get_session().cookies.get("APIC-cookie")
+    return {"APIC-cookie": token} if token is not None else None
+
+
+def _set_token(token):
+    """
+    Replace the APIC-cookie held by the session.
+
+    token:str The APIC-cookie value, None to clear it
+    """
+    cookies = get_session().cookies
+    with _token_lock:
+        if token is None:
+            remove_cookie_by_name(cookies, "APIC-cookie")
+            return
+
+        # the APIC also sets the cookie against its host on login/refresh, the
+        # token is set with that copy's domain and path so it is replaced in
+        # place and a request is never sent without a cookie. Any other copy is
+        # then dropped so only a single cookie is ever sent.
+        current = [cookie for cookie in cookies if cookie.name == "APIC-cookie"]
+        domain, path = (current[0].domain, current[0].path) if current else ("", "/")
+        cookies.set("APIC-cookie", token, domain=domain, path=path)
+        for cookie in current[1:]:
+            if (cookie.domain, cookie.path) != (domain, path):
+                cookies.clear(cookie.domain, cookie.path, cookie.name)
 
 
 def login():
 
-    global apic_token
-    global token_refresh_time
+    _login()
+    if aci_plan.enabled:
+        # plan mode only reads, no session refresh or websocket
+        return
+    _thread.start_new_thread(login_refresh, ())
+    open_websocket()
 
-    url = "https://{}/api/aaaLogin.json".format(host)
+
+def _login():
+    """
+    aaaLogin, sets the session token
+    """
+    global token_refresh_time, login_generation
+
+    url = "{}://{}/api/aaaLogin.json".format(scheme, host)
     payload = {"aaaUser": {"attributes": {"name": username, "pwd": password}}}
-    headers = {"Content-Type": "application/json"}
-    r = requests.post(url, headers=headers, data=json.dumps(payload), verify=False)
+    r = get_session().post(url, data=json.dumps(payload))
     if r.status_code != 200:
         raise Exception("APIC login failed with error: {}\n{}".format(r.status_code, r.content))
 
     data = json.loads(r.content)
-    apic_token = {"APIC-cookie": r.cookies["APIC-cookie"]}
+    _set_token(r.cookies["APIC-cookie"])
     token_refresh_time = data["imdata"][0]["aaaLogin"]["attributes"]["refreshTimeoutSeconds"]
+    login_generation += 1
 
     print("Logged into APIC")
-    _thread.start_new_thread(login_refresh, ())
-    open_websocket()
 
 
 def login_refresh():
     """
     Dedicated Thread (from login())
+
+    If the session refresh fails the application logs in again, the APICWatcher
+    reconnects the websocket with the new token.
     """
-    global apic_token
     global token_refresh_time
 
+    backoff = 1
     while True:
         sleep(min(60, int(token_refresh_time) / 2))
-        r = requests.get(
-            "https://{}/api/aaaRefresh.json".format(host), cookies=apic_token, verify=False
-        )
-        if r.status_code != 200:
-            print(r.content)
-            print("APIC session refresh failed")
-            raise Exception(
-                "APIC session refresh failed with {}-{}".format(r.status_code, r.content)
-            )
-        else:
+        try:
+            r = get_session().get("{}://{}/api/aaaRefresh.json".format(scheme, host))
+            if r.status_code != 200:
+                raise Exception(
+                    "APIC session refresh failed with {}-{}".format(r.status_code, r.content)
+                )
             # print("APIC session refresh successful")
-            apic_token = {"APIC-cookie": r.cookies["APIC-cookie"]}
+            _set_token(r.cookies["APIC-cookie"])
             data = json.loads(r.content)["imdata"][0]
             token_refresh_time = data["aaaLogin"]["attributes"]["refreshTimeoutSeconds"]
 
+        except Exception as e:
+            print("APIC session refresh failed: {}".format(str(e)))
+            while True:
+                try:
+                    _login()
+                    backoff = 1
+                    break
+                except Exception as e:
+                    print("APIC login failed, retrying in {}s: {}".format(backoff, str(e)))
+                    sleep(backoff)
+                    backoff = min(backoff * 2, 60)
+
 
 def open_websocket():
-    """ """
-    global websocket
+    """
+    Opens the APIC websocket with the current token, replacing any open websocket
+    """
+    global websocket, websocket_generation
     kwargs = {"enable_multithread": True}
     sslopt = {"cert_reqs": ssl.CERT_NONE}
-    assert apic_token is not None
-    url = "wss://{}/socket{}".format(host, apic_token["APIC-cookie"])
+    # the websocket always opens with the token of the latest login/refresh
+    generation = login_generation
+    token = get_token()
+    assert token is not None
+    url = "{}://{}/socket{}".format(websocket_scheme, host, token["APIC-cookie"])
+
+    if websocket is not None:
+        try:
+            websocket.close()
+        except Exception:
+            pass
+
     try:
-        websocket = create_connection(url, sslopt=sslopt, **kwargs)
+        websocket = create_connection(url, sslopt=sslopt, timeout=websocket_heartbeat, **kwargs)
         if websocket.connected:
+            websocket_generation = generation
             print("APIC websocket created")
         else:
             print("APIC websocket creation failed.")
@@ -126,18 +243,21 @@ def open_websocket():
         raise
 
 
+def websocket_login_current():
+    """
+    True if the websocket was opened under the current APIC login
+    """
+    return websocket_generation == login_generation
+
+
 def logout():
-    global apic_token
-    url = "https://{}/api/aaaLogout.json".format(host)
+    url = "{}://{}/api/aaaLogout.json".format(scheme, host)
     payload = {"aaaUser": {"attributes": {"name": username}}}
-    headers = {"Content-Type": "application/json"}
-    r = requests.post(
-        url, headers=headers, data=json.dumps(payload), cookies=apic_token, verify=False
-    )
+    r = get_session().post(url, data=json.dumps(payload))
     if r.status_code != 200:
         print("APIC logout failed with error: {}\n{}".format(r.status_code, r.content))
 
-    apic_token = None
+    _set_token(None)
     print("Logged out of APIC")
 
 
@@ -152,9 +272,16 @@ def get(urlpath, params=None):
     params_str = ""
     if params:
         params_str = "?{}".format(params)
-    headers = {"Content-Type": "application/json"}
-    url = "https://{}{}.json{}".format(host, _urlpath, params_str)
-    r = requests.get(url, headers=headers, cookies=apic_token, verify=False)
+    url = "{}://{}{}.json{}".format(scheme, host, _urlpath, params_str)
+    if aci_plan.enabled and _urlpath.startswith("/api/mo/"):
+        # an MO the plan creates does not exist on the APIC yet
+        planned = aci_plan.planned_response(_urlpath[len("/api/mo/") :])
+        if planned is not None:
+            return planned
+    start = monotonic()
+    r = _request("GET", _urlpath, url)
+    if aci_plan.enabled:
+        aci_plan.record_read(monotonic() - start)
 
     if re.fullmatch(r"[345]..", str(r.status_code)):
         raise REST_Error(
@@ -173,39 +300,43 @@ def delete(dn):
     dn: e.g. /uni/tn-TEN_PROD/ctx-....
     """
     _dn = dn if dn.startswith("/") else ("/" + dn)
-    url = "https://{}/api/mo{}.json?rsp-subtree=modified".format(host, _dn)
+    if aci_plan.enabled:
+        aci_plan.record_delete(_dn)
+        return
+    url = "{}://{}/api/mo{}.json?rsp-subtree=modified".format(scheme, host, _dn)
     # Returns 200 OK even if the object does not exist.. .but gives a 400
     # if DN url not in right format
-    r = requests.delete(url, cookies=apic_token, verify=False)
+    r = _request("DELETE", "/api/mo" + _dn, url)
     if r.status_code != 200:
         raise Exception(
             "DN format incorrect for deletion with DN: {} due to {}".format(dn, r.content)
         )
-    print("Deleted MO with DN: {}".format(_dn))
+    log.debug("Deleted MO with DN: %s", _dn)
 
 
 # TODO: clean up options, not a str but dict/str-list and format correctly !
 # take code from tooling orchestrator apic class
-def post(urlpath, payload, options=""):
+def post(urlpath, payload, options="rsp-subtree=full"):
     """
     Returns modified object, full raw json content \
-    
+
+    options:str Query string options, e.g. 'rsp-subtree=modified'
 
     Raises: 
     
     - REST_Error with for non REST 2xx code with additional attributes 'code' and 'content'
     
+    In plan mode the change is recorded and a synthetic response echoing the payload is returned.
     """
     if "api/mo/" not in urlpath and "api/class/" not in urlpath:
         raise Exception("The urlpath does not have /api/xx prefix. {}".format(urlpath))
+    if aci_plan.enabled:
+        return aci_plan.record_post(urlpath, payload)
 
     _urlpath = urlpath if urlpath.startswith("/") else ("/" + urlpath)
-    headers = {"Content-Type": "application/json"}
-    options = "?rsp-subtree=full"
-    url = "https://{}{}.json{}".format(host, _urlpath, options)
-    r = requests.post(
-        url, headers=headers, data=json.dumps(payload), cookies=apic_token, verify=False
-    )
+    options_str = "?{}".format(options) if options else ""
+    url = "{}://{}{}.json{}".format(scheme, host, _urlpath, options_str)
+    r = _request("POST", _urlpath, url, data=json.dumps(payload))
     if r.status_code != 200:
         raise REST_Error(
             "APIC REST POST failed with error: {}\n{}".format(r.status_code, r.content),
@@ -215,3 +346,38 @@ def post(urlpath, payload, options=""):
 
     data = json.loads(r.content)
     return data
+
+
+def _request(method, urlpath, url, **kwargs):
+    """
+    Send a request over the shared session, its latency is recorded by
+    method, URL class and status code ('error' when no response)
+    """
+    start = monotonic()
+    code = "error"
+    with tracing.span("APIC {}".format(method), url=urlpath) as span:
+        try:
+            r = get_session().request(method, url, **kwargs)
+            code = r.status_code
+            return r
+        finally:
+            apic_request_seconds.observe(monotonic() - start, method, url_class(urlpath), code)
+            if span is not None:
+                span.set_attribute("code", code)
+
+
+def url_class(urlpath):
+    """
+    Returns the metrics class of an API path, bounded whatever the DN
+
+    /api/mo/uni/tn-A/out-B/instP-C -> mo:instP
+    /api/class/l3extSubnet -> class:l3extSubnet
+    /api/subscriptionRefresh -> subscriptionRefresh
+    """
+    # drop the bracketed names, e.g. extsubnet-[10.0.0.1/32]
+    parts = re.sub(r"\[[^\]]*\]", "", urlpath).strip("/").split("/")
+    if len(parts) > 2 and parts[1] == "class":
+        return "class:{}".format(parts[2])
+    if len(parts) > 2 and parts[1] == "mo":
+        return "mo:{}".format(parts[-1].split("-")[0])
+    return parts[-1]
@@ -0,0 +1,209 @@
+"""
+Plan (dry-run) mode, the APIC writes are recorded instead of sent.
+
+With plan mode enabled aci_apic.post/delete record the change and return a
+synthetic response, reads still go to the APIC and are timed. A read of a
+DN the plan creates is answered from the plan, so on a fresh fabric the
+subnets of a planned EEPG are planned too. print_plan() prints the change
+set per tenant/l3out/eepg.
+"""
+import os
+import re
+import copy
+from collections import OrderedDict
+from threading import Lock
+
+# Warn when the plan deletes more than this many subnets/EEPGs
+plan_delete_warn = int(os.environ.get("ACI_PLAN_DELETE_WARN", "50"))
+
+# RN format per class, for MOs posted without a DN
+rn_formats = {
+    "fvTenant": "tn-{name}",
+    "l3extOut": "out-{name}",
+    "l3extInstP": "instP-{name}",
+    "l3extSubnet": "extsubnet-[{ip}]",
+}
+
+# Plan mode, also enabled by the aci-sync.py --plan flag
+enabled = os.environ.get("ACI_SYNC_PLAN", "").lower() in ("1", "true", "yes")
+# DN -> (action, class, attributes), the last change to a DN wins
+_changes = OrderedDict()
+# DN -> (class, attributes) of the MOs the plan creates, as read back by planned_response()
+_created = OrderedDict()
+_lock = Lock()
+# [GET count, total GET seconds]
+_reads = [0, 0.0]
+
+_dn_re = re.compile(r"^uni/tn-([^/]+)(?:/out-([^/]+))?(?:/instP-([^/]+))?")
+# A single RN, the brackets may hold a '/' e.g. extsubnet-[10.0.0.1/32]
+_child_rn_re = re.compile(r"[^/\[]+(\[[^\]]*\])?")
+_last_rn_re = re.compile(r"[^/\[\]]+(\[[^\]]*\])?$")
+
+# Attributes the APIC sets on a created MO that the handlers read
+mo_defaults = {"descr": "", "annotation": ""}
+
+
+def enable_plan_mode():
+    global enabled
+    enabled = True
+    print("APIC plan mode, changes are recorded and not sent to the APIC")
+
+
+def record_read(seconds):
+    """
+    Account a GET against the read phase
+    """
+    with _lock:
+        _reads[0] += 1
+        _reads[1] += seconds
+
+
+def record_post(urlpath, payload):
+    """
+    Record the MOs of a POST payload tree, returns a synthetic APIC response
+    echoing the payload with every MO's DN set.
+
+    urlpath:str e.g. /api/mo/uni/tn-TEN_K8/out-L3O
+    payload:dict { 'class-name': { 'attributes': {...}, 'children': [...] } }
+    """
+    parent_dn = urlpath.strip("/")
+    parent_dn = parent_dn[len("api/mo/") :] if parent_dn.startswith("api/mo/") else parent_dn
+    echo = copy.deepcopy(payload)
+    _record_tree(parent_dn, echo)
+    return {"totalCount": "1", "imdata": [echo]}
+
+
+def record_delete(dn):
+    """
+    Record the deletion of a DN
+    """
+    dn = dn.strip("/")
+    with _lock:
+        _changes.pop(dn, None)
+        _changes[dn] = ("delete", None, {})
+        _forget_created(dn)
+
+
+def planned_response(dn):
+    """
+    Returns a synthetic GET response for a DN the plan creates, holding its
+    planned children, None if the plan does not create the DN
+
+    dn:str e.g. uni/tn-TEN_K8/out-L3O/instP-EPG
+    """
+    dn = dn.strip("/")
+    with _lock:
+        created = _created.get(dn)
+        if created is None:
+            return None
+        mo_class, attributes = created
+        children = [
+            {child_class: {"attributes": dict(child_attributes)}}
+            for child_dn, (child_class, child_attributes) in _created.items()
+            if child_dn.startswith(dn + "/") and _child_rn_re.fullmatch(child_dn[len(dn) + 1 :])
+        ]
+    mo = {"attributes": dict(attributes)}
+    if children:
+        mo["children"] = children
+    return {"totalCount": "1", "imdata": [{mo_class: mo}]}
+
+
+def _record_tree(parent_dn, tree):
+    for mo_class, mo in tree.items():
+        attributes = mo.setdefault("attributes", {})
+        dn = attributes.get("dn")
+        if dn is None:
+            rn = rn_formats[mo_class].format(**attributes) if mo_class in rn_formats else None
+            # posted to the MO's own DN
+            if rn is None or parent_dn.endswith("/" + rn) or parent_dn == rn:
+                dn = parent_dn
+            else:
+                dn = "{}/{}".format(parent_dn, rn)
+            attributes["dn"] = dn
+
+        status = attributes.get("status", "")
+        changed = {k: v for k, v in attributes.items() if k not in ("dn", "name", "status")}
+        with _lock:
+            if status == "deleted":
+                _changes.pop(dn, None)
+                _changes[dn] = ("delete", mo_class, {})
+                _forget_created(dn)
+            elif status != "modified":
+                _changes.pop(dn, None)
+                _changes[dn] = ("create", mo_class, changed)
+                # the echo holds the attributes the APIC returns for a new MO
+                for k, v in mo_defaults.items():
+                    attributes.setdefault(k, v)
+                attributes.setdefault("rn", _last_rn_re.search(dn).group(0))
+                _created[dn] = (mo_class, dict(attributes, status="created"))
+            elif changed:
+                # a parent marked modified only to hold children is not a change
+                action = _changes[dn][0] if dn in _changes else "modify"
+                _changes[dn] = (action, mo_class, changed)
+                if dn in _created:
+                    _created[dn][1].update(changed)
+
+        for child in mo.get("children", []):
+            _record_tree(dn, child)
+
+
+def _forget_created(dn):
+    """
+    Drop a deleted DN and the DNs below it from the planned MOs, holding _lock
+    """
+    for created_dn in [d for d in _created if d == dn or d.startswith(dn + "/")]:
+        del _created[created_dn]
+
+
+def get_plan():
+    """
+    Returns the recorded changes grouped per EEPG
+
+    Returns:dict - { (tenant, l3out, eepg): [ (action, dn, class, attributes), ... ] }
+    """
+    plan = OrderedDict()
+    with _lock:
+        changes = list(_changes.items())
+    for dn, (action, mo_class, attributes) in changes:
+        match = _dn_re.match(dn)
+        key = match.groups() if match is not None else (dn, None, None)
+        plan.setdefault(key, []).append((action, dn, mo_class, attributes))
+    return plan
+
+
+def print_plan():
+    """
+    Prints the change set per tenant/l3out/eepg and the read phase timing
+    """
+    plan = get_plan()
+    counts = {"create": 0, "modify": 0, "delete": 0}
+    symbols = {"create": "+", "modify": "~", "delete": "-"}
+
+    print("APIC Plan")
+    print("=" * 100)
+    for (tenant, l3out, eepg), changes in plan.items():
+        print("tn-{} / out-{} / instP-{}".format(tenant, l3out, eepg))
+        for action, dn, mo_class, attributes in changes:
+            counts[action] += 1
+            print(
+                "  {} {:<8} {} {}".format(
+                    symbols[action],
+                    action,
+                    dn,
+                    " ".join("{}={}".format(k, v) for k, v in sorted(attributes.items())),
+                ).rstrip()
+            )
+    print("=" * 100)
+    print(
+        "Plan: {} to create, {} to modify, {} to delete".format(
+            counts["create"], counts["modify"], counts["delete"]
+        )
+    )
+    print("Read phase: {} APIC GETs in {:.3f}s".format(_reads[0], _reads[1]))
+    if counts["delete"] > plan_delete_warn:
+        print(
+            "WARNING: the plan deletes {} APIC objects, more than ACI_PLAN_DELETE_WARN ({})".format(
+                counts["delete"], plan_delete_warn
+            )
+        )
+    return counts
@@ -5,20 +5,34 @@ import json
 from time import sleep
 from queue import Queue
 from threading import Thread, Lock
-from .aci_apic import get_websocket
+from websocket import ABNF, WebSocketTimeoutException
+from .aci_apic import get_websocket, open_websocket, websocket_login_current
+
+# Seconds to wait before reconnecting the websocket, doubled on each failure
+reconnect_backoff_min = 1
+reconnect_backoff_max = 60
 
 
 class APICWatcher(Thread):
     """
     Listens for APIC Websocket Events
+
+    The websocket is pinged when quiet and reopened with backoff when it closes,
+    stops answering pings or the APIC login is renewed. After a reconnect the
+    on_reconnect callback re-subscribes, the APIC events it returns (changes
+    missed whilst disconnected) are pushed to the out queue.
     """
 
-    def __init__(self, inQ: Queue, outQ: Queue, outQLock: Lock):
+    def __init__(self, inQ: Queue, outQ: Queue, outQLock: Lock, on_reconnect=None):
+        """
+        on_reconnect:func Called after the websocket is reopened, returns a list of APIC events
+        """
         Thread.__init__(self)
         self._inQ = inQ
         # Out Q - Events from APIC are pushed in
         self._outQ = outQ
         self._outQLock = outQLock
+        self._on_reconnect = on_reconnect
 
         self._log("Init APICWatcher Instance")
         self._start_thread()
@@ -36,8 +50,7 @@ class APICWatcher(Thread):
         """ """
         while True:
             try:
-                event = get_websocket().recv()
-                sleep(1)
+                self._receive(get_websocket())
 
             except Exception as e:
                 # dedicated thread so ensure we send any unhandled
@@ -45,9 +58,60 @@ class APICWatcher(Thread):
                 print("Unhandled error in ACI APICWatcher thread: {}".format(str(e)))
                 print(traceback.format_exc())
 
-            if not len(event):
+            self._reconnect()
+
+    def _receive(self, ws):
+        """
+        Reads the websocket until it needs reopening
+        """
+        ping_sent = False
+        while ws is not None and ws.connected:
+            try:
+                opcode, data = ws.recv_data(control_frame=True)
+            except WebSocketTimeoutException:
+                if ping_sent:
+                    print("APIC websocket heartbeat not answered")
+                    return
+                if not websocket_login_current():
+                    print("APIC login renewed")
+                    return
+                ws.ping()
+                ping_sent = True
                 continue
-            self._outQ.put(json.loads(event))
+
+            ping_sent = False
+            if opcode == ABNF.OPCODE_CLOSE:
+                print("APIC websocket closed")
+                return
+            if opcode != ABNF.OPCODE_TEXT or not len(data):
+                continue
+            self._outQ.put(json.loads(data))
+
+    def _reconnect(self):
+        """
+        Reopens the websocket, then runs the on_reconnect callback
+        """
+        backoff = reconnect_backoff_min
+        while True:
+            print("APIC websocket reconnecting in {}s".format(backoff))
+            sleep(backoff)
+            try:
+                open_websocket()
+                break
+            except Exception as e:
+                print("APIC websocket reconnect failed: {}".format(str(e)))
+                backoff = min(backoff * 2, reconnect_backoff_max)
+
+        if self._on_reconnect is None:
+            return
+        try:
+            events = self._on_reconnect()
+        except Exception as e:
+            print("APIC websocket on_reconnect failed: {}".format(str(e)))
+            print(traceback.format_exc())
+            return
+        for event in events:
+            self._outQ.put(event)
 
     def _log(self, msg):
         print(msg)
@@ -2,10 +2,15 @@
 """
 import re
 from aci_apic.aci_apic import REST_Error, get, post, delete
+from tracing.tracing import traced
+from aci_logging.aci_logging import get_logger
 
 from exceptions import ManagedObjectNotFoundError
 
+log = get_logger(__name__)
 
+
+@traced
 def get_tenant(name):
     """
     Returns the fvTenant MO { 'attributes: {...}}
@@ -23,6 +28,7 @@ def get_tenant(name):
         raise ManagedObjectNotFoundError("Tenant {} does not exist".format(name))
 
 
+@traced
 def get_l3out_epg(tenant_name, l3o_name, epg_name, create_if_absent=False):
     """
     Return EEPG attributes.
@@ -43,7 +49,7 @@ def get_l3out_epg(tenant_name, l3o_name, epg_name, create_if_absent=False):
             )
         else:
             if create_if_absent:
-                print("Trying to create absent EEPG - L3Out: {} EPG:{}".format(l3o_name, epg_name))
+                log.info("Trying to create absent EEPG - L3Out: %s EPG: %s", l3o_name, epg_name)
                 return create_l3out_epg(tenant_name, l3o_name, epg_name)
             else:
                 raise ManagedObjectNotFoundError(
@@ -53,6 +59,7 @@ def get_l3out_epg(tenant_name, l3o_name, epg_name, create_if_absent=False):
                 )
 
 
+@traced
 def get_eepg(tenant, l3out, eepg, subnet):
     """ """
     urlpath = "/api/mo/uni/tn-{}/out-{}/instP-{}/extsubnet-[{}]".format(tenant, l3out, eepg, subnet)
@@ -64,6 +71,7 @@ def get_eepg(tenant, l3out, eepg, subnet):
     raise ManagedObjectNotFoundError("MO {} not found.")
 
 
+@traced
 def create_l3out_epg(tenant_name, l3o_name, epg_name):
     """
     '
@@ -77,17 +85,19 @@ def create_l3out_epg(tenant_name, l3o_name, epg_name):
 
     data = post(urlpath, payload)
 
-    print("Created EEPG {} for L3Out {} in Tenant {}".format(epg_name, l3o_name, tenant_name))
+    log.info("Created EEPG %s for L3Out %s in Tenant %s", epg_name, l3o_name, tenant_name)
 
     # TODO: tidy up error handling if totalCount==0 (unlikely senario)
     return data["imdata"][0]["l3extInstP"]
 
 
+@traced
 def delete_managed_object(dn):
     """ """
     delete(dn)
 
 
+@traced
 def create_eepg_subnet(tenant, l3out, eepg, host_ip, name):
     """
     Create APIC l3extSubnet for L3Out (l3out)
@@ -117,10 +127,13 @@ def create_eepg_subnet(tenant, l3out, eepg, host_ip, name):
         # Already exists, return MO config.
         return mo
 
-    print(
-        "Creating APIC L3Out EEPG for {}|{}|{} with IP: {}, {}".format(
-            tenant, l3out, eepg, host_ip, name
-        )
+    log.info(
+        "Creating APIC L3Out EEPG subnet for %s|%s|%s with IP: %s, %s",
+        tenant,
+        l3out,
+        eepg,
+        host_ip,
+        name,
     )
 
     # change to regex for /1-32, 32 default if missing
@@ -150,6 +163,128 @@ def create_eepg_subnet(tenant, l3out, eepg, host_ip, name):
     return mo["imdata"][0]["l3extSubnet"]
 
 
+@traced
+def create_eepg_subnets(subnets):
+    """
+    Create many APIC l3extSubnet's as hosts (/32), using one APIC
+    transaction per parent EEPG (l3extInstP).
+
+    subnets:list - (tenant, l3out, eepg, host_ip, name) tuples
+
+    The subnets are grouped under their l3extInstP parent and each group is
+    posted as a single tree to /api/mo/uni. The parents are only modified,
+    never created. Subnets that already exist are returned as is.
+
+    Returns:dict - l3extSubnet MO configurations keyed by DN. { 'uni/...': { 'attributes': {...} } }
+    Subnets where the parent MOs (fvTenant, l3out, l3extInstP) do not exist are
+    not in the returned dict.
+    """
+    groups = {}
+    for tenant, l3out, eepg, host_ip, name in subnets:
+        ip = host_ip if host_ip.endswith("/32") else "{}/32".format(host_ip)
+        groups.setdefault((tenant, l3out, eepg), {})[ip] = name
+
+    subnet_mos = {}
+    for (tenant, l3out, eepg), ips in groups.items():
+        eepg_dn = "uni/tn-{}/out-{}/instP-{}".format(tenant, l3out, eepg)
+
+        # one GET per EEPG to skip subnets that already exist
+        try:
+            eepg_mo = get_eepg_subnets(tenant, l3out, eepg, managed_only=False)
+        except ManagedObjectNotFoundError:
+            log.warning("APIC EEPG %s not found, cannot create %s subnets", eepg_dn, len(ips))
+            continue
+
+        for child in eepg_mo.get("children", []):
+            subnet = child.get("l3extSubnet")
+            if subnet is None or subnet["attributes"]["ip"] not in ips:
+                continue
+            dn = "{}/{}".format(eepg_dn, subnet["attributes"]["rn"])
+            subnet["attributes"].setdefault("dn", dn)
+            subnet_mos[dn] = subnet
+            del ips[subnet["attributes"]["ip"]]
+
+        if len(ips) == 0:
+            continue
+
+        log.info("Creating %s APIC L3Out EEPG subnets for %s|%s|%s", len(ips), tenant, l3out, eepg)
+        children = []
+        for ip, name in ips.items():
+            ip_name = name[:63] if name is not None else ""
+            children.append(
+                {
+                    "l3extSubnet": {
+                        "attributes": {
+                            "annotation": "orchestrator:aci-k8-haystack",
+                            "scope": "import-security",
+                            "ip": ip,
+                            "name": ip_name,
+                        }
+                    }
+                }
+            )
+
+        payload = {
+            "fvTenant": {
+                "attributes": {"name": tenant, "status": "modified"},
+                "children": [
+                    {
+                        "l3extOut": {
+                            "attributes": {"name": l3out, "status": "modified"},
+                            "children": [
+                                {
+                                    "l3extInstP": {
+                                        "attributes": {"name": eepg, "status": "modified"},
+                                        "children": children,
+                                    }
+                                }
+                            ],
+                        }
+                    }
+                ],
+            }
+        }
+
+        try:
+            data = post("/api/mo/uni", payload, options="rsp-subtree=modified")
+        except REST_Error as e:
+            if e.code == 400:
+                # fvTenant, l3out and/or l3extInstP (parents) are absent.
+                log.warning("APIC EEPG %s not found, cannot create %s subnets", eepg_dn, len(ips))
+                continue
+            raise
+
+        created = dict(_find_managed_objects(data["imdata"], "l3extSubnet"))
+        for child in children:
+            attributes = child["l3extSubnet"]["attributes"]
+            dn = "{}/extsubnet-[{}]".format(eepg_dn, attributes["ip"])
+            # the APIC does not return objects that were left unchanged
+            subnet_mos[dn] = created.get(dn, {"attributes": dict(attributes, dn=dn)})
+
+    return subnet_mos
+
+
+def _find_managed_objects(imdata, mo_class, parent_dn=""):
+    """
+    Yields (dn, mo) for every MO of class mo_class in an APIC response tree.
+
+    imdata:list - APIC imdata or children list. [{ 'class-name': {...} }, ...]
+    mo_class:str - e.g. l3extSubnet
+    """
+    for item in imdata:
+        for item_class, mo in item.items():
+            attributes = mo.get("attributes", {})
+            dn = attributes.get("dn")
+            if dn is None:
+                rn = attributes.get("rn", "uni" if item_class == "polUni" else None)
+                dn = "{}/{}".format(parent_dn, rn) if parent_dn else rn
+            if item_class == mo_class:
+                attributes["dn"] = dn
+                yield dn, mo
+            yield from _find_managed_objects(mo.get("children", []), mo_class, dn)
+
+
+@traced
 def delete_eepg_subnet(tenant, l3out, eepg, host_ip):
     """
     Deletes the l3extSubnet Managed Object from the APIC.
@@ -160,10 +295,60 @@ def delete_eepg_subnet(tenant, l3out, eepg, host_ip):
     host_ip:str - The host address to delete (excluding mask, /32 is used internally)
     """
     urlpath = "/uni/tn-{}/out-{}/instP-{}/extsubnet-[{}/32]".format(tenant, l3out, eepg, host_ip)
-    print("APIC Deleting Subnet: {}".format(urlpath))
+    log.info("APIC Deleting Subnet: %s", urlpath)
     mo = delete(urlpath)
 
 
+@traced
+def delete_eepg_subnets(subnets):
+    """
+    Deletes many l3extSubnet Managed Objects from the APIC, using one APIC
+    transaction per parent EEPG (l3extInstP).
+
+    subnets:list - (tenant, l3out, eepg, host_ip) tuples, host_ip with or without the /32 mask
+    """
+    groups = {}
+    for tenant, l3out, eepg, host_ip in subnets:
+        ip = host_ip if host_ip.endswith("/32") else "{}/32".format(host_ip)
+        groups.setdefault((tenant, l3out, eepg), []).append(ip)
+
+    for (tenant, l3out, eepg), ips in groups.items():
+        log.info("Deleting %s APIC L3Out EEPG subnets for %s|%s|%s", len(ips), tenant, l3out, eepg)
+        children = [{"l3extSubnet": {"attributes": {"ip": ip, "status": "deleted"}}} for ip in ips]
+        payload = {
+            "fvTenant": {
+                "attributes": {"name": tenant, "status": "modified"},
+                "children": [
+                    {
+                        "l3extOut": {
+                            "attributes": {"name": l3out, "status": "modified"},
+                            "children": [
+                                {
+                                    "l3extInstP": {
+                                        "attributes": {"name": eepg, "status": "modified"},
+                                        "children": children,
+                                    }
+                                }
+                            ],
+                        }
+                    }
+                ],
+            }
+        }
+
+        try:
+            post("/api/mo/uni", payload, options="rsp-subtree=modified")
+        except REST_Error as e:
+            if e.code == 400:
+                # fvTenant, l3out and/or l3extInstP (parents) are absent, nothing to delete
+                log.warning(
+                    "APIC EEPG %s|%s|%s not found, subnets not deleted", tenant, l3out, eepg
+                )
+                continue
+            raise
+
+
+@traced
 def get_eepg_subnets(tenant, l3out, eepg, managed_only=True):
     """
     Returns a l3extInstP (L3Out EEPG) object from the APIC including
@@ -1,10 +1,46 @@
 """
 """
-from time import sleep
+import os
+import re
+from time import sleep, monotonic
+from threading import RLock, Lock, Event
+from zlib import crc32
+from concurrent.futures import ThreadPoolExecutor
 import traceback
-from aci_apic.aci_apic import REST_Error, get
+from datetime import datetime
+from aci_apic.aci_apic import REST_Error, get, pool_size, subscription_refresh_time
+from aci_apic import aci_plan
+from aci_helpers.aci_helpers import get_parent_from_dn
+from metrics.prometheus import Gauge
+from tracing import tracing
+from aci_logging.aci_logging import get_logger
 from typing import List
 
+log = get_logger(__name__)
+
+# APIC subscription mode for the managed l3extInstP and l3extSubnet DNs
+#  - dn:      one subscription per DN
+#  - subtree: one subscription per l3extInstP covering the EEPG and its subnets
+#  - class:   one l3extSubnet subscription filtered on the haystack annotation,
+#             the l3extInstP DNs are subscribed per DN
+# Any other DN (e.g. a parent L3Out watched for a callback) has its own subscription.
+subscription_mode = os.environ.get("ACI_SUBSCRIPTION_MODE", "dn")
+assert subscription_mode in ["dn", "subtree", "class"]
+
+# Seconds between refreshes of each APIC subscription, the APIC expires a
+# subscription subscription_refresh_time seconds after its last refresh.
+subscription_refresh_interval = int(os.environ.get("ACI_SUBSCRIPTION_REFRESH_INTERVAL", "30"))
+assert 0 < subscription_refresh_interval < subscription_refresh_time
+
+# Subscriptions shared by many managed objects (subtree & class mode)
+# { key: { 'urlpath': str, 'params': str, 'id': subscription ID } }
+_shared_subscriptions = {}
+# Held from the check for a key to its subscribe, so a key is only subscribed once
+_shared_subscriptions_lock = Lock()
+# Held from the cache check for a DN to its subscribe, or its unsubscribe, so a
+# DN is only subscribed once. Striped by DN, different DNs subscribe in parallel.
+_watch_locks = [RLock() for _ in range(64)]
+
 
 class ManagedObject:
     """ """
@@ -15,7 +51,7 @@ class ManagedObject:
         mo:dict is the dict like { "l3extSubnet": { ...}  }
         sub_id:int is the APIC subscription ID like 9298883939
         """
-        self._dn = dn if dn.startswith("/") else ("/" + dn)
+        self._dn = normalise_dn(dn)
         self._sub_id = sub_id
         self._mo = mo
         self._callbacks = {"created": [], "modified": [], "deleted": []}
@@ -67,9 +103,10 @@ class ManagedObject:
         action:str One of 'created','modified','deleted'
         f:func A function to be called with no params.
 
+        The callback's span is linked to the span registering it, when tracing.
         """
         assert action in ["created", "modified", "deleted"]
-        self._callbacks[action].append(f)
+        self._callbacks[action].append((f, tracing.current_context()))
 
     def run_callbacks(self, action):
         """
@@ -82,46 +119,194 @@ class ManagedObject:
         assert action in ["created", "modified", "deleted"]
         for _ in range(len(self._callbacks[action])):
             try:
-                print("\nRunning callback for {} : {}".format(action, self.dn))
-                func = self._callbacks[action].pop(0)
-                func()
+                log.info("Running callback for %s : %s", action, self.dn)
+                func, context = self._callbacks[action].pop(0)
+                with tracing.linked_span(
+                    "callback {}".format(getattr(func, "__name__", "")), [context], dn=self.dn
+                ):
+                    func()
             except Exception as e:
-                print("An error occurred during a callback func execution: {}" / format(str(e)))
-                print(traceback.format_exc())
+                log.exception("An error occurred during a callback func execution: %s", str(e))
                 # continue processing all other callbacks
         return
 
 
-_managed_objects: List[ManagedObject]
-_managed_objects = []
+def normalise_dn(dn):
+    """
+    Returns the DN as '/uni/...' with a leading and without a trailing '/'
+    """
+    _dn = dn if dn.startswith("/") else ("/" + dn)
+    return _dn.rstrip("/") or "/"
 
 
-def watch_managed_object(dn):
+def split_dn(dn):
+    """
+    Returns the list of RNs in a DN, a '/' inside [] is not an RN separator.
+
+    dn:str /uni/tn-TEN_K8_C1/out-L3O_K8_C1/instP-EPG1/extsubnet-[172.27.111.253/32]
+    returns:list ['uni', 'tn-TEN_K8_C1', 'out-L3O_K8_C1', 'instP-EPG1', 'extsubnet-[172.27.111.253/32]']
+    """
+    return _rn_re.findall(dn)
+
+
+_rn_re = re.compile(r"(?:[^/\[]|\[[^\]]*\])+")
+
+
+class _DNTrieNode:
+    """
+    A DN hierarchy node, one per RN.
+    """
+
+    __slots__ = ("children", "mo")
+
+    def __init__(self):
+        self.children = {}
+        self.mo = None
+
+
+class ManagedObjectCache:
+    """
+    Thread safe ManagedObject cache keyed by normalised DN.
+
+    A DN hierarchy (trie) index of the same objects answers subtree
+    queries, e.g. all cached children of an EEPG.
+    """
+
+    def __init__(self):
+        self._lock = RLock()
+        self._objects = {}
+        self._root = _DNTrieNode()
+
+    def __len__(self):
+        return len(self._objects)
+
+    def __contains__(self, dn):
+        return normalise_dn(dn) in self._objects
+
+    def get(self, dn):
+        """
+        Returns the ManagedObject for the DN or None
+        """
+        return self._objects.get(normalise_dn(dn))
+
+    def values(self):
+        """
+        Returns a list (snapshot) of all cached ManagedObject's
+        """
+        with self._lock:
+            return list(self._objects.values())
+
+    def add(self, mo):
+        """
+        Adds a ManagedObject, returns False if the DN is already cached.
+        """
+        with self._lock:
+            if mo.dn in self._objects:
+                return False
+            self._objects[mo.dn] = mo
+            node = self._root
+            for rn in split_dn(mo.dn):
+                node = node.children.setdefault(rn, _DNTrieNode())
+            node.mo = mo
+            return True
+
+    def remove(self, dn):
+        """
+        Removes and returns the ManagedObject for the DN, None if not cached.
+        """
+        with self._lock:
+            mo = self._objects.pop(normalise_dn(dn), None)
+            if mo is None:
+                return None
+
+            path = [self._root]
+            rns = split_dn(mo.dn)
+            for rn in rns:
+                path.append(path[-1].children[rn])
+            path[-1].mo = None
+
+            # prune the now empty branch
+            for rn, node, parent in zip(reversed(rns), reversed(path), reversed(path[:-1])):
+                if node.mo is not None or len(node.children) > 0:
+                    break
+                del parent.children[rn]
+            return mo
+
+    def subtree(self, dn):
+        """
+        Returns a list of the cached ManagedObject's at and below the DN.
+        """
+        with self._lock:
+            node = self._root
+            for rn in split_dn(normalise_dn(dn)):
+                node = node.children.get(rn)
+                if node is None:
+                    return []
+
+            mos = []
+            nodes = [node]
+            while len(nodes) > 0:
+                node = nodes.pop()
+                if node.mo is not None:
+                    mos.append(node.mo)
+                nodes.extend(node.children.values())
+            return mos
+
+
+_managed_objects = ManagedObjectCache()
+
+
+def watch_managed_object(dn, mo=None):
     """
     Creates a Managed Object cache entry and creates an APIC subscription for the
     DN.
 
+    In subtree or class subscription mode the DN joins the shared subscription
+    covering it, APIC events are matched to the cache entry by DN. In plan
+    mode the DN is cached without a subscription.
+
     dn:str '/uni/tn-TEN_K8/...'
+    mo:dict Optional, current MO config { 'class-name': { ... } }, saves a GET
+    in subtree and class mode
     """
-    print("\tWatching managed object: {}".format(dn))
-    _dn = dn if dn.startswith("/") else ("/" + dn)
-    global _managed_objects
-    for o in _managed_objects:
-        if o.dn == _dn:
-            print(
-                "DN: {} already being watched with subscription ID: {}".format(
-                    _dn, o.subscription_id
-                )
-            )
-            return
+    log.debug("Watching managed object: %s", dn, extra={"dn": dn})
+    _dn = normalise_dn(dn)
+    with _watch_lock(_dn):
+        _watch_managed_object(_dn, mo)
+
+
+def _watch_managed_object(_dn, mo):
+    cached_mo = _managed_objects.get(_dn)
+    if cached_mo is not None:
+        log.debug(
+            "DN: %s already being watched with subscription ID: %s",
+            _dn,
+            cached_mo.subscription_id,
+        )
+        return
 
-    data = subscribe(_dn)
+    if aci_plan.enabled:
+        # plan mode only reads, the MO is cached without an APIC subscription
+        if mo is None:
+            mo = _get_mo(_dn)
+        _managed_objects.add(ManagedObject(dn=_dn, mo=mo))
+        return
 
-    # Can be empty data if subscribing to an object that doesnt exist yet
-    mo = data["imdata"][0] if len(data["imdata"]) > 0 else None
+    shared = _shared_subscription_for(_dn)
+    if shared is None:
+        data = subscribe(_dn)
+        sub_id = data["subscriptionId"]
+        # Can be empty data if subscribing to an object that doesnt exist yet
+        if len(data["imdata"]) > 0:
+            mo = data["imdata"][0]
+    else:
+        key, urlpath, params = shared
+        sub_id, data = subscribe_shared(key, urlpath, params)
+        if mo is None:
+            mo = _find_mo(data["imdata"], _dn) if data is not None else _get_mo(_dn)
 
-    # TODO: Lock Required
-    _managed_objects.append(ManagedObject(dn=_dn, mo=mo, sub_id=data["subscriptionId"]))
+    if _managed_objects.add(ManagedObject(dn=_dn, mo=mo, sub_id=sub_id)):
+        _refresh_scheduler.track(sub_id)
 
 
 def unwatch_managed_object(dn):
@@ -130,25 +315,61 @@ def unwatch_managed_object(dn):
 
     dn:str '/uni/tn-TEN_K8/...'
     """
-    _dn = dn if dn.startswith("/") else ("/" + dn)
-    for i, mo in enumerate(_managed_objects):
-        if mo.dn == _dn:
-            # TODO: Lock Required
-            del _managed_objects[i]
-            print("Removed APIC change subscription for DN: {}".format(_dn))
-            return
-    print("Did not find an active subscription for DN: {}".format(_dn))
+    _dn = normalise_dn(dn)
+    with _watch_lock(_dn):
+        _unwatch_managed_object(_dn)
+
+
+def _unwatch_managed_object(_dn):
+    mo = _managed_objects.remove(_dn)
+    if mo is None:
+        log.debug("Did not find an active subscription for DN: %s", _dn)
+        return
+
+    if _refresh_scheduler.untrack(mo.subscription_id):
+        _release_shared_subscription(_dn, mo.subscription_id)
+    log.debug("Removed APIC change subscription for DN: %s", _dn, extra={"dn": _dn})
+
+
+def _watch_lock(dn):
+    """
+    Returns the watch lock of a normalised DN
+    """
+    return _watch_locks[crc32(dn.encode()) % len(_watch_locks)]
+
+
+def unwatch_managed_subtree(dn):
+    """
+    Deletes the ManagedObject class instances for the DN and every cached
+    DN below it, e.g. an EEPG and all of its subnets.
+
+    dn:str '/uni/tn-TEN_K8/...'
+
+    Returns:list - The DNs no longer watched
+    """
+    dns = [mo.dn for mo in _managed_objects.subtree(dn)]
+    for _dn in dns:
+        unwatch_managed_object(_dn)
+    return dns
 
 
 def get_cached_managed_object(dn) -> ManagedObject:
     """
     dn: /uni/tn-TEN_K8/...
     """
-    _dn = dn if dn.startswith("/") else ("/" + dn)
-    for mo in _managed_objects:
-        if mo.dn == _dn:
-            return mo
-    raise Exception("MO with DN {} not in cache.".format(dn))
+    mo = _managed_objects.get(dn)
+    if mo is None:
+        raise Exception("MO with DN {} not in cache.".format(dn))
+    return mo
+
+
+def get_cached_managed_subtree(dn) -> List[ManagedObject]:
+    """
+    Returns the cached ManagedObject's at and below the DN
+
+    dn: /uni/tn-TEN_K8/...
+    """
+    return _managed_objects.subtree(dn)
 
 
 def update_cached_managed_object(dn, mo):
@@ -162,13 +383,48 @@ def update_cached_managed_object(dn, mo):
     Raises:
         Exception if DN not found in cache
     """
-    print("\tUpdating managed object: {}".format(dn))
-    _dn = dn if dn.startswith("/") else ("/" + dn)
-    for _mo in _managed_objects:
-        if _mo.dn == _dn:
-            _mo.mo = mo
-            return
-    raise Exception("MO with DN {} not in cache.".format(dn))
+    log.debug("Updating managed object: %s", dn)
+    get_cached_managed_object(dn).mo = mo
+
+
+def patch_cached_managed_object(dn, mo_class, attributes):
+    """
+    Merge the attributes of a modified event into the cached MO in place, an
+    event older than the cached MO (by modTs) is discarded.
+
+    dn:str  /uni/tn-TEN_K8/...  \\
+    mo_class:str e.g. l3extInstP \\
+    attributes:dict The event attributes, only the modified attributes
+
+    Returns:bool - False if the cache could not be patched, the MO is not
+    cached or the event has no modTs, the caller should GET the MO instead
+    """
+    mo = _managed_objects.get(normalise_dn(dn))
+    if mo is None or mo.mo is None or mo_class not in mo.mo or "modTs" not in attributes:
+        return False
+
+    cached = mo.mo[mo_class]["attributes"]
+    try:
+        out_of_order = "modTs" in cached and (
+            _parse_mod_ts(attributes["modTs"]) < _parse_mod_ts(cached["modTs"])
+        )
+    except ValueError:
+        return False
+    if out_of_order:
+        log.debug("Discarding out of order event for DN: %s", dn)
+        return True
+
+    cached.update({k: v for k, v in attributes.items() if k not in ("childAction", "status")})
+    log.debug("Patched cached managed object: %s", dn)
+    return True
+
+
+def _parse_mod_ts(mod_ts):
+    """
+    Returns the datetime of an APIC modTs e.g. 2021-06-10T13:25:12.345+00:00
+    """
+    # strptime %z only accepts a +hh:mm offset from Python 3.7
+    return datetime.strptime(mod_ts[:-3] + mod_ts[-2:], "%Y-%m-%dT%H:%M:%S.%f%z")
 
 
 def register_managed_object_callback(dn, action, callback_func):
@@ -180,21 +436,17 @@ def register_managed_object_callback(dn, action, callback_func):
     action:str one of 'created', 'modified', 'deleted' \\
     callback_func:func A function to run when event {action} on given DN is triggered    
     """
-    _dn = dn if dn.startswith("/") else ("/" + dn)
-    for mo in _managed_objects:
-        if mo.dn == _dn:
-            mo.register_callback(action, callback_func)
-            # TODO: should we check there is a valid subscription ID/running
-            return
-    else:
+    mo = _managed_objects.get(dn)
+    if mo is None:
         # A ManagedObject class does not exist for the given dn.
         # 1. We need to create a class instance
         # 2. Register callback function
         # 3. Register a subscription with the APIC
         watch_managed_object(dn)
         mo = get_cached_managed_object(dn)
-        mo.register_callback(action, callback_func)
 
+    # TODO: should we check there is a valid subscription ID/running
+    mo.register_callback(action, callback_func)
     return
 
 
@@ -204,14 +456,14 @@ def subscribe(dn, options=""):
         
     dn: /uni/tn-TEN_K8/...
     """
-    _dn = dn if dn.startswith("/") else ("/" + dn)
+    _dn = normalise_dn(dn)
     dn = "/api/mo{}".format(_dn)
     params = "subscription=yes"
     try:
         data = get(dn, params)
     except REST_Error as e:
         msg = "APIC subscribe request failed due to {}".format(e.content)
-        print(msg)
+        log.error(msg)
         # if e.code == 406:
         #     login()
         #     return
@@ -219,74 +471,480 @@ def subscribe(dn, options=""):
         raise Exception(msg)
 
     else:
-        print(
-            "\tAPIC subscription successful for ID: {} with DN: {}".format(
-                data["subscriptionId"], dn
+        log.debug("APIC subscription successful for ID: %s with DN: %s", data["subscriptionId"], dn)
+
+    return data
+
+
+def _shared_subscription_for(dn):
+    """
+    Returns (key, urlpath, params) of the shared subscription covering the DN
+    in the current subscription mode, or None if the DN needs its own subscription.
+
+    dn:str /uni/tn-TEN_K8/...
+    """
+    if subscription_mode == "dn":
+        return None
+
+    rn = dn.rstrip("/")[len(get_parent_from_dn(dn)) + 1 :]
+    if rn.startswith("instP-"):
+        if subscription_mode == "class":
+            # an EEPG created without the annotation, e.g. by hand, raises no class
+            # event, the subnet callbacks waiting on its creation need a DN subscription
+            return None
+        mo_class, eepg_dn = "l3extInstP", dn
+    elif rn.startswith("extsubnet-"):
+        mo_class, eepg_dn = "l3extSubnet", get_parent_from_dn(dn)
+    else:
+        return None
+
+    if subscription_mode == "subtree":
+        params = "query-target=subtree&target-subtree-class=l3extInstP,l3extSubnet"
+        return eepg_dn, "/api/mo{}".format(eepg_dn), params
+
+    params = 'query-target-filter=wcard({}.annotation,"aci-k8-haystack")'.format(mo_class)
+    return mo_class, "/api/class/{}".format(mo_class), params
+
+
+def subscribe_shared(key, urlpath, params):
+    """
+    Returns (subscription ID, data) of the shared subscription for key, the APIC
+    subscription is only created the first time a key is used, otherwise
+    data is None.
+
+    key:str EEPG DN (subtree mode) or class name (class mode)
+    urlpath:str e.g. /api/class/l3extSubnet
+    params:str the query params, excluding subscription=yes
+    """
+    with _shared_subscriptions_lock:
+        if key in _shared_subscriptions:
+            return _shared_subscriptions[key]["id"], None
+
+        try:
+            data = get(urlpath, "{}&subscription=yes".format(params))
+        except REST_Error as e:
+            msg = "APIC subscribe request failed due to {}".format(e.content)
+            log.error(msg)
+            raise Exception(msg)
+
+        log.info(
+            "APIC shared subscription successful for ID: %s with %s", data["subscriptionId"], key
+        )
+        _shared_subscriptions[key] = {
+            "urlpath": urlpath,
+            "params": params,
+            "id": data["subscriptionId"],
+        }
+        return data["subscriptionId"], data
+
+
+def _release_shared_subscription(dn, sub_id):
+    """
+    Forget the shared subscription covering the unwatched DN, its ID is no
+    longer refreshed and expires on the APIC. The next DN it covers subscribes
+    again.
+
+    sub_id:int The subscription ID unscheduled with its last user
+    """
+    shared = _shared_subscription_for(dn)
+    if shared is None:
+        return
+
+    key = shared[0]
+    with _shared_subscriptions_lock:
+        if key in _shared_subscriptions and _shared_subscriptions[key]["id"] == sub_id:
+            del _shared_subscriptions[key]
+            log.info("Removed APIC shared subscription for %s", key)
+
+
+def _find_mo(imdata, dn):
+    """
+    Returns the MO { 'class-name': { ... } } with the given DN from
+    an APIC imdata list, None if not found.
+    """
+    for item in imdata:
+        for attributes in (v["attributes"] for v in item.values()):
+            if "/" + attributes["dn"].lstrip("/") == dn:
+                return item
+    return None
+
+
+def _get_mo(dn):
+    """
+    Returns the current MO { 'class-name': { ... } } for the DN from the APIC
+    without a subscription, None if it does not exist.
+    """
+    data = get("/api/mo{}".format(dn))
+    return data["imdata"][0] if len(data["imdata"]) > 0 else None
+
+
+class RefreshScheduler:
+    """
+    Timer wheel refreshing every APIC subscription once per refresh interval.
+
+    The wheel has one slot per second of the interval and each subscription ID
+    is placed in the least loaded slot, so refreshes are spread evenly over the
+    interval rather than sent in one burst. Each tick the slot's refreshes are
+    sent concurrently over the pooled APIC session. A subscription not refreshed
+    within its lifetime, or refused by the APIC, is re-subscribed on its own.
+
+    The scheduler stops on stop() or once the interpreter shuts down.
+    """
+
+    def __init__(self, interval, lifetime, workers):
+        """
+        interval:int Seconds between refreshes of a subscription, one slot per second
+        lifetime:int Seconds after the last refresh the APIC expires a subscription
+        workers:int Max concurrent refresh requests
+        """
+        self._slots = [set() for _ in range(interval)]
+        self._lifetime = lifetime
+        self._workers = workers
+        self._pool = None
+        self._stopped = Event()
+        self._cursor = 0
+        self._lock = Lock()
+        # sub_id -> slot index
+        self._slot_of = {}
+        # sub_id -> number of managed objects using the subscription
+        self._users = {}
+        # sub_id -> monotonic time of the last subscribe/refresh
+        self._refreshed = {}
+
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self.refresh_count = 0
+        self.resubscribe_count = 0
+        self.expired_count = 0
+
+    def __len__(self):
+        return len(self._slot_of)
+
+    def track(self, sub_id):
+        """
+        A managed object uses the subscription, the first user schedules it
+        """
+        with self._lock:
+            self._users[sub_id] = self._users.get(sub_id, 0) + 1
+            if sub_id in self._slot_of:
+                return
+            slot = min(range(len(self._slots)), key=lambda i: len(self._slots[i]))
+            self._slots[slot].add(sub_id)
+            self._slot_of[sub_id] = slot
+            self._refreshed[sub_id] = monotonic()
+
+    def untrack(self, sub_id):
+        """
+        A managed object no longer uses the subscription, the subscription is
+        unscheduled with its last user and expires on the APIC
+
+        Returns True if the subscription was unscheduled
+        """
+        with self._lock:
+            users = self._users.get(sub_id, 0) - 1
+            if users > 0:
+                self._users[sub_id] = users
+                return False
+            self._unschedule(sub_id)
+            return True
+
+    def replace(self, old_id, new_id):
+        """
+        The subscription was re-subscribed under a new ID, keeps the old slot
+        """
+        with self._lock:
+            slot = self._slot_of.get(old_id)
+            users = self._users.get(old_id, 0)
+            self._unschedule(old_id)
+            if slot is None:
+                return
+            self._users[new_id] = self._users.get(new_id, 0) + users
+            if new_id not in self._slot_of:
+                self._slots[slot].add(new_id)
+                self._slot_of[new_id] = slot
+            self._refreshed[new_id] = monotonic()
+
+    def _unschedule(self, sub_id):
+        slot = self._slot_of.pop(sub_id, None)
+        if slot is not None:
+            self._slots[slot].discard(sub_id)
+        self._users.pop(sub_id, None)
+        self._refreshed.pop(sub_id, None)
+
+    def run(self):
+        """
+        Ticks once a second, ticks missed by a late wakeup are caught up.
+        Returns once stopped.
+        """
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self._workers)
+        next_tick = monotonic() + 1
+        while not self._stopped.wait(max(0.0, next_tick - monotonic())):
+            now = monotonic()
+            self.lag = now - next_tick
+            self.max_lag = max(self.max_lag, self.lag)
+            try:
+                while next_tick <= now:
+                    self._tick(now)
+                    next_tick += 1
+            except RuntimeError as e:
+                # the pool refuses new refreshes once the interpreter shuts down
+                log.info("APIC subscription refresh stopped: %s", str(e))
+                self.stop()
+
+    def stop(self):
+        """
+        Stop the ticks, refreshes already running are not waited for
+        """
+        self._stopped.set()
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+
+    @property
+    def stopped(self):
+        return self._stopped.is_set()
+
+    def _tick(self, now):
+        with self._lock:
+            sub_ids = list(self._slots[self._cursor])
+            self._cursor = (self._cursor + 1) % len(self._slots)
+        for sub_id in sub_ids:
+            self._pool.submit(self._refresh, sub_id, now)
+
+    def _refresh(self, sub_id, now):
+        try:
+            refreshed = self._refreshed.get(sub_id)
+            if refreshed is None:
+                # unscheduled since the tick
+                return
+            if now - refreshed > self._lifetime:
+                log.warning("APIC subscription ID: %s expired, re-subscribing", sub_id)
+                self.expired_count += 1
+                self._resubscribe(sub_id)
+                return
+
+            try:
+                get("api/subscriptionRefresh", "id={}".format(sub_id))
+            except REST_Error as e:
+                if e.code == 400:
+                    # Subscription refresh timeout
+                    self._resubscribe(sub_id)
+                    return
+                log.error(
+                    "APIC subscription refresh failed for ID: %s due to %s - %s",
+                    sub_id,
+                    e.code,
+                    e.content,
+                )
+                return
+
+            self.refresh_count += 1
+            with self._lock:
+                if sub_id in self._refreshed:
+                    self._refreshed[sub_id] = monotonic()
+        except Exception as e:
+            log.exception("Unhandled error refreshing APIC subscription ID %s: %s", sub_id, str(e))
+
+    def _resubscribe(self, sub_id):
+        self.resubscribe_count += 1
+        new_id = resubscribe(sub_id)
+        if new_id is None:
+            with self._lock:
+                self._unschedule(sub_id)
+
+    def oldest_refresh(self):
+        """
+        Returns the seconds since the least recently refreshed subscription was refreshed
+        """
+        with self._lock:
+            oldest = min(self._refreshed.values(), default=None)
+        return monotonic() - oldest if oldest is not None else 0.0
+
+    def stats(self):
+        """
+        Returns a stats string, subscriptions, slot spread and refresh lag
+        """
+        with self._lock:
+            loads = [len(slot) for slot in self._slots]
+        return (
+            "Subscriptions: {} Slot load: min {} max {} Refreshed: {} Expired: {} "
+            "Re-subscribed: {} Lag: {:.3f}s Max lag: {:.3f}s".format(
+                len(self._slot_of),
+                min(loads),
+                max(loads),
+                self.refresh_count,
+                self.expired_count,
+                self.resubscribe_count,
+                self.lag,
+                self.max_lag,
             )
         )
 
-    return data
+
+_refresh_scheduler = RefreshScheduler(
+    subscription_refresh_interval, subscription_refresh_time, pool_size
+)
+
+Gauge(
+    "aci_sync_managed_objects",
+    "APIC managed objects cached",
+    func=lambda: len(_managed_objects),
+)
+Gauge(
+    "aci_sync_apic_subscriptions",
+    "APIC subscriptions scheduled for refresh",
+    func=lambda: len(_refresh_scheduler),
+)
+Gauge(
+    "aci_sync_subscription_refresh_lag_seconds",
+    "Seconds the last subscription refresh tick ran late",
+    func=lambda: _refresh_scheduler.lag,
+)
+Gauge(
+    "aci_sync_subscription_refresh_age_seconds",
+    "Seconds since the least recently refreshed subscription was refreshed",
+    func=_refresh_scheduler.oldest_refresh,
+)
 
 
 def refresh_subscriptions():
     """
-    Dedicated Thread (from login())
+    Dedicated Thread (from login()), returns once the scheduler is stopped
     """
-    while True:
+    while not _refresh_scheduler.stopped:
         try:
-            sleep(30)
-            for mo in _managed_objects:
-                dn = "api/subscriptionRefresh"
-                params = "id={}".format(mo.subscription_id)
-                try:
-                    data = get(dn, params)
-                except REST_Error as e:
-                    if e.code == 400:
-                        # Subscription refresh timeout
-                        renew_subscriptions()
-                        continue
-                    print(
-                        "APIC subscription refresh failed for ID: {} : {} due to {} - {}".format(
-                            mo.subscription_id, mo.dn, e.code, e.content
-                        )
-                    )
-                    continue
-                # else:
-                #     print(
-                #         "APIC subscription refresh successful for ID: {} : DN: {}".format(
-                #             mo.subscription_id, mo.dn
-                #         )
-                #     )
+            _refresh_scheduler.run()
         except Exception as e:
-            # dedicated thread so ensure we send any unhandled
-            # errors to stdout
-            print("Unhandled error in refresh_subscriptions thread: {}".format(str(e)))
-            print(traceback.format_exc())
+            # dedicated thread so ensure we log any unhandled errors
+            log.exception("Unhandled error in refresh_subscriptions thread: %s", str(e))
+            sleep(1)
 
 
-def renew_subscriptions():
+def resubscribe(sub_id):
     """
-    Called by refresh_subscriptions only after a 400 returned
+    Re-subscribe a single expired subscription ID, the managed objects using
+    it are moved to the new subscription ID.
+
+    Returns the new subscription ID, None if no managed object uses the ID
+    """
+    for key, shared in list(_shared_subscriptions.items()):
+        if shared["id"] == sub_id:
+            data = get(shared["urlpath"], "{}&subscription=yes".format(shared["params"]))
+            with _shared_subscriptions_lock:
+                shared["id"] = data["subscriptionId"]
+            break
+    else:
+        mos = [mo for mo in _managed_objects.values() if mo.subscription_id == sub_id]
+        if not mos:
+            return None
+        key = mos[0].dn
+        data = subscribe(key)
+
+    new_id = data["subscriptionId"]
+    for mo in _managed_objects.values():
+        if mo.subscription_id == sub_id:
+            mo.subscription_id = new_id
+    _refresh_scheduler.replace(sub_id, new_id)
+    log.info("APIC re-subscribed ID: %s as ID: %s for %s", sub_id, new_id, key)
+    return new_id
+
+
+def renew_subscriptions():
     """
-    for mo in _managed_objects:
+    Re-subscribes every subscription, e.g. after the APIC websocket was reopened,
+    the subscribe requests run concurrently over the pooled APIC session.
 
-        dn = "api/mo/{}".format(mo.dn)
-        params = "subscription=yes"
+    Each subscribe response holds the current MO config, it is compared with the
+    cached MOs of the subscription to catch the changes missed whilst unsubscribed.
 
+    Returns:list - APIC events synthesized for the missed changes
+    """
+    users = {}
+    for mo in _managed_objects.values():
+        users.setdefault(mo.subscription_id, []).append(mo)
+
+    renewals = []
+    for key, shared in list(_shared_subscriptions.items()):
+        renewals.append((shared["id"], key, shared["urlpath"], shared["params"], shared))
+    shared_ids = {request[0] for request in renewals}
+    for sub_id, mos in users.items():
+        if sub_id not in shared_ids:
+            renewals.append((sub_id, mos[0].dn, "/api/mo{}".format(mos[0].dn), "", None))
+
+    def _renew(request):
+        sub_id, key, urlpath, params, shared = request
+        params = "{}&subscription=yes".format(params) if params else "subscription=yes"
         try:
-            data = get(dn, params)
+            return request, get(urlpath, params)
         except Exception as e:
-            print("Renewal of APIC subscription {} failed".format(mo.dn))
-        else:
-            # TODO: Lock Required
-            mo.subscription_id = data["subscriptionId"]
-            print(
-                "APIC subscription renewal successful for ID: {} with DN: {}".format(
-                    mo.subscription_id, mo.dn
-                )
-            )
+            log.error("Renewal of APIC subscription %s failed: %s", key, str(e))
+            return request, None
+
+    events = []
+    with ThreadPoolExecutor(max_workers=pool_size) as pool:
+        for request, data in pool.map(_renew, renewals):
+            sub_id, key, urlpath, params, shared = request
+            if data is None:
+                continue
+            new_id = data["subscriptionId"]
+            if shared is not None:
+                with _shared_subscriptions_lock:
+                    shared["id"] = new_id
+            _refresh_scheduler.replace(sub_id, new_id)
+            for mo in users.get(sub_id, []):
+                mo.subscription_id = new_id
+            events.extend(_missed_events(new_id, users.get(sub_id, []), data["imdata"]))
+
+    log.info(
+        "APIC renewed %s subscriptions, %s changes missed whilst unsubscribed",
+        len(renewals),
+        len(events),
+    )
+    return events
+
+
+def _missed_events(sub_id, mos, imdata):
+    """
+    Returns APIC events for the differences between the cached ManagedObject's
+    and their current config in imdata, as the APIC would have sent them.
+    """
+    current = {}
+    for item in imdata:
+        for attributes in (v["attributes"] for v in item.values()):
+            current[normalise_dn(attributes["dn"])] = item
 
-    return
+    events = []
+    for mo in mos:
+        item = current.get(mo.dn)
+        if item is None and mo.mo is None:
+            continue
+
+        if item is None:
+            mo_class = next(iter(mo.mo))
+            attributes = dict(mo.mo[mo_class]["attributes"], status="deleted")
+
+        elif mo.mo is None:
+            mo_class = next(iter(item))
+            attributes = dict(item[mo_class]["attributes"], status="created")
+
+        else:
+            # modified events only carry the changed attributes
+            mo_class = next(iter(item))
+            cached = mo.mo[mo_class]["attributes"]
+            fresh = item[mo_class]["attributes"]
+            attributes = {
+                k: fresh[k]
+                for k, v in cached.items()
+                if k not in ("childAction", "modTs", "status") and k in fresh and fresh[k] != v
+            }
+            if not attributes:
+                continue
+            attributes.update(dn=fresh["dn"], status="modified")
+            if "modTs" in fresh:
+                attributes["modTs"] = fresh["modTs"]
+
+        events.append({"subscriptionId": [sub_id], "imdata": [{mo_class: {"attributes": attributes}}]})
+    return events
 
 
 def print_subscriptions():
@@ -297,8 +955,9 @@ def print_subscriptions():
         try:
             sleep(15)
             print("Subscription List")
+            print(_refresh_scheduler.stats())
             print("=" * 190)
-            for mo in _managed_objects:
+            for mo in _managed_objects.values():
                 if mo.has_subscription():
                     print(
                         "Sub ID: {:<8} DN: {:<100} MO: {:<8} Callback Count: Created:{} Modified:{} Deleted:{}".format(
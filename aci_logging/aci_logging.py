@@ -0,0 +1,122 @@
+"""
+Structured logging for aci-sync.
+
+Records are put on a bounded queue by the calling thread and written to
+stdout by a background listener thread, so an event handler never blocks on
+stdout. When the queue is full a record is dropped and counted rather than
+slowing the handlers.
+
+ACI_SYNC_LOG_FORMAT=json writes one JSON object per record with the fields
+passed in `extra` and, for a traced event, its trace and span IDs.
+"""
+import os
+import sys
+import json
+import atexit
+import logging
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from queue import Queue, Full
+from metrics.prometheus import Gauge
+from tracing.tracing import current_context
+
+# DEBUG adds the per event details, e.g. every attribute of an APIC event
+log_level = os.environ.get("ACI_SYNC_LOG_LEVEL", "INFO").upper()
+# text or json
+log_format = os.environ.get("ACI_SYNC_LOG_FORMAT", "text")
+assert log_format in ["text", "json"]
+# Max records waiting to be written, further records are dropped
+log_queue_size = int(os.environ.get("ACI_SYNC_LOG_QUEUE_SIZE", "10000"))
+
+# The LogRecord attributes, anything else was passed in `extra`
+_record_attributes = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {
+    "message",
+    "asctime",
+}
+
+
+class _NonBlockingQueueHandler(QueueHandler):
+    """
+    Queues records without waiting, counts the records dropped on a full queue
+    """
+
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+    def prepare(self, record):
+        # tag the record with the trace of the calling thread before it changes thread
+        context = current_context()
+        if context is not None:
+            record.trace_id, record.span_id = context
+        return super().prepare(record)
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    One JSON object per record, the `extra` fields at the top level
+    """
+
+    def format(self, record):
+        data = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _record_attributes:
+                data[key] = value
+        return json.dumps(data, default=str)
+
+
+def get_logger(name):
+    """
+    Returns the aci-sync logger for a module, e.g. get_logger(__name__)
+    """
+    return logging.getLogger("aci-sync.{}".format(name))
+
+
+def _configure():
+    """
+    Route the aci-sync loggers through the queue to stdout
+    """
+    handler = logging.StreamHandler(sys.stdout)
+    if log_format == "json":
+        handler.setFormatter(JSONFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)-7s %(message)s"))
+
+    queue = Queue(maxsize=log_queue_size)
+    queue_handler = _NonBlockingQueueHandler(queue)
+    listener = QueueListener(queue, handler)
+    listener.start()
+    # written out on exit
+    atexit.register(listener.stop)
+
+    logger = logging.getLogger("aci-sync")
+    logger.setLevel(log_level)
+    logger.addHandler(queue_handler)
+    logger.propagate = False
+    return queue_handler
+
+
+_queue_handler = _configure()
+
+Gauge(
+    "aci_sync_log_records_dropped",
+    "Log records dropped on a full log queue",
+    func=lambda: _queue_handler.dropped,
+)
+Gauge(
+    "aci_sync_log_queue_depth",
+    "Log records waiting to be written",
+    func=lambda: _queue_handler.queue.qsize(),
+)
@@ -1,22 +1,99 @@
 """
 .
 """
-import traceback
-from aci_helpers.aci_object import get_cached_managed_object, ManagedObject
+from collections import OrderedDict
+from logging import DEBUG
+from aci_helpers.aci_object import get_cached_managed_object, ManagedObject, normalise_dn
+from capture.event_capture import capture_apic_event
+from metrics.prometheus import Counter, Histogram
+from tracing import tracing
+from aci_logging.aci_logging import get_logger
 from .class_handler_eepg import class_handler_eepg
 from .class_handler_eepg_subnet import class_handler_eepg_subnet
 
+log = get_logger(__name__)
+
 class_event_handlers = {
     "l3extInstP": class_handler_eepg,
     "l3extSubnet": class_handler_eepg_subnet,
 }
 
+# Batched events are handled parent class first, an EEPG before its subnets
+class_order = ["l3extInstP", "l3extSubnet"]
+
+apic_events_total = Counter(
+    "aci_sync_apic_events_total", "APIC MO events received by class and status", ("class", "status")
+)
+apic_handler_seconds = Histogram(
+    "aci_sync_apic_handler_seconds", "APIC MO class handler duration by handler", ("handler",)
+)
+
 
 def process_apic_event(event):
     """
-    Process a recieved APIC subscription event.
+    Process a recieved APIC subscription event, every MO in imdata.
     event: full APIC payload sent in event as dict/json
     """
+    process_apic_events([event])
+
+
+@tracing.traced
+def process_apic_events(events):
+    """
+    Process a batch of recieved APIC subscription events.
+
+    The MOs of all the events are merged per DN so the handlers run once per DN
+    with the latest state, l3extInstP MOs are handled before l3extSubnet MOs.
+
+    events:list full APIC payloads sent in events as dict/json
+    """
+    for event in events:
+        capture_apic_event(event)
+        for mo in event["imdata"]:
+            mo_class = list(mo.keys())[0]
+            apic_events_total.inc(mo_class, mo[mo_class]["attributes"].get("status"))
+    for event in merge_apic_events(events):
+        _process_mo_event(event)
+
+
+def merge_apic_events(events):
+    """
+    Returns single MO APIC events, one per DN, merging every MO of the events
+    in order. Attributes are merged, a 'created' MO stays 'created' when later
+    modified, otherwise the latest status wins.
+    """
+    merged = OrderedDict()
+    for event in events:
+        for mo in event["imdata"]:
+            mo_class = list(mo.keys())[0]
+            attributes = mo[mo_class]["attributes"]
+            dn = normalise_dn(attributes["dn"])
+
+            last = merged.get(dn)
+            if last is None or attributes.get("status") != "modified":
+                merged[dn] = (mo_class, dict(attributes), event.get("subscriptionId"))
+                continue
+
+            last_attributes = last[1]
+            status = last_attributes.get("status")
+            last_attributes.update(attributes)
+            if status == "created":
+                last_attributes["status"] = status
+
+    ordered = sorted(
+        merged.values(),
+        key=lambda m: class_order.index(m[0]) if m[0] in class_order else len(class_order),
+    )
+    return [
+        {"subscriptionId": sub_ids, "imdata": [{mo_class: {"attributes": attributes}}]}
+        for mo_class, attributes, sub_ids in ordered
+    ]
+
+
+def _process_mo_event(event):
+    """
+    Process a single MO APIC event
+    """
     print_event(event)
 
     # Standard default MO class handler for all event types
@@ -40,13 +117,14 @@ def _run_class_handler(event):
     try:
         class_handler_f = class_event_handlers[mo_class]
     except KeyError as e:
-        print("Received an event for mo class {}, but no handler found.".format(mo_class))
+        log.warning("Received an event for mo class %s, but no handler found.", mo_class)
     else:
         try:
-            class_handler_f(event)
+            with apic_handler_seconds.time(class_handler_f.__name__):
+                with tracing.span(class_handler_f.__name__):
+                    class_handler_f(event)
         except Exception as e:
-            print("Unhandled error occured in APIC MO event handlers")
-            print(traceback.format_exc())
+            log.exception("Unhandled error occured in APIC MO event handlers")
     return
 
 
@@ -69,17 +147,18 @@ def _run_class_callbacks(event):
     try:
         if cached_mo is not None:
             cached_mo.run_callbacks(action)
-            print("**** PROBLEM ***** apic_events:72")
+            log.debug("**** PROBLEM ***** apic_events:72")
             # PROBLEM: What do we do with the cached (e.g. parent) MO/Subscription after all this
             # has been run - need to cleanup ?
 
     except Exception as e:
-        msg = (
+        log.exception(
             "An error occurred during an attempt to run callbacks for an APIC event. "
-            "The event is {} for DN: {} with error {}".format(action, dn, str(e))
+            "The event is %s for DN: %s with error %s",
+            action,
+            dn,
+            str(e),
         )
-        print(msg)
-        print(traceback.format_exc())
     return
 
 
@@ -89,8 +168,15 @@ def print_event(event):
     action = event["imdata"][0][moclass]["attributes"]["status"]
     dn = event["imdata"][0][moclass]["attributes"]["dn"]
 
-    # print(event)
-    print("APIC Object {} has been {}. DN:{} Attributes:".format(moclass, action, dn))
-    for k, v in event["imdata"][0][moclass]["attributes"].items():
-        # if k not in ignore_attributes:
-        print("\t{} = {}".format(k, v))
+    log.info(
+        "APIC Object %s has been %s. DN:%s",
+        moclass,
+        action,
+        dn,
+        extra={"mo_class": moclass, "status": action, "dn": dn},
+    )
+    # the attribute dump is per event, only built at debug level
+    if log.isEnabledFor(DEBUG):
+        for k, v in event["imdata"][0][moclass]["attributes"].items():
+            # if k not in ignore_attributes:
+            log.debug("\t%s = %s", k, v)
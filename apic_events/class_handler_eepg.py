@@ -1,8 +1,13 @@
 """
 """
 import json
+from logging import DEBUG
 from aci_helpers.aci_object import get_cached_managed_object, update_cached_managed_object
+from aci_helpers.aci_object import patch_cached_managed_object
 from aci_apic.aci_apic import REST_Error, post, get
+from aci_logging.aci_logging import get_logger
+
+log = get_logger(__name__)
 
 ignore_attributes = [
     "configIssues",
@@ -37,7 +42,7 @@ def class_handler_eepg(event):
         - modified
         - deleted
     """
-    print("Class Handler: l3extInstP")
+    log.debug("Class Handler: l3extInstP")
 
     event_mo = event["imdata"][0]
 
@@ -69,7 +74,7 @@ def _created(event_mo, cached_mo):
     Creation event, must mean that it did not exist whilst we had subs on it,
     may have been deleted manually, then recreated manually or by code
     """
-    print("\nCreated event")
+    log.debug("l3extInstP created event")
     # if the object is in the cache then we can ignore this, likely
     # from a re-creation of the object, but we will update the cache mo
     dn = cached_mo["l3extInstP"]["attributes"]["dn"]
@@ -93,11 +98,11 @@ def _modified(event_mo, cached_mo):
 
      - update cache with new
     """
-    print("\nModified event")
+    log.debug("l3extInstP modified event")
     event_attributes = event_mo["l3extInstP"]["attributes"]
     cached_attributes = cached_mo["l3extInstP"]["attributes"]
 
-    print(event_attributes)
+    log.debug("l3extInstP modified attributes: %s", event_attributes)
 
     annotation_modified = (
         "annotation" in event_attributes
@@ -105,15 +110,15 @@ def _modified(event_mo, cached_mo):
     )
 
     if not (annotation_modified):
-        print("No significant change, updating cache with event object")
+        log.debug("No significant change, updating cache with event object")
         dn = cached_attributes["dn"]
+        if patch_cached_managed_object(dn, "l3extInstP", event_attributes):
+            return
         try:
             data = get("/api/mo/" + dn)
         except REST_Error as e:
-            print(
-                (
-                    "Error attempting to get updated MO for DN {} for cache, " "cache not updated"
-                ).format(dn)
+            log.warning(
+                "Error attempting to get updated MO for DN %s for cache, cache not updated", dn
             )
         else:
             update_cached_managed_object(dn, data["imdata"][0])
@@ -143,7 +148,8 @@ def _modified(event_mo, cached_mo):
 
     # post returns full subtree and we only want the parent class data
     class_data = {"l3extInstP": data["imdata"][0]["l3extInstP"]}
-    print(json.dumps(class_data, indent=1))
+    if log.isEnabledFor(DEBUG):
+        log.debug(json.dumps(class_data, indent=1))
     update_cached_managed_object(dn, class_data)
     return
 
@@ -159,7 +165,7 @@ def _deleted(event_mo, cached_mo):
     - check object cache, if exists and we manage, recreate it.
     - update cache with new
     """
-    print("\nDeleted event")
+    log.debug("l3extInstP deleted event")
     # validate this is a managed object - we kinda now it is anyway as
     # its in the mo cache, but for now just check the annotation of the object
     # but dont act upon absence.
@@ -167,11 +173,13 @@ def _deleted(event_mo, cached_mo):
     cached_attributes = cached_mo["l3extInstP"]["attributes"]
 
     if "aci-k8-haystack" not in cached_attributes["annotation"]:
-        print("Haystack annotation NOT found in cached object {}".format(cached_attributes["dn"]))
+        log.error("Haystack annotation NOT found in cached object %s", cached_attributes["dn"])
         # TODO: remove subscription ? / maybe entire if statement can be removed.
         raise Exception("is even this a valid situation ?")
 
-    print("Haystack annotation found in cached object {}".format(cached_attributes["dn"]))
+    log.info(
+        "Haystack annotation found in deleted object %s, reinstating", cached_attributes["dn"]
+    )
 
     # At this point we should be convinced the object should be reinstated.
     # Reinstate as base default configuration
@@ -1,8 +1,13 @@
 """
 """
 import json
+from logging import DEBUG
 from aci_helpers.aci_object import get_cached_managed_object, update_cached_managed_object
+from aci_helpers.aci_object import patch_cached_managed_object
 from aci_apic.aci_apic import REST_Error, post, get
+from aci_logging.aci_logging import get_logger
+
+log = get_logger(__name__)
 
 ignore_attributes = ["childAction", "dn", "modTs", "rn", "status"]
 
@@ -18,7 +23,7 @@ def class_handler_eepg_subnet(event):
         - modified
         - deleted
     """
-    print("Class Handler: l3extSubnet")
+    log.debug("Class Handler: l3extSubnet")
 
     event_mo = event["imdata"][0]
 
@@ -50,7 +55,7 @@ def _created(event_mo, cached_mo):
     Creation event, must mean that it did not exist whilst we had subs on it,
     may have been deleted manually, then recreated manually or by code
     """
-    print("\nCreated event")
+    log.debug("l3extSubnet created event")
     # if the object is in the cache then we can ignore this, likely
     # from a re-creation of the object, but we will update the cache mo
     dn = cached_mo["l3extSubnet"]["attributes"]["dn"]
@@ -81,11 +86,11 @@ def _modified(event_mo, cached_mo):
 
      - update cache with new
     """
-    print("\nModified event")
+    log.debug("l3extSubnet modified event")
     event_attributes = event_mo["l3extSubnet"]["attributes"]
     cached_attributes = cached_mo["l3extSubnet"]["attributes"]
 
-    print(event_attributes)
+    log.debug("l3extSubnet modified attributes: %s", event_attributes)
 
     name_modified = "name" in event_attributes
     scope_modified = (
@@ -96,19 +101,23 @@ def _modified(event_mo, cached_mo):
         and "orchestrator:aci-k8-haystack" not in event_attributes["annotation"]
     )
 
-    print(scope_modified, name_modified, annotation_modified)
-    print(not (scope_modified or name_modified or annotation_modified))
+    log.debug(
+        "scope modified: %s name modified: %s annotation modified: %s",
+        scope_modified,
+        name_modified,
+        annotation_modified,
+    )
 
     if not (scope_modified or name_modified or annotation_modified):
-        print("No significant change, updating cache with event object")
+        log.debug("No significant change, updating cache with event object")
         dn = cached_attributes["dn"]
+        if patch_cached_managed_object(dn, "l3extSubnet", event_attributes):
+            return
         try:
             data = get("/api/mo/" + dn)
         except REST_Error as e:
-            print(
-                (
-                    "Error attempting to get updated MO for DN {} for cache, " "cache not updated"
-                ).format(dn)
+            log.warning(
+                "Error attempting to get updated MO for DN %s for cache, cache not updated", dn
             )
         else:
             update_cached_managed_object(dn, data["imdata"][0])
@@ -148,7 +157,8 @@ def _modified(event_mo, cached_mo):
     except REST_Error as e:
         raise
 
-    print(json.dumps(data, indent=1))
+    if log.isEnabledFor(DEBUG):
+        log.debug(json.dumps(data, indent=1))
     update_cached_managed_object(dn, data["imdata"][0])
 
     return
@@ -165,7 +175,7 @@ def _deleted(event_mo, cached_mo):
     - check object cache, if exists and we manage, recreate it.
     - update cache with new
     """
-    print("\nDeleted event")
+    log.debug("l3extSubnet deleted event")
     # validate this is a managed object - we kinda now it is anyway as
     # its in the mo cache, but for now just check the annotation of the object
     # but dont act upon absence.
@@ -173,11 +183,13 @@ def _deleted(event_mo, cached_mo):
     cached_attributes = cached_mo["l3extSubnet"]["attributes"]
 
     if "aci-k8-haystack" not in cached_attributes["annotation"]:
-        print("Haystack annotation NOT found in cached object {}".format(cached_attributes["dn"]))
+        log.error("Haystack annotation NOT found in cached object %s", cached_attributes["dn"])
         # TODO: remove subscription ? / maybe entire if statement can be removed.
         raise Exception("is even this a valid situation ?")
 
-    print("Haystack annotation found in cached object {}".format(cached_attributes["dn"]))
+    log.info(
+        "Haystack annotation found in deleted object %s, reinstating", cached_attributes["dn"]
+    )
 
     # At this point we should be convinced the object should be reinstated.
     # Reinstate as base default configuration
@@ -0,0 +1,116 @@
+"""
+Capture of the K8 and APIC events handled by aci-sync, for offline replay
+with capture/event_replay.py.
+
+With ACI_SYNC_CAPTURE set every event is appended to that file as one JSON
+line, gzip compressed when the file name ends in .gz. The records are
+written by a background thread so the handlers never wait on the disk.
+
+Record sources:
+    K8     a watch event entering process_k8_event
+    SYNC   an object listed by the initial K8 sync
+    OWNER  a ReplicaSet/Deployment event applied to the owner index
+    APIC   a websocket event entering process_apic_events
+"""
+import os
+import gzip
+import json
+import atexit
+import traceback
+from queue import Queue
+from threading import Thread, Lock
+from time import time
+
+capture_path = os.environ.get("ACI_SYNC_CAPTURE", "")
+
+_queue = Queue()
+_writer = None
+_writer_lock = Lock()
+_api_client = None
+
+
+def capture_k8_event(source, event):
+    """
+    Capture a K8 event, the object is serialized as the K8 API JSON
+
+    source:str One of K8, SYNC, OWNER
+    event:dict { 'type': str, 'object': V1Pod/V1Service/V1Deployment/V1ReplicaSet }
+    """
+    if not capture_path:
+        return
+    global _api_client
+    if _api_client is None:
+        from kubernetes import client
+
+        _api_client = client.ApiClient()
+
+    obj = event["object"]
+    _put(
+        {
+            "t": time(),
+            "src": source,
+            "type": event["type"],
+            "kind": obj.kind,
+            "object": _api_client.sanitize_for_serialization(obj),
+        }
+    )
+
+
+def capture_apic_event(event):
+    """
+    Capture an APIC websocket event
+    """
+    if not capture_path:
+        return
+    # not the root span of a traced event
+    event = {k: v for k, v in event.items() if k != "trace"}
+    _put({"t": time(), "src": "APIC", "event": event})
+
+
+def read_capture(path):
+    """
+    Yields the records of a capture file
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def _put(record):
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = Thread(target=_write, name="event-capture", daemon=True)
+                _writer.start()
+                atexit.register(_close)
+                print("Capturing events to {}".format(capture_path))
+    _queue.put(record)
+
+
+def _write():
+    """
+    Dedicated Thread, appends the queued records to the capture file
+    """
+    opener = gzip.open if capture_path.endswith(".gz") else open
+    try:
+        with opener(capture_path, "at") as f:
+            while True:
+                record = _queue.get()
+                if record is None:
+                    return
+                f.write(json.dumps(record, separators=(",", ":")) + "\n")
+                if _queue.empty():
+                    f.flush()
+    except Exception as e:
+        # dedicated thread so ensure we send any unhandled
+        # errors to stdout
+        print("Unhandled error in event capture thread: {}".format(str(e)))
+        print(traceback.format_exc())
+
+
+def _close():
+    _queue.put(None)
+    _writer.join(timeout=10)
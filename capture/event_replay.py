@@ -0,0 +1,203 @@
+#!/usr/local/bin/python3.9
+"""
+Replay a capture (ACI_SYNC_CAPTURE) through the aci-sync event handlers
+against the APIC simulator and the fake K8 API server.
+
+The records are replayed in order at 1x, Nx or max speed, each through the
+handler it was captured from. Reports the throughput, the per handler latency
+percentiles and the number of APIC and K8 API calls.
+
+Usage:
+    python3 capture/event_replay.py capture.jsonl.gz --speed max
+"""
+import argparse
+import contextlib
+import json
+import os
+import sys
+import tempfile
+from time import sleep, monotonic
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [repo_root, os.path.join(repo_root, "simulators")]
+
+from apic_simulator import APICSimulator
+from k8_simulator import K8Simulator
+from benchmark import percentile
+from capture import event_capture
+from capture.event_capture import read_capture
+
+# The order sync_all() hands the listed objects to the handlers
+sync_order = ["Deployment", "Pod", "Service"]
+
+
+class _Response:
+    """
+    A K8 API response for ApiClient.deserialize
+    """
+
+    def __init__(self, data):
+        self.data = json.dumps(data)
+
+
+def load(path):
+    """
+    Returns the capture records, each contiguous run of SYNC records in sync_all() order
+    """
+    records = []
+    run = []
+    for record in read_capture(path):
+        if record["src"] == "SYNC":
+            run.append(record)
+            continue
+        if run:
+            records.extend(sorted(run, key=lambda r: sync_order.index(r["kind"])))
+            run = []
+        records.append(record)
+    records.extend(sorted(run, key=lambda r: sync_order.index(r["kind"])))
+    return records
+
+
+def seed_apic(apic, records):
+    """
+    Create the tenants and l3outs named by the captured deployment annotations
+    """
+    seeded = set()
+    for record in records:
+        if record.get("kind") != "Deployment":
+            continue
+        annotations = record["object"]["metadata"].get("annotations") or {}
+        try:
+            l3o = json.loads(annotations["aci.haystacknetworks.com/l3o"])
+            key = (l3o["tenant"], l3o["l3out"])
+        except (KeyError, ValueError):
+            continue
+        if key not in seeded:
+            apic.seed(*key)
+            seeded.add(key)
+    return seeded
+
+
+def replay(records, speed):
+    """
+    Replay the records through the handlers
+
+    speed:float Multiple of the captured rate, 0 for as fast as possible
+    Returns (elapsed seconds, { handler: [seconds, ...] })
+    """
+    from kubernetes import client
+    from k8_events.k8_events import process_k8_event
+    from k8_events.k8_events_helpers import subnet_batch
+    from k8_helpers.k8_owners import apply_replicaset_event, apply_deployment_event
+    from apic_events.apic_events import process_apic_events
+
+    api_client = client.ApiClient()
+    owner_funcs = {"ReplicaSet": apply_replicaset_event, "Deployment": apply_deployment_event}
+    timings = {}
+    start = monotonic()
+    first = records[0]["t"] if records else 0
+
+    for record in records:
+        if speed:
+            delay = start + (record["t"] - first) / speed - monotonic()
+            if delay > 0:
+                sleep(delay)
+
+        if record["src"] == "APIC":
+            event = record["event"]
+            mo = event["imdata"][0]
+            mo_class = next(iter(mo))
+            handler = "APIC {} {}".format(mo_class, mo[mo_class]["attributes"].get("status"))
+            func, args = process_apic_events, [event]
+        else:
+            obj = api_client.deserialize(_Response(record["object"]), "V1" + record["kind"])
+            obj.kind = record["kind"]
+            event = {"type": record["type"], "object": obj}
+            handler = "{} {} {}".format(record["src"], record["kind"], record["type"])
+            if record["src"] == "OWNER":
+                func, args = owner_funcs[record["kind"]], event
+            else:
+                func, args = process_k8_event, event
+
+        handled = monotonic()
+        with subnet_batch():
+            func(args)
+        timings.setdefault(handler, []).append(monotonic() - handled)
+
+    return monotonic() - start, timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay an aci-sync event capture")
+    parser.add_argument("capture", help="ACI_SYNC_CAPTURE file, .gz for gzip")
+    parser.add_argument(
+        "--speed", default="max", help="1 for the captured rate, N for N times faster, max"
+    )
+    parser.add_argument("--apic-latency", type=float, default=0.0)
+    parser.add_argument("--verbose", action="store_true", help="show the aci-sync output")
+    args = parser.parse_args()
+    speed = 0.0 if args.speed == "max" else float(args.speed)
+
+    records = load(args.capture)
+    apic = APICSimulator(port=0, latency=args.apic_latency).start()
+    print("Seeded tenant/l3outs: {}".format(sorted(seed_apic(apic, records))))
+    # handler calls that miss the owner index find an empty cluster
+    k8 = K8Simulator(port=0).start()
+    kubeconfig = k8.write_kubeconfig(os.path.join(tempfile.mkdtemp(), "kubeconfig"))
+
+    # aci_apic reads its environment at import
+    os.environ.update(
+        ACI_APIC=apic.address,
+        ACI_APIC_SCHEME="http",
+        ACI_USERNAME=os.environ.get("ACI_USERNAME", "replay"),
+        ACI_PASSWORD=os.environ.get("ACI_PASSWORD", "replay"),
+    )
+    # event_capture read ACI_SYNC_CAPTURE at import, with it set the replayed
+    # events would be appended to the capture being replayed
+    event_capture.capture_path = ""
+    if not args.verbose:
+        # the handler logging is written by its own thread, not muted by redirect_stdout
+        os.environ["ACI_SYNC_LOG_LEVEL"] = "WARNING"
+    from kubernetes import config as k8_config
+    from aci_apic.aci_apic import login as apic_login
+
+    k8_config.load_kube_config(config_file=kubeconfig)
+    output = sys.stdout if args.verbose else open(os.devnull, "w")
+    with contextlib.redirect_stdout(output):
+        apic_login()
+        elapsed, timings = replay(records, speed)
+
+    print(
+        "Replayed {} events in {:.3f}s, {:.1f} events/s (speed {})".format(
+            len(records), elapsed, len(records) / elapsed if elapsed else 0.0, args.speed
+        )
+    )
+    print(
+        "{:<40} {:>8} {:>10} {:>10} {:>10} {:>10}".format(
+            "Handler", "count", "p50", "p90", "p99", "max"
+        )
+    )
+    for handler, values in sorted(timings.items()):
+        values.sort()
+        print(
+            "{:<40} {:>8} {:>9.2f}ms {:>9.2f}ms {:>9.2f}ms {:>9.2f}ms".format(
+                handler,
+                len(values),
+                percentile(values, 50) * 1000,
+                percentile(values, 90) * 1000,
+                percentile(values, 99) * 1000,
+                values[-1] * 1000,
+            )
+        )
+
+    apic_stats = apic.stats()
+    print("APIC API calls: {}".format(sum(apic_stats["requests"].values())))
+    for request, count in sorted(apic_stats["requests"].items()):
+        print("\t{:<30} {}".format(request, count))
+    print("K8 API calls: {}".format(k8.stats()["lists"] + k8.stats()["watches"]))
+    k8.stop()
+    apic.stop()
+
+
+if __name__ == "__main__":
+    main()
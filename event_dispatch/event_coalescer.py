@@ -0,0 +1,135 @@
+"""
+Coalescing of bursty K8 watch events before they reach the handlers.
+"""
+from collections import OrderedDict
+
+
+class EventCoalescer:
+    """
+    Holds K8 events for up to `window` seconds. Pending events for the same
+    object UID are collapsed into the latest state, and MODIFIED events that
+    do not change a field the handlers act on (pod IP, haystack annotations,
+    LB ingress) are dropped.
+
+    Items are (queued time, source, event) as queued by the EventDispatcher.
+    """
+
+    def __init__(self, window, on_drop, owned=None):
+        """
+        window:float Seconds an event is held for
+        on_drop:func Called with each item that is merged or dropped
+        owned:func Called with (Deployment DELETED item, held item), True if the
+        held event is for a pod of the deployment and is passed on ahead of it
+        """
+        self._window = window
+        self._on_drop = on_drop
+        self._owned = owned
+        # uid -> [deadline, item], in arrival (and so deadline) order
+        self._pending = OrderedDict()
+        # uid -> fingerprint of the last event passed on
+        self._last = {}
+        self.coalesced = 0
+        self.unchanged = 0
+
+    def add(self, item, now):
+        """
+        Add an event, returns the list of items to dispatch now
+        """
+        queued, source, event = item
+        uid = event["object"].metadata.uid
+
+        if event["type"] == "DELETED":
+            self._last.pop(uid, None)
+            if source == "Deployment" and self._owned is not None:
+                # the deployment's pods may still be pending, they must reach
+                # the handlers first
+                owned = [uid for uid, (_, held) in self._pending.items() if self._owned(item, held)]
+                return self._release(owned) + [item]
+
+            pending = self._pending.pop(uid, None)
+            if pending is not None:
+                self._drop(pending[1])
+            return [item]
+
+        pending = self._pending.get(uid)
+        if pending is None:
+            self._pending[uid] = [now + self._window, item]
+            return []
+
+        # keep the first queued time & deadline, an ADDED stays an ADDED
+        pending_queued, _, pending_event = pending[1]
+        if pending_event["type"] == "ADDED":
+            event = dict(event, type="ADDED")
+        self._drop(pending[1])
+        pending[1] = (pending_queued, source, event)
+        self.coalesced += 1
+        return []
+
+    def due(self, now):
+        """
+        Returns the list of held items whose window has passed
+        """
+        uids = []
+        for uid, (deadline, _) in self._pending.items():
+            if deadline > now:
+                break
+            uids.append(uid)
+        return self._release(uids)
+
+    def _release(self, uids):
+        """
+        Returns the held items of the uids in arrival order, less the
+        MODIFIED events that change nothing the handlers act on
+        """
+        ready = []
+        for uid in uids:
+            _, item = self._pending.pop(uid)
+
+            fingerprint = _fingerprint(item[1], item[2]["object"])
+            if item[2]["type"] == "MODIFIED" and self._last.get(uid) == fingerprint:
+                self.unchanged += 1
+                self._on_drop(item)
+                continue
+            self._last[uid] = fingerprint
+            ready.append(item)
+        return ready
+
+    def next_deadline(self):
+        """
+        Returns the time the oldest held event is due, None if none are held
+        """
+        for deadline, _ in self._pending.values():
+            return deadline
+        return None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _drop(self, item):
+        self._on_drop(item)
+
+
+def _fingerprint(source, obj):
+    """
+    Returns the fields of a K8 object the event handlers act on
+    """
+    annotations = tuple(
+        sorted(
+            (k, v)
+            for k, v in (obj.metadata.annotations or {}).items()
+            if "haystacknetworks.com" in k
+        )
+    )
+    if source == "Pod":
+        return (obj.status.pod_ip if obj.status is not None else None, annotations)
+
+    if source == "Service":
+        ingress = obj.status.load_balancer.ingress if obj.status.load_balancer else None
+        return (
+            obj.spec.type,
+            tuple(i.ip for i in (ingress or [])),
+            tuple(sorted((obj.spec.selector or {}).items())),
+            annotations,
+        )
+
+    return annotations
@@ -0,0 +1,477 @@
+"""
+Event dispatch from the K8 and APIC watcher threads to the event handlers.
+"""
+import os
+import traceback
+from queue import Queue, Empty
+from threading import Thread, Lock
+from time import monotonic
+from zlib import crc32
+from k8_events.k8_events import process_k8_event
+from k8_events.k8_events_helpers import subnet_batch, set_eepg_handoff
+from k8_helpers.k8_helpers import extract_k8_annotation
+from k8_helpers.k8_owners import get_replicaset_owner, get_indexed_deployment
+from apic_events.apic_events import process_apic_events
+from .event_coalescer import EventCoalescer
+from aci_helpers.aci_helpers import get_parent_from_dn
+from aci_helpers.aci_object import normalise_dn
+from tracing import tracing
+from aci_logging.aci_logging import get_logger
+
+log = get_logger(__name__)
+
+# Max number of queued events handled per dispatch batch
+dispatch_batch_size = int(os.environ.get("ACI_SYNC_DISPATCH_BATCH_SIZE", "100"))
+# Seconds between dispatcher stats lines, 0 to disable
+dispatch_stats_interval = int(os.environ.get("ACI_SYNC_DISPATCH_STATS_INTERVAL", "60"))
+# Number of event handler worker threads, 0 runs the handlers on the dispatch thread
+dispatch_workers = int(os.environ.get("ACI_SYNC_EVENT_WORKERS", "4"))
+# Seconds K8 events are held to coalesce repeated events for an object, 0 to disable
+coalesce_window = float(os.environ.get("K8_EVENT_COALESCE_WINDOW", "1.0"))
+
+# Event sources, APIC is the APIC websocket the others are K8 kinds
+event_sources = ["Deployment", "Pod", "Service", "APIC"]
+
+
+class EventDispatcher:
+    """
+    Multiplexes every event source into one FIFO queue, the dispatch
+    loop blocks on the queue and drains it in batches as fast as the
+    handlers allow.
+
+    With workers, each event is handed to the worker selected by its partition
+    key (the EEPG DN it affects) so the events for one EEPG are handled
+    strictly in order while unrelated EEPGs are handled in parallel. A K8
+    object keeps the key of its first event until it is DELETED, so its events
+    are never split across workers. A service may write to several EEPGs, its
+    events keep namespace order and its EEPG writes are handed to the EEPG
+    workers.
+
+    K8 events pass through an EventCoalescer first, unless the coalesce
+    window is 0. The pods of a deployment it flushes ahead of the Deployment
+    DELETED are handled before it on the same worker.
+    """
+
+    def __init__(self, batch_size=None, workers=None, window=None):
+        self._queue = Queue()
+        self._batch_size = batch_size if batch_size is not None else dispatch_batch_size
+        self._lock = Lock()
+        self._depth = {source: 0 for source in event_sources}
+        # source: [count, total latency, max latency] of queue wait time
+        self._latency = {source: [0, 0.0, 0.0] for source in event_sources}
+
+        workers = workers if workers is not None else dispatch_workers
+        self._workers = [_EventWorker(self, i) for i in range(workers)]
+        # K8 object uid -> partition key, only used by the dispatch thread
+        self._keys = {}
+        if self._workers:
+            set_eepg_handoff(self.submit)
+
+        window = window if window is not None else coalesce_window
+        self._coalescer = EventCoalescer(window, self._discard, self._owned) if window > 0 else None
+
+    def source_queue(self, source):
+        """
+        Returns a queue like object with put(event) for a watcher thread
+
+        source:str One of event_sources
+        """
+        assert source in event_sources
+        return _SourceQueue(self, source)
+
+    def put(self, source, event):
+        """
+        Queue an event from the given source for dispatch, an APIC event is
+        queued as one event per MO in imdata as each MO may affect another EEPG.
+        """
+        events = [event]
+        if source == "APIC" and len(event["imdata"]) > 1:
+            events = [
+                {"subscriptionId": event.get("subscriptionId"), "imdata": [mo]}
+                for mo in event["imdata"]
+            ]
+
+        for event in events:
+            # the root span of a sampled event starts at the watcher receipt
+            trace = _start_trace(source, event)
+            if trace is not None:
+                event["trace"] = trace
+
+        queued = monotonic()
+        with self._lock:
+            self._depth[source] += len(events)
+        for event in events:
+            self._queue.put((queued, source, event))
+
+    def submit(self, key, func):
+        """
+        Run func on the worker of the partition key, after the events already
+        queued for it
+
+        key:str e.g. an EEPG DN '/uni/tn-../out-../instP-..'
+        func:func Called without arguments
+        """
+        self._worker(key).put((monotonic(), "Task", func))
+
+    def _worker(self, key):
+        return self._workers[crc32(key.encode()) % len(self._workers)]
+
+    def run(self, stop):
+        """
+        Dispatch loop, returns once stop() returns True.
+
+        stop:func Called at least every 0.5s while the queue is empty
+        """
+        last_stats = monotonic()
+        while not stop():
+            timeout = 0.5
+            if self._coalescer is not None and len(self._coalescer) > 0:
+                timeout = min(timeout, max(0.0, self._coalescer.next_deadline() - monotonic()))
+
+            batch = []
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except Empty:
+                pass
+
+            while 0 < len(batch) < self._batch_size:
+                try:
+                    batch.append(self._queue.get(block=False))
+                except Empty:
+                    break
+
+            # groups of items handled in order by the same worker
+            groups = [[item] for item in batch]
+            if self._coalescer is not None:
+                now = monotonic()
+                groups = []
+                for item in batch:
+                    if item[1] == "APIC":
+                        groups.append([item])
+                        continue
+                    # a Deployment DELETED comes with its pods flushed ahead of it
+                    ready = self._coalescer.add(item, now)
+                    if ready:
+                        groups.append(ready)
+                groups.extend([item] for item in self._coalescer.due(now))
+
+            if len(groups) == 0:
+                continue
+            if len(self._workers) == 0:
+                self._dispatch([item for group in groups for item in group])
+            else:
+                for group in groups:
+                    worker = self._worker(self._group_key(group))
+                    for item in group:
+                        worker.put(item)
+
+            if dispatch_stats_interval and monotonic() - last_stats > dispatch_stats_interval:
+                last_stats = monotonic()
+                self.print_stats()
+
+        for worker in self._workers:
+            worker.stop()
+
+    def _dispatch(self, batch):
+        """
+        Run the handlers for a batch of (queued time, source, event), APIC
+        subnets requested by the K8 handlers are created in bulk.
+
+        Consecutive APIC events are handled together, merged per DN.
+
+        The root spans of the traced events are ended after the bulk subnet push.
+        """
+        traces = []
+        with subnet_batch():
+            apic_events = []
+            for queued, source, event in batch:
+                if source == "Task":
+                    if apic_events:
+                        _process_apic_events(apic_events)
+                        apic_events = []
+                    _run_task(event)
+                    continue
+                if event.get("trace") is not None:
+                    traces.append(event["trace"])
+                wait = monotonic() - queued
+                with self._lock:
+                    self._depth[source] -= 1
+                    latency = self._latency[source]
+                    latency[0] += 1
+                    latency[1] += wait
+                    latency[2] = max(latency[2], wait)
+
+                if source == "APIC":
+                    apic_events.append(event)
+                    continue
+                if apic_events:
+                    _process_apic_events(apic_events)
+                    apic_events = []
+                with tracing.resume(event.get("trace")):
+                    process_k8_event(event)
+
+            if apic_events:
+                _process_apic_events(apic_events)
+
+        for trace in traces:
+            tracing.finish(trace)
+
+    def _group_key(self, group):
+        """
+        Returns the partition key of the last event in the group. The pods
+        flushed ahead of a Deployment DELETED take its key, so their later
+        events follow them onto the same worker.
+        """
+        key = self._partition_key(group[-1][1], group[-1][2])
+        for _, _, event in group[:-1]:
+            uid = event["object"].metadata.uid
+            if event["type"] == "DELETED":
+                self._keys.pop(uid, None)
+            else:
+                self._keys[uid] = key
+        return key
+
+    def _partition_key(self, source, event):
+        """
+        Returns the partition key of an event, the key of a K8 object is set by
+        its first event and forgotten after its DELETED event
+        """
+        if source == "APIC":
+            return _partition_key(source, event, self._keys)
+
+        uid = event["object"].metadata.uid
+        key = self._keys.get(uid)
+        if key is None:
+            key = _partition_key(source, event, self._keys)
+        if event["type"] == "DELETED":
+            self._keys.pop(uid, None)
+        else:
+            self._keys[uid] = key
+        return key
+
+    def _owned(self, deployment, item):
+        """
+        True if the held K8 event is for a pod of the deployment, the pod
+        shares the deployment's key or its ReplicaSet is owned by it in the
+        owner index
+
+        deployment:tuple The Deployment DELETED item
+        """
+        if item[1] != "Pod":
+            return False
+        dep = deployment[2]["object"].metadata
+        pod = item[2]["object"].metadata
+        key = self._keys.get(dep.uid)
+        if key is not None and self._keys.get(pod.uid) == key:
+            return True
+        if pod.namespace != dep.namespace or not pod.owner_references:
+            return False
+        owner = pod.owner_references[0]
+        if owner.kind != "ReplicaSet":
+            return False
+        return get_replicaset_owner(pod.namespace, owner.name)[1] == dep.name
+
+    def _discard(self, item):
+        """
+        An event merged or dropped by the coalescer
+        """
+        with self._lock:
+            self._depth[item[1]] -= 1
+        tracing.finish(item[2].get("trace"), coalesced=True)
+
+    def stats(self):
+        """
+        Returns { 'depth': { source: queued events },
+                  'latency': { source: { 'count': int, 'avg': secs, 'max': secs } },
+                  'workers': [ worker queued events, ... ],
+                  'coalesced': events merged, 'unchanged': MODIFIED events dropped }
+        """
+        coalescer = self._coalescer
+        with self._lock:
+            return {
+                "coalesced": coalescer.coalesced if coalescer is not None else 0,
+                "unchanged": coalescer.unchanged if coalescer is not None else 0,
+                "depth": dict(self._depth),
+                "workers": [worker.depth() for worker in self._workers],
+                "latency": {
+                    source: {
+                        "count": count,
+                        "avg": (total / count) if count else 0.0,
+                        "max": max_wait,
+                    }
+                    for source, (count, total, max_wait) in self._latency.items()
+                },
+            }
+
+    def print_stats(self):
+        stats = self.stats()
+        print("Event Dispatcher Stats")
+        for source in event_sources:
+            latency = stats["latency"][source]
+            print(
+                "\t{:<12} queued: {:<8} dispatched: {:<10} latency avg: {:.3f}s max: {:.3f}s".format(
+                    source, stats["depth"][source], latency["count"], latency["avg"], latency["max"]
+                )
+            )
+        for i, depth in enumerate(stats["workers"]):
+            print("\tWorker {:<5} queued: {}".format(i, depth))
+        print(
+            "\tCoalesced events: {} Unchanged MODIFIED events dropped: {}".format(
+                stats["coalesced"], stats["unchanged"]
+            )
+        )
+
+
+class _SourceQueue:
+    """
+    The put() side of the dispatcher queue for a single event source
+    """
+
+    def __init__(self, dispatcher, source):
+        self._dispatcher = dispatcher
+        self._source = source
+
+    def put(self, event):
+        self._dispatcher.put(self._source, event)
+
+
+class _EventWorker(Thread):
+    """
+    Runs the event handlers for the partition keys hashed to it,
+    draining its queue in batches.
+    """
+
+    def __init__(self, dispatcher, index):
+        Thread.__init__(self, name="event-worker-{}".format(index))
+        self._dispatcher = dispatcher
+        self._queue = Queue()
+        self.start()
+
+    def put(self, item):
+        self._queue.put(item)
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def stop(self):
+        self._queue.put(None)
+        self.join()
+
+    def run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self._dispatcher._batch_size:
+                try:
+                    batch.append(self._queue.get(block=False))
+                except Empty:
+                    break
+
+            stop = None in batch
+            try:
+                self._dispatcher._dispatch([item for item in batch if item is not None])
+            except Exception as e:
+                # dedicated thread so ensure we send any unhandled
+                # errors to stdout
+                print("Unhandled error in {} thread: {}".format(self.name, str(e)))
+                print(traceback.format_exc())
+            if stop:
+                return
+
+
+def _run_task(func):
+    """
+    Run a function handed to the worker by submit()
+    """
+    try:
+        func()
+    except Exception as e:
+        log.exception("Unhandled error in handed off event work: %s", str(e))
+
+
+def _process_apic_events(events):
+    """
+    Handle merged APIC events, the spans are children of the first traced event
+    """
+    with tracing.resume(*[event.get("trace") for event in events]):
+        process_apic_events(events)
+
+
+def _start_trace(source, event):
+    """
+    Returns the root span for an event if sampled, else None
+    """
+    if not tracing.enabled:
+        return None
+    if source == "APIC":
+        mo = event["imdata"][0]
+        mo_class = list(mo.keys())[0]
+        attributes = mo[mo_class]["attributes"]
+        return tracing.start_trace(
+            "APIC {} {}".format(mo_class, attributes.get("status")), dn=attributes.get("dn")
+        )
+    metadata = event["object"].metadata
+    return tracing.start_trace(
+        "K8 {} {}".format(source, event["type"]),
+        namespace=metadata.namespace,
+        name=metadata.name,
+        uid=metadata.uid,
+    )
+
+
+def _partition_key(source, event, keys):
+    """
+    Returns the key that orders events, the EEPG DN '/uni/tn-../out-../instP-..'
+    affected by the event when known.
+
+    K8 events use the owning deployment's tenant/l3out/epg annotation, APIC
+    events the parent EEPG DN of a subnet or the MO DN itself. A pod takes the
+    key of its deployment. A service uses its namespace, see on_eepg_worker.
+
+    keys:dict K8 object uid -> partition key of the objects already dispatched
+    """
+    try:
+        if source == "APIC":
+            mo = event["imdata"][0]
+            mo_class = list(mo.keys())[0]
+            dn = mo[mo_class]["attributes"]["dn"]
+            if mo_class == "l3extSubnet":
+                dn = get_parent_from_dn(dn)
+            return normalise_dn(dn)
+
+        obj = event["object"]
+        if source == "Service":
+            # may span many deployments, keep the namespace in order
+            return "Service:{}".format(obj.metadata.namespace)
+
+        dep_annotations = obj.metadata.annotations
+        if source == "Pod":
+            dep = _indexed_pod_deployment(obj)
+            if dep is not None and dep.uid in keys:
+                return keys[dep.uid]
+            dep_annotations = dep.annotations if dep is not None else None
+
+        dn_data = extract_k8_annotation(dep_annotations)
+        return "/uni/tn-{}/out-{}/instP-{}".format(
+            dn_data["tenant"], dn_data["l3out"], dn_data["epg"]
+        )
+
+    except Exception as e:
+        # unmanaged object or unexpected event, keep the object in order
+        if source == "APIC":
+            return "APIC"
+        return "{}:{}".format(source, event["object"].metadata.uid)
+
+
+def _indexed_pod_deployment(pod):
+    """
+    Returns the pod's Deployment K8Object from the owner index, None if not
+    indexed. Runs on the dispatch thread so the K8 API is never called.
+    """
+    owners = pod.metadata.owner_references
+    if not owners or owners[0].kind != "ReplicaSet":
+        return None
+    namespace = pod.metadata.namespace
+    _, dep_name = get_replicaset_owner(namespace, owners[0].name)
+    if dep_name is None:
+        return None
+    return get_indexed_deployment(namespace, dep_name)
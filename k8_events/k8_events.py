@@ -1,18 +1,33 @@
 """
 """
-import traceback
+from capture.event_capture import capture_k8_event
+from metrics.prometheus import Counter, Histogram
+from tracing import tracing
+from aci_logging.aci_logging import get_logger
 from .k8_events_deployment import event_deployment
 from .k8_events_pod import event_pod
 from .k8_events_service import event_service
 
+log = get_logger(__name__)
+
 event_map = {"Deployment": event_deployment, "Service": event_service, "Pod": event_pod}
 
+k8_events_total = Counter(
+    "aci_sync_k8_events_total", "K8 events handled by kind and type", ("kind", "type")
+)
+k8_handler_seconds = Histogram(
+    "aci_sync_k8_handler_seconds", "K8 event handler duration by handler", ("handler",)
+)
+
 
+@tracing.traced
 def process_k8_event(event):
+    capture_k8_event("K8", event)
     try:
-        f = event_map[event["object"].kind]
-        f(event)
+        kind = event["object"].kind
+        k8_events_total.inc(kind, event["type"])
+        f = event_map[kind]
+        with k8_handler_seconds.time(f.__name__), tracing.span(f.__name__):
+            f(event)
     except Exception as e:
-        print('Unhandled error occurred in K8 Events Handlers')
-        print('Error: {}'.format(stre(e)))
-        print(traceback.format_exc())
+        log.exception("Unhandled error occurred in K8 Events Handlers: %s", str(e))
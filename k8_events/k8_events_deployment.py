@@ -3,10 +3,14 @@
 """
 from k8_helpers.k8_helpers import print_event, extract_k8_annotation
 from k8_helpers.k8_object import add_k8_object, del_k8_object, get_k8_object
-from aci_helpers.aci_object import watch_managed_object, unwatch_managed_object
+from aci_helpers.aci_object import watch_managed_object, unwatch_managed_subtree
 from aci_helpers.aci_object import register_managed_object_callback, update_cached_managed_object
 from exceptions import ManagedObjectNotFoundError, CachedObjectNotFoundError
 from aci_helpers.aci_helpers import get_l3out_epg, delete_managed_object, get_eepg_subnets
+from aci_helpers.aci_helpers import delete_eepg_subnets
+from aci_logging.aci_logging import get_logger
+
+log = get_logger(__name__)
 
 
 def event_deployment(event):
@@ -21,14 +25,13 @@ def event_deployment(event):
         return
 
     print_event(event)
-    print("\t{}".format(annotation))
-
-    # We are dealing with .....
-    print("\tTenant:     /api/mo/uni/tn-{}".format(annotation["tenant"]))
-    print(
-        "\tLayer3 Out: /api/mo/uni/tn-{}/out-{}/instP-{}".format(
-            annotation["tenant"], annotation["l3out"], annotation["epg"]
-        )
+    log.debug(
+        "Deployment annotation %s, EEPG /api/mo/uni/tn-%s/out-%s/instP-%s",
+        annotation,
+        annotation["tenant"],
+        annotation["l3out"],
+        annotation["epg"],
+        extra={key: annotation[key] for key in ["tenant", "l3out", "epg"]},
     )
 
     # call relevent action func
@@ -48,14 +51,14 @@ def _add_event(event, aci_data):
       - Tenant/L3O must exist
       - Security Domains for tenant access mapped to K8 namespace ?
     """
-    print("\tDeployment Add Event")
+    log.debug("Deployment Add Event")
 
     # add object to app cache
     add_k8_object(event["object"])
 
     try:
         epg = _get_l3out_epg(aci_data)
-        print("\tL3Out EPG Description:", epg["attributes"]["descr"])
+        log.debug("L3Out EPG Description: %s", epg["attributes"].get("descr"))
 
     except ManagedObjectNotFoundError as e:
         # The Parent objects dont exist so we cant create this MO
@@ -72,15 +75,16 @@ def _add_event(event, aci_data):
                 return
 
             try:
-                annotation = extract_k8_annotation(obj.metadata.annotations)
+                annotation = extract_k8_annotation(obj.annotations)
             except Exception as e:
                 # the object does not have a haystacknetworks.com annotation
                 return
 
-            print(
-                "\tCreating L3Out EEPG from L3Out parent created event for: {}/{}/{}".format(
-                    annotation["tenant"], annotation["l3out"], annotation["epg"]
-                )
+            log.info(
+                "Creating L3Out EEPG from L3Out parent created event for: %s/%s/%s",
+                annotation["tenant"],
+                annotation["l3out"],
+                annotation["epg"],
             )
             epg = _get_l3out_epg(annotation)
             return
@@ -90,9 +94,7 @@ def _add_event(event, aci_data):
         # Create subscription for parent DN (tenant/l3out) 'created' event
         # and pass callback func for APIC MO 'created' event
         parent_dn = "/uni/tn-{}/out-{}".format(aci_data["tenant"], aci_data["l3out"])
-        print(
-            "\tRegistering callback function for created event for parent dn: {}".format(parent_dn)
-        )
+        log.info("Registering callback function for created event for parent dn: %s", parent_dn)
         register_managed_object_callback(dn=parent_dn, action="created", callback_func=create_eepg)
 
     return
@@ -114,13 +116,13 @@ def _get_l3out_epg(aci_data):
                 update_cached_managed_object(epg["attributes"]["dn"], {"l3extInstP": epg})
             except Exception as e:
                 # if not create MO cache and subs
-                watch_managed_object(epg["attributes"]["dn"])
+                watch_managed_object(epg["attributes"]["dn"], mo={"l3extInstP": epg})
 
     except ManagedObjectNotFoundError as e:
-        print(
-            (
-                "\tThe APIC tenant: {} and L3Out: {} must already exist. " "Please create them."
-            ).format(aci_data["tenant"], aci_data["l3out"])
+        log.error(
+            "The APIC tenant: %s and L3Out: %s must already exist. Please create them.",
+            aci_data["tenant"],
+            aci_data["l3out"],
         )
         raise
 
@@ -133,9 +135,8 @@ def _mod_event(event, aci_data):
       - Dont this we really care about deployment being modified ?
       - What if the annotations have been changed ? how do we get old and new?
     """
-    print("\tDeployment Modified Event")
+    log.debug("Deployment Modified Event")
     # TODO: Deployment Modify
-    print("\t**** TODO: Deployment Modify ****")
 
 
 def _del_event(event, aci_data):
@@ -148,16 +149,13 @@ def _del_event(event, aci_data):
         can either mark with special aci tag/annotation or just use
         the k8 deployment annotation.
     """
-    print("\tDeployment Deleted Event")
+    log.debug("Deployment Deleted Event")
 
-    # Stop Any Subscriptions
+    # Stop Any Subscriptions, for the EEPG and all subnets below it
     eepg_dn = "/uni/tn-{}/out-{}/instP-{}".format(
         aci_data["tenant"], aci_data["l3out"], aci_data["epg"]
     )
-    # TODO: delete all APIC subs with a dn path starting with EEPG Dn
-    # i.e. unsubscribe... /uni/tn-TEN_K8_C1/out-L3O_K8_C1/instP-EPG_K8_APP_MCAST/extsubnet#[]
-    # with haystack annotation
-    unwatch_managed_object(eepg_dn)
+    unwatch_managed_subtree(eepg_dn)
 
     # Delete EEPG if managed by us, if not delete subnets where managed by us.
     try:
@@ -175,14 +173,13 @@ def _del_event(event, aci_data):
         try:
             # get all EEPG subnets that are managed
             eepg_subnets = get_eepg_subnets(aci_data["tenant"], aci_data["l3out"], aci_data["epg"])
-            subnets = eepg_subnets["children"]
-            for subnet in subnets:
+            subnets = []
+            for subnet in eepg_subnets["children"]:
                 if list(subnet.keys())[0] == "l3extSubnet":
-                    subnet_dn = "/{}/{}".format(
-                        eepg_subnets["attributes"]["dn"], subnet["l3extSubnet"]["attributes"]["rn"]
-                    )
-                    unwatch_managed_object(subnet_dn)
-                    delete_managed_object(subnet_dn)
+                    ip = subnet["l3extSubnet"]["attributes"]["ip"]
+                    subnets.append((aci_data["tenant"], aci_data["l3out"], aci_data["epg"], ip))
+            # one APIC transaction for all the subnets
+            delete_eepg_subnets(subnets)
 
         except ManagedObjectNotFoundError as e:
             # the L3out no longer exists, so do nothing in ACI
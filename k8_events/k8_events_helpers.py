@@ -1,10 +1,245 @@
 """
 '
 """
+import os
+from contextlib import contextmanager
+from threading import local
 from k8_helpers.k8_object import get_k8_object
 from aci_helpers.aci_helpers import create_eepg_subnet as api_create_eepg_subnet
-from aci_helpers.aci_object import watch_managed_object, update_cached_managed_object
+from aci_helpers.aci_helpers import create_eepg_subnets as api_create_eepg_subnets
+from aci_helpers.aci_helpers import delete_eepg_subnet as api_delete_eepg_subnet
+from aci_helpers.aci_helpers import delete_eepg_subnets as api_delete_eepg_subnets
+from aci_helpers.aci_object import watch_managed_object, unwatch_managed_object
+from aci_helpers.aci_object import register_managed_object_callback, update_cached_managed_object
 from exceptions import ManagedObjectNotFoundError, CachedObjectNotFoundError
+from tracing import tracing
+from aci_logging.aci_logging import get_logger
+
+log = get_logger(__name__)
+
+# Max number of l3extSubnet creations queued in a subnet_batch() before they are pushed
+subnet_batch_size = int(os.environ.get("ACI_SUBNET_BATCH_SIZE", "500"))
+
+# Per thread queue of pending l3extSubnet creations, only set inside subnet_batch(),
+# with the trace contexts of the spans that queued them
+_batch = local()
+
+# Called with (EEPG DN, func) to run func on the event worker of the EEPG, set by
+# an EventDispatcher with workers. When None func runs on the calling thread.
+_eepg_handoff = None
+
+
+def set_eepg_handoff(handoff):
+    """
+    handoff:func Called with (EEPG DN, func), None to run on the calling thread
+    """
+    global _eepg_handoff
+    _eepg_handoff = handoff
+
+
+def on_eepg_worker(dn_data, func):
+    """
+    Run func on the event worker handling the EEPG, after the events already
+    queued for it. The writes of an event keyed by another EEPG, e.g. a
+    service, are then ordered with the EEPG's own pod and deployment events.
+
+    dn_data:dict - Keys: tenant, l3out, epg (names)
+    func:func - Called without arguments
+    """
+    if _eepg_handoff is None:
+        func()
+        return
+
+    context = tracing.current_context()
+
+    def handed_off():
+        with tracing.linked_span("on_eepg_worker", [context]):
+            func()
+
+    eepg_dn = "/uni/tn-{}/out-{}/instP-{}".format(
+        dn_data["tenant"], dn_data["l3out"], dn_data["epg"]
+    )
+    _eepg_handoff(eepg_dn, handed_off)
+
+
+@contextmanager
+def subnet_batch():
+    """
+    Queue the l3extSubnet creations requested through create_or_defer_eepg_subnet
+    on this thread and push them to the APIC in bulk when the block exits.
+    If the block raises the queued creations are dropped, the reconciler
+    creates any subnet missing on the APIC.
+
+    A nested subnet_batch() joins the outer batch.
+    """
+    if getattr(_batch, "pending", None) is not None:
+        yield
+        return
+
+    _batch.pending = []
+    _batch.contexts = []
+    try:
+        yield
+    except BaseException:
+        if len(_batch.pending) > 0:
+            log.warning("Dropped %s queued subnet creations", len(_batch.pending))
+        raise
+    finally:
+        pending = _batch.pending
+        _batch.pending = None
+    _flush_subnet_batch(pending, _batch.contexts)
+
+
+def _flush_subnet_batch(pending, contexts):
+    """
+    Create the queued l3extSubnet's with one APIC transaction per EEPG. If the
+    bulk creation fails each subnet is created on its own.
+
+    pending:list - (name, ip, dn_data, callback_func) tuples
+    contexts:list - Trace contexts of the spans that queued them, the push is linked to each
+    """
+    if len(pending) == 0:
+        return
+
+    subnets = [
+        (dn_data["tenant"], dn_data["l3out"], dn_data["epg"], ip, name)
+        for name, ip, dn_data, _ in pending
+    ]
+    with tracing.linked_span("subnet_batch", list(dict.fromkeys(contexts)), subnets=len(subnets)):
+        try:
+            created = api_create_eepg_subnets(subnets)
+        except Exception as e:
+            log.warning(
+                "Bulk creation of %s subnets failed, creating them one by one: %s",
+                len(subnets),
+                str(e),
+            )
+            for name, ip, dn_data, callback_func in pending:
+                try:
+                    _create_or_defer_eepg_subnet(name, ip, dn_data, callback_func)
+                except Exception as e:
+                    log.error("Failed to create subnet %s: %s", ip, str(e), extra=dn_data)
+            return
+
+        for name, ip, dn_data, callback_func in pending:
+            subnet = created.get(_subnet_dn(dn_data, ip))
+            if subnet is None:
+                # The Parent objects dont exist so we cant create this MO
+                _register_parent_callback(dn_data, callback_func)
+                continue
+            _watch_subnet(subnet)
+
+
+def _subnet_dn(dn_data, ip):
+    """
+    Returns the l3extSubnet host (/32) DN as 'uni/tn-../out-../instP-../extsubnet-[x.x.x.x/32]'
+    """
+    return "uni/tn-{}/out-{}/instP-{}/extsubnet-[{}/32]".format(
+        dn_data["tenant"], dn_data["l3out"], dn_data["epg"], ip
+    )
+
+
+def _watch_subnet(subnet):
+    """
+    Add APIC watcher for EEPG Subnet DN (l3extSubnet) and update the cache with MO data
+    """
+    # The cache MO object MUST have a valid MO config now we have created the APIC MO
+    try:
+        # In case it exists already
+        watch_managed_object(subnet["attributes"]["dn"], mo={"l3extSubnet": subnet})
+    except Exception as e:
+        # if not create MO cache and subs
+        update_cached_managed_object(subnet["attributes"]["dn"], {"l3extSubnet": subnet})
+
+
+def _register_parent_callback(dn_data, callback_func):
+    """
+    Setup APIC subscription to watch for the parent EEPG (l3extInstP) creation
+    with callback which will then create the l3extSubnet
+    """
+    parent_dn = "/uni/tn-{}/out-{}/instP-{}".format(
+        dn_data["tenant"], dn_data["l3out"], dn_data["epg"]
+    )
+    log.info("Registering callback function for created event for parent dn: %s", parent_dn)
+    register_managed_object_callback(dn=parent_dn, action="created", callback_func=callback_func)
+
+
+def create_or_defer_eepg_subnet(name, ip, dn_data, callback_func):
+    """
+    Create the l3extSubnet in the l3out l3extInstP (EEPG). If the parent MOs do
+    not exist, callback_func is registered for the parent EEPG 'created' event.
+
+    Inside a subnet_batch() the creation is queued and pushed on exit.
+
+    name:str - Short decrcription
+    ip:str - Host IP address without mask.
+    dn_data:dict - Keys: tenant, l3out, epg (names)
+    callback_func:func - Creates the subnet once the parent EEPG exists
+    """
+    pending = getattr(_batch, "pending", None)
+    if pending is not None:
+        pending.append((name, ip, dn_data, callback_func))
+        context = tracing.current_context()
+        if context is not None:
+            _batch.contexts.append(context)
+        if len(pending) >= subnet_batch_size:
+            _flush_subnet_batch(pending[:], _batch.contexts[:])
+            del pending[:]
+            del _batch.contexts[:]
+        return
+
+    _create_or_defer_eepg_subnet(name, ip, dn_data, callback_func)
+
+
+def _create_or_defer_eepg_subnet(name, ip, dn_data, callback_func):
+    """
+    Create the l3extSubnet now, see create_or_defer_eepg_subnet
+    """
+    try:
+        subnet = create_eepg_subnet(name, ip, dn_data)
+        log.debug("L3Out EPG Subnet IP: %s", subnet["attributes"]["ip"])
+
+    except ManagedObjectNotFoundError as e:
+        # The Parent objects dont exist so we cant create this MO
+        _register_parent_callback(dn_data, callback_func)
+
+
+def delete_eepg_subnet(ip, dn_data):
+    """
+    Delete the l3extSubnet from the l3out l3extInstP (EEPG) and remove the
+    APIC subscription for it. A creation still queued in a subnet_batch()
+    for the same subnet is dropped.
+
+    ip:str - Host IP address without mask.
+    dn_data:dict - Keys: tenant, l3out, epg (names)
+    """
+    pending = getattr(_batch, "pending", None)
+    if pending is not None:
+        pending[:] = [p for p in pending if not (p[1] == ip and p[2] == dn_data)]
+
+    api_delete_eepg_subnet(dn_data["tenant"], dn_data["l3out"], dn_data["epg"], ip)
+    unwatch_managed_object(_subnet_dn(dn_data, ip))
+
+
+def delete_eepg_subnets(subnets):
+    """
+    Delete many l3extSubnet's with one APIC transaction per EEPG and remove
+    their APIC subscriptions.
+
+    subnets:list - (ip, dn_data) tuples, see delete_eepg_subnet
+    """
+    if len(subnets) == 0:
+        return
+
+    pending = getattr(_batch, "pending", None)
+    if pending is not None:
+        pending[:] = [p for p in pending if (p[1], p[2]) not in subnets]
+
+    api_delete_eepg_subnets(
+        [(dn_data["tenant"], dn_data["l3out"], dn_data["epg"], ip) for ip, dn_data in subnets]
+    )
+    for ip, dn_data in subnets:
+        unwatch_managed_object(_subnet_dn(dn_data, ip))
 
 
 def create_eepg_subnet(name, ip, dn_data):
@@ -28,20 +263,13 @@ def create_eepg_subnet(name, ip, dn_data):
             name,
         )
 
-        # Add APIC watcher for EEPG Subnet DN (l3extSubnet) and update the cache with MO data
-        # The cache MO object MUST have a valid MO config now we have created the APIC MO
-        try:
-            # In case it exists already
-            watch_managed_object(subnet["attributes"]["dn"])
-        except Exception as e:
-            # if not create MO cache and subs
-            update_cached_managed_object(subnet["attributes"]["dn"], {"l3extSubnet": subnet})
+        _watch_subnet(subnet)
 
     except ManagedObjectNotFoundError as e:
-        print(
-            ("\tThe APIC tenant: {}, L3Out: {} must already exist. " "Please create them.").format(
-                dn_data["tenant"], dn_data["l3out"]
-            )
+        log.warning(
+            "The APIC tenant: %s, L3Out: %s must already exist. Please create them.",
+            dn_data["tenant"],
+            dn_data["l3out"],
         )
         raise
 
@@ -62,14 +290,16 @@ def create_pod_subnet_callback(event, dn_data):
             # must have been deleted, so dont create ACI object
             return
 
-        name = "{}::{}".format(obj.metadata.namespace, obj.metadata.name)
+        name = "{}::{}".format(obj.namespace, obj.name)
         # this ip is from Pod Object Path
-        ip = obj.status.pod_ip
+        ip = obj.pod_ip
 
-        print(
-            "\tCreating l3ExtSubnet in l3out parent created event for: {}/{}/{}/{}".format(
-                dn_data["tenant"], dn_data["l3out"], dn_data["epg"], ip
-            )
+        log.info(
+            "Creating l3ExtSubnet in l3out parent created event for: %s/%s/%s/%s",
+            dn_data["tenant"],
+            dn_data["l3out"],
+            dn_data["epg"],
+            ip,
         )
 
         subnet = create_eepg_subnet(name, ip, dn_data)
@@ -103,11 +333,13 @@ def create_service_subnet_callback(event, dn_data):
         # for each assigned service ip
         for service in service_ip_list:
 
-            name = "{}::{}".format(obj.metadata.namespace, obj.metadata.name)
-            print(
-                "\tCreating l3ExtSubnet in l3out parent created event for: {}/{}/{}/{}".format(
-                    dn_data["tenant"], dn_data["l3out"], dn_data["epg"], service.ip
-                )
+            name = "{}::{}".format(obj.namespace, obj.name)
+            log.info(
+                "Creating l3ExtSubnet in l3out parent created event for: %s/%s/%s/%s",
+                dn_data["tenant"],
+                dn_data["l3out"],
+                dn_data["epg"],
+                service.ip,
             )
 
             subnet = create_eepg_subnet(name, service.ip, dn_data)
@@ -1,17 +1,21 @@
 """
 K8 Service Event Handlers
 
+A service may select the pods of several deployments, its subnet writes to
+each deployment EEPG run on the event worker of that EEPG (on_eepg_worker).
+
 TODO: Currently only managing ingress IP and not hostname
 """
-from k8_helpers.k8_pods import get_pods, get_pod_deployment
+from functools import partial
+from k8_helpers.k8_pods import get_cached_pod_deployment
 from k8_helpers.k8_helpers import print_event, extract_k8_annotation
-from k8_helpers.k8_object import add_k8_object, del_k8_object, get_k8_object
-from aci_helpers.aci_object import watch_managed_object, unwatch_managed_object
-from aci_helpers.aci_object import register_managed_object_callback
-from aci_helpers.aci_helpers import create_eepg_subnet, delete_eepg_subnet
-from k8_events.k8_events_helpers import create_eepg_subnet as _create_eepg_subnet
-from k8_events.k8_events_helpers import create_service_subnet_callback
-from exceptions import CachedObjectNotFoundError, ManagedObjectNotFoundError
+from k8_helpers.k8_object import add_k8_object, del_k8_object, get_k8_object, find_k8_pods
+from k8_events.k8_events_helpers import create_or_defer_eepg_subnet, delete_eepg_subnet
+from k8_events.k8_events_helpers import create_service_subnet_callback, on_eepg_worker
+from exceptions import CachedObjectNotFoundError
+from aci_logging.aci_logging import get_logger
+
+log = get_logger(__name__)
 
 
 def event_service(event):
@@ -24,14 +28,12 @@ def event_service(event):
     selector_dict = event["object"].spec.selector
     if selector_dict is None:
         return
-    # create dict of selector k:v's
-    selector_list = ["{}={}".format(key, val) for key, val in selector_dict.items()]
-    selector_str = ",".join(selector_list)
 
-    items = get_pods(event["object"].metadata.namespace, selector_str)
+    # the K8 object cache holds the pods of the managed deployments
+    items = find_k8_pods(event["object"].metadata.namespace, selector_dict)
     deployments = []
     for pod in items:
-        deployment = get_pod_deployment(pod)
+        deployment = get_cached_pod_deployment(pod)
         if deployment is not None:
             # save pods that are part of a deployment that
             # has the 'haystacknetworks.com' annotation
@@ -40,14 +42,14 @@ def event_service(event):
             # print("\t Pod:        {:<20} {:<50}".format(pod.metadata.namespace, pod.metadata.name))
             # print(
             #     "\t Deployment: {:<20} {:<50}".format(
-            #         deployment.metadata.namespace, deployment.metadata.name
+            #         deployment.namespace, deployment.name
             #     )
             # )
 
     dep_dn_data = []
     for dep in deployments:
         try:
-            dn_data = extract_k8_annotation(deployment.metadata.annotations)
+            dn_data = extract_k8_annotation(dep.annotations)
             if dn_data not in dep_dn_data:
                 dep_dn_data.append(dn_data)
         except Exception as e:
@@ -56,7 +58,12 @@ def event_service(event):
             pass
 
     if len(dep_dn_data) == 0:
-        # no managed deployments found
+        # no managed deployments found, the service is still cached so the
+        # reconciler picks it up once its pods have been handled
+        if event["type"] == "DELETED":
+            del_k8_object(event["object"].metadata.uid)
+        else:
+            add_k8_object(event["object"])
         return
 
     # call relevent action func
@@ -74,7 +81,7 @@ def _add_event(event, dep_dn_data):
     ADDED (Is New & Startup Sync)
     Need to get the LB IP and add to the EEPG Subnets
     """
-    print("\tService Added Event")
+    log.debug("Service Added Event")
 
     # service_ip = event["object"].status.load_balancer.ingress[0].ip
     # TODO: Do we need/want to deal with other types?
@@ -89,39 +96,9 @@ def _add_event(event, dep_dn_data):
         # end deployments in scope
 
         # For each deployment (tenant|l3out|eepg)
+        ips = [service.ip for service in service_ip_list]
         for dn_data in dep_dn_data:
-
-            # for each assigned service ip
-            for service in service_ip_list:
-
-                name = "{}::{}".format(
-                    event["object"].metadata.namespace, event["object"].metadata.name
-                )
-
-                try:
-                    subnet = _create_eepg_subnet(name, service.ip, dn_data)
-                    print("\tL3Out EPG Subnet IP:", subnet["attributes"]["ip"])
-
-                except ManagedObjectNotFoundError as e:
-                    # The Parent objects dont exist so we cant create this MO
-                    # So setup APIC subscription to watch for the parent EEPG (l3extInstP) creation
-                    # with callback which will then create the l3extSubnet
-
-                    cb_func = create_service_subnet_callback(event, dn_data)
-
-                    # Create subscription for parent DN (tenant/l3out) 'created' event
-                    # and pass callback func for APIC MO 'created' event
-                    parent_dn = "/uni/tn-{}/out-{}/instP-{}".format(
-                        dn_data["tenant"], dn_data["l3out"], dn_data["epg"]
-                    )
-                    print(
-                        "\tRegistering callback function for created event for parent dn: {}".format(
-                            parent_dn
-                        )
-                    )
-                    register_managed_object_callback(
-                        dn=parent_dn, action="created", callback_func=cb_func
-                    )
+            on_eepg_worker(dn_data, partial(_create_subnets, event, ips, dn_data))
 
     # Add Pod to k8 cache
     add_k8_object(event["object"])
@@ -132,7 +109,7 @@ def _mod_event(event, dep_dn_data):
     MODIFIED
     Need to get and check the LB IP and add/modify in the EEPG Subnets
     """
-    print("\tService Modified Event")
+    log.debug("Service Modified Event")
 
     uid = event["object"].metadata.uid
     try:
@@ -142,20 +119,15 @@ def _mod_event(event, dep_dn_data):
         return
 
     new_service_is_load_balancer = event["object"].spec.type == "LoadBalancer"
-    # old_service_is_load_balancer = last_obj.spec.type == "LoadBalancer"
+    # old_service_is_load_balancer = last_obj.service_type == "LoadBalancer"
 
     new_ingress = (
         []
         if event["object"].status.load_balancer.ingress is None
         else event["object"].status.load_balancer.ingress
     )
-    old_ingress = (
-        []
-        if last_obj.status.load_balancer.ingress is None
-        else last_obj.status.load_balancer.ingress
-    )
     new_service_ip_list = [ingress.ip for ingress in new_ingress]
-    old_service_ip_list = [ingress.ip for ingress in old_ingress]
+    old_service_ip_list = list(last_obj.lb_ingress)
 
     def remove_ips(ips_to_remove):
         nonlocal dep_dn_data
@@ -168,14 +140,7 @@ def _mod_event(event, dep_dn_data):
         # end deployments in scope
         for dn_data in dep_dn_data:
             # For each deployment (tenant|l3out|eepg)
-            for service_ip in ips_to_remove:
-                delete_eepg_subnet(dn_data["tenant"], dn_data["l3out"], dn_data["epg"], service_ip)
-
-                # Remove APIC Subscription for this Subnet
-                urlpath = "/uni/tn-{}/out-{}/instP-{}/extsubnet-[{}/32]".format(
-                    dn_data["tenant"], dn_data["l3out"], dn_data["epg"], service_ip
-                )
-                unwatch_managed_object(urlpath)
+            on_eepg_worker(dn_data, partial(_delete_subnets, ips_to_remove, dn_data))
 
     def add_ips(ips_to_add):
         nonlocal dep_dn_data
@@ -184,20 +149,7 @@ def _mod_event(event, dep_dn_data):
             return
         # For each deployment (tenant|l3out|eepg)
         for dn_data in dep_dn_data:
-            # for each assigned service ip
-            for service_ip in ips_to_add:
-                name = "{}::{}".format(
-                    event["object"].metadata.namespace, event["object"].metadata.name
-                )
-                create_eepg_subnet(
-                    dn_data["tenant"], dn_data["l3out"], dn_data["epg"], service_ip, name
-                )
-
-                # Add APIC watcher for EEPG Subnet DN (l3extSubnet)
-                urlpath = "/uni/tn-{}/out-{}/instP-{}/extsubnet-[{}/32]".format(
-                    dn_data["tenant"], dn_data["l3out"], dn_data["epg"], service_ip
-                )
-                watch_managed_object(urlpath)
+            on_eepg_worker(dn_data, partial(_create_subnets, event, ips_to_add, dn_data))
 
     # Remove subnet if either
     # - the service is not LoadBalancer
@@ -238,7 +190,7 @@ def _del_event(event, dep_dn_data):
     DELETED
     Remove the IP(s) from the EEPG subnets
     """
-    print("\tService Deleted Event")
+    log.debug("Service Deleted Event")
 
     uid = event["object"].metadata.uid
     try:
@@ -247,12 +199,8 @@ def _del_event(event, dep_dn_data):
         # we have not had an add for this so ignore it
         return
 
-    service_is_load_balancer = last_obj.spec.type == "LoadBalancer"
-    ips_to_remove = (
-        []
-        if last_obj.status.load_balancer.ingress is None
-        else last_obj.status.load_balancer.ingress
-    )
+    service_is_load_balancer = last_obj.service_type == "LoadBalancer"
+    ips_to_remove = last_obj.lb_ingress
 
     # Add Pod IP to EEPG Subnets (l3extSubnet) if not exist
     if len(ips_to_remove) > 0 and service_is_load_balancer:
@@ -262,14 +210,26 @@ def _del_event(event, dep_dn_data):
         # end deployments in scope
         for dn_data in dep_dn_data:
             # For each deployment (tenant|l3out|eepg)
-            for service in ips_to_remove:
-                delete_eepg_subnet(dn_data["tenant"], dn_data["l3out"], dn_data["epg"], service.ip)
-
-                # Remove APIC Subscription for this Subnet
-                urlpath = "/uni/tn-{}/out-{}/instP-{}/extsubnet-[{}/32]".format(
-                    dn_data["tenant"], dn_data["l3out"], dn_data["epg"], service.ip
-                )
-                unwatch_managed_object(urlpath)
+            on_eepg_worker(dn_data, partial(_delete_subnets, ips_to_remove, dn_data))
 
     # Add Pod to k8 cache
     del_k8_object(uid)
+
+
+def _create_subnets(event, ips, dn_data):
+    """
+    Create the service IP subnets in the EEPG, if the parent EEPG (l3extInstP)
+    does not exist the subnets are created from the EEPG 'created' event callback
+    """
+    name = "{}::{}".format(event["object"].metadata.namespace, event["object"].metadata.name)
+    for service_ip in ips:
+        cb_func = create_service_subnet_callback(event, dn_data)
+        create_or_defer_eepg_subnet(name, service_ip, dn_data, cb_func)
+
+
+def _delete_subnets(ips, dn_data):
+    """
+    Remove the service IP subnets and their APIC subscriptions from the EEPG
+    """
+    for service_ip in ips:
+        delete_eepg_subnet(service_ip, dn_data)
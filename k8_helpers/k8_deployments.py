@@ -1,19 +1,16 @@
 """
 """
 from kubernetes import client
+from .k8_helpers import ListPager
 
 
 def get_all_deployments():
     """
     Get all deployments
-    Returns V1DeploymentList
+    Returns ListPager of V1Deployment
     """
     _core_apps = client.AppsV1Api()
-    deployment = _core_apps.list_deployment_for_all_namespaces()
-    # TODO: Initial Sync Needs _continue and items remaining code
-    print("** Initial Sync Needs _continue and items remaining code **")
-    # V1DeploymentList
-    return deployment
+    return ListPager(_core_apps.list_deployment_for_all_namespaces)
 
 
 def get_deployment(namespace, name):
@@ -1,24 +1,37 @@
 """
 .
 """
+import os
 import json
+from time import monotonic
+from aci_logging.aci_logging import get_logger
+
+log = get_logger(__name__)
+
+# Max number of items requested per K8 list API page
+list_page_size = int(os.environ.get("K8_LIST_PAGE_SIZE", "500"))
 
 
 def print_event(event):
-    print("\n")
     try:
-        print(
-            "{:<8} {:<15} {:<10} {:<50} {:<50}".format(
-                event["type"],
-                event["object"].kind,
-                event["object"].metadata.resource_version,
-                event["object"].metadata.namespace,
-                event["object"].metadata.name,
-            )
+        metadata = event["object"].metadata
+        log.info(
+            "%-8s %-15s %-10s %-50s %s",
+            event["type"],
+            event["object"].kind,
+            metadata.resource_version,
+            metadata.namespace,
+            metadata.name,
+            extra={
+                "event_type": event["type"],
+                "kind": event["object"].kind,
+                "resource_version": metadata.resource_version,
+                "namespace": metadata.namespace,
+                "object_name": metadata.name,
+            },
         )
     except Exception as e:
-        print(event)
-        print(str(e))
+        log.error("Malformed K8 event %s: %s", event, str(e))
         raise
 
 
@@ -52,3 +65,49 @@ def extract_k8_annotation(annotations):
         )
 
     return d
+
+
+class ListPager:
+    """
+    Iterates the items of a K8 list API call, requesting one page
+    at a time with limit/_continue.
+
+    The list resource version is set once the first page is received, every
+    page is served from that same snapshot so the watchers can resume there.
+    The time spent waiting on the K8 API is accumulated in list_time.
+    """
+
+    def __init__(self, list_func, limit=None, **kwargs):
+        """
+        list_func:func K8 list API function e.g. CoreV1Api().list_pod_for_all_namespaces
+        limit:int Items per page, defaults to K8_LIST_PAGE_SIZE
+        kwargs: Passed to each list_func call e.g. label_selector
+        """
+        self._list_func = list_func
+        self._limit = limit if limit is not None else list_page_size
+        self._kwargs = kwargs
+        self.resource_version = None
+        self.list_time = 0.0
+
+    def __iter__(self):
+        for items in self.pages():
+            for item in items:
+                yield item
+
+    def pages(self):
+        """
+        Yields the list items one page (list) at a time
+        """
+        _continue = None
+        while True:
+            start = monotonic()
+            page = self._list_func(limit=self._limit, _continue=_continue, **self._kwargs)
+            self.list_time += monotonic() - start
+            if self.resource_version is None:
+                self.resource_version = page.metadata.resource_version
+
+            yield page.items
+
+            _continue = page.metadata._continue
+            if not _continue:
+                return
@@ -1,9 +1,23 @@
 """
 .
 """
+import sys
+from threading import Lock
+from kubernetes import client
 from exceptions import CachedObjectNotFoundError
+from metrics.prometheus import Gauge
+from aci_logging.aci_logging import get_logger
 
-_k8_objects = []
+log = get_logger(__name__)
+
+# K8 object cache, K8Object records keyed by UID with secondary
+# indexes of (kind, namespace, name) to UID and (kind, namespace) to UIDs.
+_k8_objects = {}
+_k8_names = {}
+_k8_namespaces = {}
+_k8_lock = Lock()
+
+Gauge("aci_sync_k8_objects", "K8 objects cached", func=lambda: len(_k8_objects))
 
 
 def add_k8_object(k8_object):
@@ -11,64 +25,196 @@ def add_k8_object(k8_object):
     .
     """
     uid = k8_object.metadata.uid
-    for i, obj in enumerate(_k8_objects):
-        if uid == obj.uid:
+    with _k8_lock:
+        obj = _k8_objects.get(uid)
+        if obj is not None:
             if k8_object.metadata.resource_version == obj.resource_version:
                 return
-            del _k8_objects[i]
-            print("\tRemoved stale K8 object with ID: {}".format(obj.uid))
+            del _k8_names[(obj.kind, obj.namespace, obj.name)]
+            log.debug("Removed stale K8 object with UID %s", obj.uid, extra={"uid": obj.uid})
 
-    _k8_objects.append(K8Object(k8_object))
-    print("\tAdded K8 object {} with UID {} to local cache".format(k8_object.kind, uid))
+        obj = K8Object(k8_object)
+        _k8_objects[uid] = obj
+        _k8_names[(obj.kind, obj.namespace, obj.name)] = uid
+        _k8_namespaces.setdefault((obj.kind, obj.namespace), set()).add(uid)
+    log.debug(
+        "Added K8 object %s with UID %s to local cache",
+        k8_object.kind,
+        uid,
+        extra={"kind": k8_object.kind, "uid": uid},
+    )
 
 
 def del_k8_object(uid):
     """
     .
     """
-    for i, obj in enumerate(_k8_objects):
-        if uid == obj.uid:
-            print("\tRemoved stale K8 object with ID: {}".format(obj.uid))
-            del _k8_objects[i]
-            return
+    with _k8_lock:
+        obj = _k8_objects.pop(uid, None)
+        if obj is not None:
+            del _k8_names[(obj.kind, obj.namespace, obj.name)]
+            uids = _k8_namespaces[(obj.kind, obj.namespace)]
+            uids.discard(uid)
+            if len(uids) == 0:
+                del _k8_namespaces[(obj.kind, obj.namespace)]
+
+    if obj is None:
+        log.debug("No K8 object with UID %s in cache to delete", uid, extra={"uid": uid})
     else:
-        print("\tNo K8 object with UID {} in cache to delete.".format(uid))
+        log.debug("Removed K8 object with UID %s from local cache", uid, extra={"uid": uid})
 
 
 def get_k8_object(uid):
     """
-    Returns the cached K8 object as { 'metadata': {...}, 'status':{...}, ... }
+    Returns the cached K8Object record for the UID
+    """
+    obj = _k8_objects.get(uid)
+    if obj is None:
+        raise CachedObjectNotFoundError("K8 object with UID {} not in cache.".format(uid))
+    return obj
+
+
+def find_k8_object(kind, namespace, name):
+    """
+    Returns the cached K8Object record for the kind/namespace/name
+
+    kind:str One of Deployment, Pod, Service
     """
-    for i, obj in enumerate(_k8_objects):
-        if uid == obj.uid:
-            return _k8_objects[i].obj
+    uid = _k8_names.get((kind, namespace, name))
+    if uid is None:
+        raise CachedObjectNotFoundError(
+            "K8 {} {}/{} not in cache.".format(kind, namespace, name)
+        )
+    return get_k8_object(uid)
+
+
+def list_k8_objects(kind):
+    """
+    Returns a list of the cached K8Object records of the kind
+
+    kind:str One of Deployment, Pod, Service
+    """
+    with _k8_lock:
+        return [obj for obj in _k8_objects.values() if obj.kind == kind]
+
+
+def find_k8_pods(namespace, selector):
+    """
+    Returns a list of the cached Pod K8Object records in the namespace
+    matching a service selector
+
+    selector:dict Labels the pods must have, e.g. { 'app': 'web' }
+    """
+    selector = selector.items()
+    with _k8_lock:
+        pods = [_k8_objects[uid] for uid in _k8_namespaces.get(("Pod", namespace), ())]
+    return [pod for pod in pods if selector <= (pod.labels or {}).items()]
+
+
+def get_k8_object_count():
+    """
+    Returns the number of cached K8 objects
+    """
+    return len(_k8_objects)
 
-    raise CachedObjectNotFoundError("K8 object with UID {} not in cache.".format(uid))
 
 class K8Object:
     """
+    Compact record of a K8 object, holding only the fields read by the
+    event handlers rather than the full kubernetes client model.
+
     Objects/Kind:
         Deployment
         Pod
         Service
     """
 
+    __slots__ = (
+        "kind",
+        "uid",
+        "namespace",
+        "name",
+        "resource_version",
+        "annotations",
+        "labels",
+        "owner_references",
+        "pod_ip",
+        "lb_ingress",
+        "selector",
+        "service_type",
+    )
+
     def __init__(self, obj):
-        """ """
-        self._object = obj
+        """
+        obj: kubernetes client model, V1Deployment, V1Pod or V1Service
+        """
+        metadata = obj.metadata
+        self.kind = sys.intern(obj.kind)
+        self.uid = metadata.uid
+        self.namespace = sys.intern(metadata.namespace)
+        self.name = metadata.name
+        self.resource_version = metadata.resource_version
+
+        # only the haystacknetworks.com annotations are ever read
+        annotations = {
+            k: v for k, v in (metadata.annotations or {}).items() if "haystacknetworks.com" in k
+        }
+        self.annotations = annotations or None
+        self.labels = None
+
+        # (kind, name, uid)
+        self.owner_references = tuple(
+            (sys.intern(ref.kind), ref.name, ref.uid) for ref in (metadata.owner_references or [])
+        )
+
+        self.pod_ip = None
+        self.lb_ingress = ()
+        self.selector = None
+        self.service_type = None
+
+        if self.kind == "Pod":
+            self.pod_ip = obj.status.pod_ip if obj.status is not None else None
+            self.labels = metadata.labels
+
+        elif self.kind == "Service":
+            self.selector = obj.spec.selector
+            self.service_type = sys.intern(obj.spec.type)
+            ingress = obj.status.load_balancer.ingress if obj.status.load_balancer else None
+            self.lb_ingress = tuple(i.ip for i in (ingress or []) if i.ip is not None)
 
-    @property
-    def kind(self):
-        return self._object.kind
+    def to_k8_model(self):
+        """
+        Rebuilds a kubernetes client model holding the recorded fields, used to
+        synthesize watch events for objects no longer returned by the K8 API.
+        """
+        metadata = client.V1ObjectMeta(
+            uid=self.uid,
+            namespace=self.namespace,
+            name=self.name,
+            resource_version=self.resource_version,
+            annotations=dict(self.annotations or {}),
+            labels=self.labels,
+            # only the owner kind/name/uid are recorded
+            owner_references=[
+                client.V1OwnerReference(api_version="apps/v1", kind=kind, name=name, uid=uid)
+                for kind, name, uid in self.owner_references
+            ],
+        )
 
-    @property
-    def uid(self):
-        return self._object.metadata.uid
+        if self.kind == "Pod":
+            return client.V1Pod(
+                kind=self.kind, metadata=metadata, status=client.V1PodStatus(pod_ip=self.pod_ip)
+            )
 
-    @property
-    def resource_version(self):
-        return self._object.metadata.resource_version
+        if self.kind == "Service":
+            ingress = [client.V1LoadBalancerIngress(ip=ip) for ip in self.lb_ingress]
+            return client.V1Service(
+                kind=self.kind,
+                metadata=metadata,
+                spec=client.V1ServiceSpec(selector=self.selector, type=self.service_type),
+                status=client.V1ServiceStatus(
+                    load_balancer=client.V1LoadBalancerStatus(ingress=ingress or None)
+                ),
+            )
 
-    @property
-    def obj(self):
-        return self._object
+        return client.V1Deployment(kind=self.kind, metadata=metadata)
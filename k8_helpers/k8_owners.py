@@ -0,0 +1,117 @@
+"""
+Local informer cache of ReplicaSet and Deployment ownership.
+
+Resolves a Pod's owning Deployment with dict lookups, the index is
+kept current by the OwnerIndexWatcher threads.
+"""
+from threading import Lock
+from kubernetes import client
+from .k8_object import K8Object
+from .k8_helpers import ListPager
+from capture.event_capture import capture_k8_event
+
+# (namespace, replicaset name) -> owning deployment name, None if not owned by a deployment
+_replicaset_owners = {}
+# (namespace, deployment name) -> K8Object
+_deployments = {}
+_owners_lock = Lock()
+
+
+def sync_owner_index():
+    """
+    Loads all ReplicaSets and Deployments into the owner index.
+
+    Returns (replicaset resource version, deployment resource version) for
+    the OwnerIndexWatcher's to start at.
+    """
+    print("Syncing ReplicaSet/Deployment owner index")
+    rs_rv = resync_owner_index("ReplicaSet")
+    dep_rv = resync_owner_index("Deployment")
+
+    print(
+        "Owner index holds {} ReplicaSets and {} Deployments".format(
+            len(_replicaset_owners), len(_deployments)
+        )
+    )
+    return rs_rv, dep_rv
+
+
+def resync_owner_index(kind):
+    """
+    Loads all ReplicaSets or Deployments into the owner index, dropping
+    the indexed objects that are no longer listed.
+
+    kind:str One of ReplicaSet, Deployment
+    Returns the list resource version
+    """
+    _core_apps = client.AppsV1Api()
+    if kind == "ReplicaSet":
+        k8_list = ListPager(_core_apps.list_replica_set_for_all_namespaces)
+        apply_func, index = apply_replicaset_event, _replicaset_owners
+    else:
+        k8_list = ListPager(_core_apps.list_deployment_for_all_namespaces)
+        apply_func, index = apply_deployment_event, _deployments
+
+    listed = set()
+    for obj in k8_list:
+        apply_func({"type": "ADDED", "object": obj})
+        listed.add((obj.metadata.namespace, obj.metadata.name))
+
+    with _owners_lock:
+        for key in [key for key in index if key not in listed]:
+            del index[key]
+    return k8_list.resource_version
+
+
+def apply_replicaset_event(event):
+    """
+    Update the owner index from a ReplicaSet watch event
+    """
+    rs = event["object"]
+    rs.kind = "ReplicaSet"
+    capture_k8_event("OWNER", event)
+    key = (rs.metadata.namespace, rs.metadata.name)
+    with _owners_lock:
+        if event["type"] == "DELETED":
+            _replicaset_owners.pop(key, None)
+            return
+
+        owner = None
+        for ref in rs.metadata.owner_references or []:
+            if ref.kind == "Deployment":
+                owner = ref.name
+        _replicaset_owners[key] = owner
+
+
+def apply_deployment_event(event):
+    """
+    Update the owner index from a Deployment watch event
+    """
+    dep = event["object"]
+    # list items do not carry the kind
+    dep.kind = "Deployment"
+    capture_k8_event("OWNER", event)
+    key = (dep.metadata.namespace, dep.metadata.name)
+    with _owners_lock:
+        if event["type"] == "DELETED":
+            _deployments.pop(key, None)
+            return
+
+        _deployments[key] = K8Object(dep)
+
+
+def get_replicaset_owner(namespace, name):
+    """
+    Returns (found, deployment name) for the ReplicaSet, the deployment
+    name is None when the ReplicaSet is not owned by a Deployment.
+    """
+    key = (namespace, name)
+    with _owners_lock:
+        return key in _replicaset_owners, _replicaset_owners.get(key)
+
+
+def get_indexed_deployment(namespace, name):
+    """
+    Returns the indexed Deployment K8Object or None
+    """
+    return _deployments.get((namespace, name))
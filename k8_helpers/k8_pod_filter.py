@@ -0,0 +1,261 @@
+"""
+Pod list/watch filters, narrowing the pod stream on the K8 API server.
+
+A filter describes one class of synced deployments as the namespaces
+they run in plus label and field selectors for their pods. If the API
+server rejects a selector, the watcher streams the unfiltered pods and
+applies the filter client side.
+"""
+import os
+import json
+import re
+from kubernetes import client
+from kubernetes.client import exceptions
+from .k8_helpers import ListPager
+
+# Default field selector, none so every pod is synced. A pod a selector excludes is
+# no longer managed and the reconciler deletes its subnet. To drop the completed
+# pods and kube-system set K8_POD_FIELD_SELECTOR, see the README.
+default_field_selector = ""
+# PodFilter's shared by the startup sync and the pod watchers
+_pod_filters = None
+
+
+class PodFilter:
+    """
+    Namespaces, label selector and field selector for one class of deployments
+    """
+
+    def __init__(self, namespaces=None, label_selector="", field_selector=None):
+        """
+        namespaces:list Namespaces to watch, None or empty for all namespaces
+        label_selector:str K8 label selector e.g. 'app in (web,api),tier=frontend'
+        field_selector:str K8 field selector, only metadata.namespace and status.phase
+            are applied client side
+        """
+        self.namespaces = list(namespaces or [])
+        self.label_selector = label_selector or ""
+        if field_selector is None:
+            field_selector = default_field_selector
+        self.field_selector = field_selector
+        self._labels = _parse_selector(self.label_selector)
+        self._fields = _parse_selector(self.field_selector)
+        # cleared when the API server rejects the selectors
+        self.server_side = True
+
+    def __repr__(self):
+        return "PodFilter(namespaces={}, label_selector='{}', field_selector='{}')".format(
+            self.namespaces or "all", self.label_selector, self.field_selector
+        )
+
+    def selector_kwargs(self):
+        """
+        Returns the list/watch API kwargs for the server side filter
+        """
+        kwargs = {}
+        if not self.server_side:
+            return kwargs
+        if self.label_selector:
+            kwargs["label_selector"] = self.label_selector
+        if self.field_selector:
+            kwargs["field_selector"] = self.field_selector
+        return kwargs
+
+    def list_func(self, namespace=None):
+        """
+        Returns (list function, kwargs) for all namespaces or a single namespace
+        """
+        _core_api = client.CoreV1Api()
+        if namespace is None:
+            return _core_api.list_pod_for_all_namespaces, {}
+        return _core_api.list_namespaced_pod, {"namespace": namespace}
+
+    def rejected(self, e):
+        """
+        Checks an ApiException from a list/watch call, if the API server rejected
+        the selectors fall back to client side filtering.
+        Returns True if the call should be retried.
+        """
+        if self.server_side and e.status in (400, 422):
+            print(
+                "K8 API server rejected pod selectors for {}, filtering client side: {}".format(
+                    self, e.reason
+                )
+            )
+            self.server_side = False
+            return True
+        return False
+
+    def matches(self, pod):
+        """
+        Client side filter, True if the pod matches this filter
+        """
+        if not self.in_scope(pod.metadata.namespace, pod.metadata.labels):
+            return False
+
+        fields = {
+            "metadata.namespace": pod.metadata.namespace,
+            "metadata.name": pod.metadata.name,
+            "status.phase": pod.status.phase if pod.status is not None else None,
+        }
+        return _match(self._fields, fields)
+
+    def in_scope(self, namespace, labels):
+        """
+        True if the namespace and labels match this filter, the field selector is not applied
+        """
+        if self.namespaces and namespace not in self.namespaces:
+            return False
+        return _match(self._labels, labels or {})
+
+
+def get_pod_filters():
+    """
+    Returns the list of PodFilter's from the environment.
+
+    K8_POD_WATCH_FILTERS is a JSON list, one object per deployment class:
+        [{"namespaces": ["web"], "label_selector": "tier=frontend", "field_selector": "..."}]
+    otherwise a single filter is built from K8_POD_NAMESPACES (comma separated),
+    K8_POD_LABEL_SELECTOR and K8_POD_FIELD_SELECTOR.
+
+    Filters should not overlap, a pod leaving one filter's watch is
+    deleted even if another filter still matches it.
+    """
+    global _pod_filters
+    if _pod_filters is not None:
+        return _pod_filters
+
+    filters = os.environ.get("K8_POD_WATCH_FILTERS")
+    if filters:
+        _pod_filters = [PodFilter(**f) for f in json.loads(filters)]
+    else:
+        namespaces = [ns for ns in os.environ.get("K8_POD_NAMESPACES", "").split(",") if ns]
+        _pod_filters = [
+            PodFilter(
+                namespaces,
+                os.environ.get("K8_POD_LABEL_SELECTOR", ""),
+                os.environ.get("K8_POD_FIELD_SELECTOR"),
+            )
+        ]
+    return _pod_filters
+
+
+_requirement_re = re.compile(
+    r"^\s*(!?)\s*([\w./-]+)\s*(?:(==|!=|=)\s*([\w./-]*)|\s+(in|notin)\s*\(([^)]*)\))?\s*$"
+)
+
+
+def _parse_selector(selector):
+    """
+    Parse a K8 label/field selector into (key, operator, values) requirements.
+    Operators: =, !=, in, notin, exists, !exists
+    """
+    requirements = []
+    # split on commas outside of the (a,b) value sets
+    for requirement in re.split(r",(?![^(]*\))", selector):
+        if not requirement.strip():
+            continue
+        match = _requirement_re.match(requirement)
+        if match is None:
+            raise ValueError("Invalid selector requirement '{}'".format(requirement))
+        negate, key, op, value, set_op, set_values = match.groups()
+        if op is not None:
+            requirements.append((key, "!=" if op == "!=" else "=", {value}))
+        elif set_op is not None:
+            values = {v.strip() for v in set_values.split(",")}
+            requirements.append((key, set_op, values))
+        else:
+            requirements.append((key, "!exists" if negate else "exists", set()))
+    return requirements
+
+
+def _match(requirements, values):
+    """
+    True if the values dict satisfies every requirement
+    """
+    for key, op, wanted in requirements:
+        value = values.get(key)
+        if op == "=" and value not in wanted:
+            return False
+        if op == "!=" and value in wanted:
+            return False
+        if op == "in" and value not in wanted:
+            return False
+        if op == "notin" and value in wanted:
+            return False
+        if op == "exists" and key not in values:
+            return False
+        if op == "!exists" and key in values:
+            return False
+    return True
+
+
+class PodListPager:
+    """
+    Lists the pods of every PodFilter and namespace, the same interface
+    as ListPager. Pods matched by more than one filter are listed once.
+    """
+
+    def __init__(self, pod_filters, namespace=None):
+        """
+        pod_filters:list PodFilter's, see get_pod_filters()
+        namespace:str Only list this namespace of the filters, None for every filter namespace
+        """
+        self._pod_filters = pod_filters
+        self._namespace = namespace
+        self._resource_versions = []
+        self.list_time = 0.0
+
+    @property
+    def resource_version(self):
+        """
+        The oldest list resource version, the K8 resource versions are cluster
+        wide so every pod watcher can start there. Events between the list
+        snapshots are replayed to the later lists watchers, which is harmless.
+        """
+        if not self._resource_versions:
+            return None
+        try:
+            return min(self._resource_versions, key=int)
+        except ValueError:
+            return self._resource_versions[0]
+
+    def __iter__(self):
+        for items in self.pages():
+            for item in items:
+                yield item
+
+    def pages(self):
+        """
+        Yields the matching pods one page (list) at a time
+        """
+        seen = set()
+        for pod_filter in self._pod_filters:
+            namespaces = pod_filter.namespaces or [None]
+            if self._namespace is not None:
+                namespaces = [self._namespace]
+            for namespace in namespaces:
+                for page in self._filter_pages(pod_filter, namespace):
+                    page = [pod for pod in page if pod.metadata.uid not in seen]
+                    seen.update(pod.metadata.uid for pod in page)
+                    yield page
+
+    def _filter_pages(self, pod_filter, namespace):
+        while True:
+            list_func, kwargs = pod_filter.list_func(namespace)
+            kwargs.update(pod_filter.selector_kwargs())
+            pager = ListPager(list_func, **kwargs)
+            try:
+                for page in pager.pages():
+                    if not pod_filter.server_side:
+                        page = [pod for pod in page if pod_filter.matches(pod)]
+                    yield page
+            except exceptions.ApiException as e:
+                # only the first page can be rejected, nothing was yielded yet
+                if pager.resource_version is None and pod_filter.rejected(e):
+                    continue
+                raise
+            finally:
+                self.list_time += pager.list_time
+            self._resource_versions.append(pager.resource_version)
+            return
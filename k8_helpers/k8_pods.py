@@ -4,15 +4,24 @@
 from kubernetes import client
 from .k8_deployments import get_deployment
 from .k8_replicasets import get_replicaset
+from .k8_owners import get_replicaset_owner, get_indexed_deployment
+from .k8_owners import apply_replicaset_event, apply_deployment_event
+from .k8_pod_filter import PodListPager, get_pod_filters
+from tracing.tracing import traced
 
 
+@traced
 def get_pod_deployment(pod):
     """
     Get the deployment associated with a pod only if 'haystacknetworks.com' annotation exists
-    Returns 'object'
+    Returns the Deployment K8Object or None
+
+    The owner index is used first, the K8 API is only called when the
+    ReplicaSet or Deployment has not reached the index yet.
     """
     namespace = pod.metadata.namespace
-    parent_uid = pod.metadata.owner_references[0].uid
+    if not pod.metadata.owner_references:
+        return None
     parent_kind = pod.metadata.owner_references[0].kind
     parent_name = pod.metadata.owner_references[0].name
 
@@ -21,21 +30,34 @@ def get_pod_deployment(pod):
     #
 
     if parent_kind == "ReplicaSet":
-        # get the replicaset object with uid: parent_uid or name: parent_name
-        rs = get_replicaset(namespace, parent_name)
-        if rs is None:
-            # presumably it been deleted as this is probably a MODIFIED event.
-            # TODO: Better MSG
-            print("**DOES NOT EXIST - MODIFIED EVENT AFTER DEPLOY DELETE EVENT ?**")
+        found, dep_name = get_replicaset_owner(namespace, parent_name)
+        if not found:
+            # get the replicaset object with name: parent_name
+            rs = get_replicaset(namespace, parent_name)
+            if rs is None:
+                # presumably it been deleted as this is probably a MODIFIED event.
+                # TODO: Better MSG
+                print("**DOES NOT EXIST - MODIFIED EVENT AFTER DEPLOY DELETE EVENT ?**")
+                return None
+            apply_replicaset_event({"type": "ADDED", "object": rs})
+            found, dep_name = get_replicaset_owner(namespace, parent_name)
+
+        if dep_name is None:
             return None
 
-        dep = get_deployment(namespace, rs.metadata.owner_references[0].name)
+        dep = get_indexed_deployment(namespace, dep_name)
+        if dep is None:
+            try:
+                apply_deployment_event(
+                    {"type": "ADDED", "object": get_deployment(namespace, dep_name)}
+                )
+            except IndexError as e:
+                # deployment deleted
+                return None
+            dep = get_indexed_deployment(namespace, dep_name)
 
-        haystack_annotations = {}
-        for k in dep.metadata.annotations.keys():
-            if "haystacknetworks.com" in k:
-                haystack_annotations[k] = dep.metadata.annotations[k]
-                return dep
+        if dep.annotations is not None:
+            return dep
         else:
             return None
     else:
@@ -46,16 +68,25 @@ def get_pod_deployment(pod):
         )
 
 
+def get_cached_pod_deployment(pod):
+    """
+    Returns the Deployment K8Object of a cached Pod K8Object from the owner index, or None
+    """
+    for kind, name, uid in pod.owner_references:
+        if kind != "ReplicaSet":
+            continue
+        found, dep_name = get_replicaset_owner(pod.namespace, name)
+        if dep_name is not None:
+            return get_indexed_deployment(pod.namespace, dep_name)
+    return None
+
+
 def get_all_pods():
     """
-    Get All K8 Pods
-    Returns V1PodList
+    Get All K8 Pods matching the pod watch filters (K8_POD_* environment)
+    Returns PodListPager of V1Pod
     """
-    _core_api = client.CoreV1Api()
-    pods = _core_api.list_pod_for_all_namespaces()
-    # print("Pod List Meta", "\n", pods.metadata, "\n")
-    # V1PodList
-    return pods
+    return PodListPager(get_pod_filters())
 
 
 def get_pods(namespace, label):
@@ -2,13 +2,13 @@
 .
 """
 from kubernetes import client
+from .k8_helpers import ListPager
+
 
 def get_all_services():
     """
     Get K8 Services
-    Returns V1ServiceList
+    Returns ListPager of V1Service
     """
     _core_api = client.CoreV1Api()
-    services = _core_api.list_service_for_all_namespaces()
-    # V1ServiceList
-    return services
+    return ListPager(_core_api.list_service_for_all_namespaces)
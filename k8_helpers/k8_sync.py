@@ -1,46 +1,208 @@
 """
 """
+import os
+import traceback
+from time import monotonic
+from threading import Thread, Event, Lock, BoundedSemaphore
+from concurrent.futures import ThreadPoolExecutor, wait
 
 from k8_helpers.k8_deployments import get_all_deployments
-from k8_helpers.k8_pods import get_all_pods
+from k8_helpers.k8_pods import get_all_pods, get_pod_deployment
 from k8_helpers.k8_services import get_all_services
 
 from k8_events.k8_events_deployment import event_deployment
 from k8_events.k8_events_pod import event_pod
 from k8_events.k8_events_service import event_service
+from k8_events.k8_events_helpers import subnet_batch
+from capture.event_capture import capture_k8_event
+
+# Number of worker threads reconciling K8 objects with the APIC in sync_all()
+sync_workers = int(os.environ.get("K8_SYNC_WORKERS", "8"))
 
 
 def sync_deployments():
     """ """
     print("Syncing Deployments")
+    # events are handled as each page arrives
     dep_list = get_all_deployments()
-    resource_version = dep_list.metadata.resource_version
-    for dep in dep_list.items:
+    for dep in dep_list:
         dep.kind = "Deployment"
         event_deployment({"type": "ADDED", "object": dep})
-    # print('Deployment Resource Version: ', resource_version)
-    return resource_version
+    # print('Deployment Resource Version: ', dep_list.resource_version)
+    return dep_list.resource_version
 
 
 def sync_pods():
     """ """
     print("Syncing Pods")
     pod_list = get_all_pods()
-    resource_version = pod_list.metadata.resource_version
-    for pod in pod_list.items:
-        pod.kind = "Pod"
-        event_pod({"type": "ADDED", "object": pod})
-    # print('Pods Resource Version: ', resource_version)
-    return resource_version
+    # APIC subnets are created in bulk, one transaction per EEPG
+    with subnet_batch():
+        for pod in pod_list:
+            pod.kind = "Pod"
+            event_pod({"type": "ADDED", "object": pod})
+    # print('Pods Resource Version: ', pod_list.resource_version)
+    return pod_list.resource_version
 
 
 def sync_services():
     """ """
     print("Syncing Services")
     service_list = get_all_services()
-    resource_version = service_list.metadata.resource_version
-    for service in service_list.items:
-        service.kind = "Service"
-        event_service({"type": "ADDED", "object": service})
-    # print('Services Resource Version: ', resource_version)
-    return resource_version
+    with subnet_batch():
+        for service in service_list:
+            service.kind = "Service"
+            event_service({"type": "ADDED", "object": service})
+    # print('Services Resource Version: ', service_list.resource_version)
+    return service_list.resource_version
+
+
+def sync_all():
+    """
+    Concurrent startup sync of deployments, pods and services.
+
+    The three K8 lists run concurrently and the APIC reconciliation of the
+    listed objects is fanned out over a pool of K8_SYNC_WORKERS threads.
+    Pods are reconciled in per deployment groups only once that deployment's
+    EEPG has been handled, services once every deployment and pod has been
+    handled as they are resolved against the cached pods.
+
+    Returns (deployment, pod, service) resource versions for the watchers
+    """
+    print("Syncing Deployments, Pods and Services with {} workers".format(sync_workers))
+    sync = _ConcurrentSync(sync_workers)
+    return sync.run()
+
+
+class _ConcurrentSync:
+    """
+    State for a single sync_all() run
+    """
+
+    def __init__(self, workers):
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        # bounds the tasks (and listed objects) held in memory at once
+        self._slots = BoundedSemaphore(workers * 4)
+        self._dep_futures = {}
+        self._deps_listed = Event()
+        self._pod_futures = []
+        self._pods_listed = Event()
+        self._futures = []
+        self._lock = Lock()
+        self._handler_time = {"Deployment": 0.0, "Pod": 0.0, "Service": 0.0}
+        self._list_time = {}
+        self._counts = {"Deployment": 0, "Pod": 0, "Service": 0}
+        self._resource_versions = {}
+
+    def run(self):
+        start = monotonic()
+        threads = [
+            Thread(target=self._list, args=("Deployment", get_all_deployments(), self._deployments)),
+            Thread(target=self._list, args=("Pod", get_all_pods(), self._pods)),
+            Thread(target=self._list, args=("Service", get_all_services(), self._services)),
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        list_done = monotonic()
+
+        wait(self._futures)
+        self._pool.shutdown()
+        end = monotonic()
+
+        self._print_timings(end - start, list_done - start)
+        return (
+            self._resource_versions["Deployment"],
+            self._resource_versions["Pod"],
+            self._resource_versions["Service"],
+        )
+
+    def _list(self, kind, k8_list, submit_page):
+        """
+        List thread, submits reconciliation tasks a page at a time
+        """
+        try:
+            for page in k8_list.pages():
+                for obj in page:
+                    obj.kind = kind
+                    capture_k8_event("SYNC", {"type": "ADDED", "object": obj})
+                self._counts[kind] += len(page)
+                submit_page(page)
+        except Exception as e:
+            print("Unhandled error listing K8 {} objects: {}".format(kind, str(e)))
+            print(traceback.format_exc())
+            raise
+        finally:
+            if kind == "Deployment":
+                self._deps_listed.set()
+            elif kind == "Pod":
+                self._pods_listed.set()
+            self._resource_versions[kind] = k8_list.resource_version
+            self._list_time[kind] = k8_list.list_time
+
+    def _deployments(self, page):
+        for dep in page:
+            key = (dep.metadata.namespace, dep.metadata.name)
+            self._dep_futures[key] = self._submit("Deployment", event_deployment, [dep])
+
+    def _pods(self, page):
+        # every deployment task must be queued before any pod task may wait on one
+        self._deps_listed.wait()
+
+        groups = {}
+        for pod in page:
+            dep = get_pod_deployment(pod)
+            if dep is None:
+                # not part of a managed deployment
+                continue
+            groups.setdefault((dep.namespace, dep.name), []).append(pod)
+
+        for key, pods in groups.items():
+            future = self._submit("Pod", event_pod, pods, self._dep_futures.get(key))
+            self._pod_futures.append(future)
+
+    def _services(self, page):
+        # services select from the cached pods, so every pod must be handled first
+        self._pods_listed.wait()
+        wait(list(self._dep_futures.values()) + self._pod_futures)
+        self._submit("Service", event_service, page)
+
+    def _submit(self, kind, handler, objects, wait_for=None):
+        self._slots.acquire()
+        future = self._pool.submit(self._reconcile, kind, handler, objects, wait_for)
+        future.add_done_callback(lambda f: self._slots.release())
+        with self._lock:
+            self._futures.append(future)
+        return future
+
+    def _reconcile(self, kind, handler, objects, wait_for):
+        """
+        Worker task, runs the ADDED handler for each object with the
+        APIC subnets created in bulk
+        """
+        if wait_for is not None:
+            wait([wait_for])
+
+        start = monotonic()
+        with subnet_batch():
+            for obj in objects:
+                try:
+                    handler({"type": "ADDED", "object": obj})
+                except Exception as e:
+                    print("Unhandled error syncing K8 {}: {}".format(kind, str(e)))
+                    print(traceback.format_exc())
+        with self._lock:
+            self._handler_time[kind] += monotonic() - start
+
+    def _print_timings(self, total, listing):
+        print("K8 Sync completed in {:.2f}s, lists completed after {:.2f}s".format(total, listing))
+        for kind in ["Deployment", "Pod", "Service"]:
+            print(
+                "\t{:<12} objects: {:<8} list: {:>8.2f}s reconcile (worker time): {:>8.2f}s".format(
+                    kind,
+                    self._counts[kind],
+                    self._list_time.get(kind, 0.0),
+                    self._handler_time[kind],
+                )
+            )
@@ -0,0 +1,230 @@
+"""
+Base K8 watcher thread, bookmark aware with 410 Gone recovery.
+"""
+import traceback
+from time import sleep
+from threading import Thread
+from kubernetes import watch
+from kubernetes.client import exceptions
+from k8_helpers.k8_object import list_k8_objects
+
+# Seconds to wait before reconnecting a failed watch, doubled on each failure
+watch_backoff_min = 1
+watch_backoff_max = 60
+
+
+class K8Watcher(Thread):
+    """
+    Streams a K8 watch from a resource version, passing each event to _handle.
+
+    Watch bookmarks keep the resource version current while the watched objects
+    are quiet. When the resource version has expired (410 Gone) _recover relists
+    and the watch resumes from the list resource version. Failed watches are
+    reconnected with exponential backoff.
+    """
+
+    def __init__(self, name, resource_version):
+        """
+        name:str Watcher name for the log messages
+        resource_version:str The resource version returned by the startup sync
+        """
+        Thread.__init__(self)
+        self._name = name
+        self._resource_version = resource_version
+        self._watcher = watch.Watch()
+
+        self._log("Init {} Instance".format(name))
+
+    def _start_thread(self):
+        """
+        Starts the thread up.
+        """
+        Thread.daemon = False  # do not terminate abruptly
+
+        self._log("Starting {} Thread.".format(self._name))
+        self.start()
+
+    def _stream_args(self):
+        """
+        Returns (list function, kwargs) to watch
+        """
+        raise NotImplementedError
+
+    def _handle(self, event):
+        """
+        Handle a single watch event
+        """
+        raise NotImplementedError
+
+    def _recover(self):
+        """
+        Relist after a 410 Gone, returns the list resource version
+        """
+        raise NotImplementedError
+
+    def run(self):
+        """ """
+        backoff = watch_backoff_min
+        while True:
+
+            try:
+                list_func, kwargs = self._stream_args()
+                events = self._watcher.stream(
+                    list_func,
+                    resource_version=self._resource_version,
+                    allow_watch_bookmarks=True,
+                    **kwargs
+                )
+                for event in events:
+                    backoff = watch_backoff_min
+                    # BOOKMARK and ERROR objects are not deserialized, only the raw dict
+                    if event["type"] == "BOOKMARK":
+                        self._resource_version = event["raw_object"]["metadata"][
+                            "resourceVersion"
+                        ]
+                        continue
+                    if event["type"] == "ERROR":
+                        status = event["raw_object"]
+                        raise exceptions.ApiException(
+                            status=status.get("code"), reason=status.get("message")
+                        )
+                    self._resource_version = event["object"].metadata.resource_version
+                    self._handle(event)
+                continue
+
+            except exceptions.ApiException as e:
+                if e.status == 410:
+                    print(
+                        "K8 {} resource version {} expired, relisting".format(
+                            self._name, self._resource_version
+                        )
+                    )
+                    if self._try_recover():
+                        backoff = watch_backoff_min
+                        continue
+                elif not self._retry(e):
+                    print("K8 Exception: {} Error: {}".format(self._name, str(e)))
+
+            except Exception as e:
+                # dedicated thread so ensure we send any unhandled
+                # errors to stdout
+                print("Unhandled error in K8 {} thread: {}".format(self._name, str(e)))
+                print(traceback.format_exc())
+
+            print("K8 {} reconnecting in {}s".format(self._name, backoff))
+            sleep(backoff)
+            backoff = min(backoff * 2, watch_backoff_max)
+
+    def _try_recover(self):
+        """
+        Returns True if the relist succeeded
+        """
+        try:
+            self._resource_version = self._recover()
+            return True
+        except Exception as e:
+            print("K8 {} relist failed: {}".format(self._name, str(e)))
+            print(traceback.format_exc())
+            return False
+
+    def _retry(self, e):
+        """
+        Returns True if the ApiException was handled and the watch can be retried
+        """
+        return False
+
+    def _log(self, msg):
+        print(msg)
+
+
+class K8EventWatcher(K8Watcher):
+    """
+    Watches Deployments, Pods or Services, putting the events on the out queue.
+
+    On 410 Gone the objects are relisted and diffed against the local K8 object
+    cache, only the delta is put on the out queue: DELETED for cached objects
+    no longer listed, MODIFIED for cached objects with a new resource version
+    and ADDED for new objects changed since the watch fell behind.
+    """
+
+    def __init__(self, kind, inQ, outQ, outQLock, resource_version):
+        """
+        kind:str One of Deployment, Pod, Service
+        """
+        K8Watcher.__init__(self, "{}Watcher".format(kind), resource_version)
+        self._kind = kind
+        self._inQ = inQ
+        self._outQ = outQ
+        self._outQLock = outQLock
+
+    def _handle(self, event):
+        self._put(event)
+
+    def _put(self, event):
+        self._outQLock.acquire()
+        self._outQ.put(event)
+        self._outQLock.release()
+
+    def _relist(self):
+        """
+        Returns a ListPager of the currently watched objects
+        """
+        raise NotImplementedError
+
+    def _in_scope(self, k8_object):
+        """
+        True if the cached K8Object is covered by this watcher
+        """
+        return True
+
+    def _recover(self):
+        since = self._resource_version
+        k8_list = self._relist()
+
+        listed = {}
+        for page in k8_list.pages():
+            for obj in page:
+                obj.kind = self._kind
+                listed[obj.metadata.uid] = obj
+
+        cached_rvs = {}
+        deleted = modified = added = 0
+        events = []
+        # deletes first, a listed object may have reused a deleted object's IP
+        for cached in list_k8_objects(self._kind):
+            cached_rvs[cached.uid] = cached.resource_version
+            if cached.uid not in listed and self._in_scope(cached):
+                events.append({"type": "DELETED", "object": cached.to_k8_model()})
+                deleted += 1
+
+        for uid, obj in listed.items():
+            rv = obj.metadata.resource_version
+            if uid in cached_rvs:
+                if cached_rvs[uid] != rv:
+                    events.append({"type": "MODIFIED", "object": obj})
+                    modified += 1
+            elif _newer(rv, since):
+                events.append({"type": "ADDED", "object": obj})
+                added += 1
+
+        # the relisted objects are already filtered
+        for event in events:
+            self._put(event)
+
+        print(
+            "K8 {} relisted {} objects, replaying {} DELETED, {} MODIFIED, {} ADDED".format(
+                self._name, len(listed), deleted, modified, added
+            )
+        )
+        return k8_list.resource_version
+
+
+def _newer(resource_version, since):
+    """
+    True if the resource version is newer than since. Resource versions are
+    opaque, if either is not an integer the object is treated as newer.
+    """
+    try:
+        return int(resource_version) > int(since)
+    except (TypeError, ValueError):
+        return True
@@ -0,0 +1,41 @@
+"""
+"""
+from kubernetes import client
+from k8_helpers.k8_owners import apply_replicaset_event, apply_deployment_event
+from k8_helpers.k8_owners import resync_owner_index
+from .k8_watcher import K8Watcher
+
+
+class OwnerIndexWatcher(K8Watcher):
+    """
+    Watches ReplicaSets or Deployments and applies the events
+    to the local owner index (k8_helpers.k8_owners)
+    """
+
+    def __init__(self, kind, resource_version):
+        """
+        kind:str One of ReplicaSet, Deployment
+        resource_version:str The resource version returned by sync_owner_index
+        """
+        K8Watcher.__init__(self, "OwnerIndexWatcher {}".format(kind), resource_version)
+        assert kind in ["ReplicaSet", "Deployment"]
+        self._kind = kind
+
+        self._core_apps = client.AppsV1Api()
+        if kind == "ReplicaSet":
+            self._list_func = self._core_apps.list_replica_set_for_all_namespaces
+            self._apply_func = apply_replicaset_event
+        else:
+            self._list_func = self._core_apps.list_deployment_for_all_namespaces
+            self._apply_func = apply_deployment_event
+
+        self._start_thread()
+
+    def _stream_args(self):
+        return self._list_func, {}
+
+    def _handle(self, event):
+        self._apply_func(event)
+
+    def _recover(self):
+        return resync_owner_index(self._kind)
@@ -1,60 +1,78 @@
 """
 """
-import traceback
-from threading import Thread
-from kubernetes import client, watch
-from kubernetes.client import exceptions
+from kubernetes import client
+from k8_helpers.k8_object import get_k8_object
+from k8_helpers.k8_pod_filter import PodListPager, get_pod_filters
+from k8_helpers.k8_pods import get_all_pods
+from exceptions import CachedObjectNotFoundError
+from .k8_watcher import K8EventWatcher
 
 
-class PodWatcher(Thread):
-    """ """
+class PodWatcher(K8EventWatcher):
+    """
+    Watches the pods of a PodFilter, in one namespace or all namespaces
+    """
 
-    def __init__(self, inQ, outQ, outQLock, resource_version):
-        Thread.__init__(self)
-        self._inQ = inQ
-        self._outQ = outQ
-        self._outQLock = outQLock
-        self._resource_version = resource_version
+    def __init__(self, inQ, outQ, outQLock, resource_version, pod_filter=None, namespace=None):
+        """
+        pod_filter:PodFilter The server side (or client side fallback) pod filter
+        namespace:str Namespace to watch, None for all namespaces
+        """
+        K8EventWatcher.__init__(self, "Pod", inQ, outQ, outQLock, resource_version)
+        self._pod_filter = pod_filter
+        self._namespace = namespace
 
         self._core_api = client.CoreV1Api()
         self._core_apps = client.AppsV1Api()
-        self._watcher = watch.Watch()
 
-        self._log("Init PodWatcher Instance")
+        self._log("PodWatcher namespace: {} {}".format(namespace, pod_filter))
         self._start_thread()
 
-    def _start_thread(self):
+    def _stream_args(self):
+        if self._pod_filter is None:
+            return self._core_api.list_pod_for_all_namespaces, {}
+        list_func, kwargs = self._pod_filter.list_func(self._namespace)
+        kwargs.update(self._pod_filter.selector_kwargs())
+        return list_func, kwargs
+
+    def _retry(self, e):
+        return self._pod_filter is not None and self._pod_filter.rejected(e)
+
+    def _handle(self, event):
+        event = self._filter(event)
+        if event is not None:
+            self._put(event)
+
+    def _relist(self):
+        if self._pod_filter is None:
+            return get_all_pods()
+        return PodListPager([self._pod_filter], self._namespace)
+
+    def _in_scope(self, k8_object):
+        if self._namespace is not None and k8_object.namespace != self._namespace:
+            return False
+        if self._pod_filter is None:
+            return True
+        return self._pod_filter.in_scope(k8_object.namespace, k8_object.labels)
+
+    def _filter(self, event):
         """
-        Starts the thread up.
+        Client side filtering, only when the API server rejected the selectors.
+        A cached pod that no longer matches is passed on as DELETED, as the
+        API server does for objects leaving a filtered watch.
+        Returns the event or None to drop it.
         """
-        Thread.daemon = False  # do not terminate abruptly
-
-        self._log("Starting PodWatcher Thread.")
-        self.start()
-
-    def run(self):
-        """ """
-        while True:
-
-            try:
-                events = self._watcher.stream(
-                    self._core_api.list_pod_for_all_namespaces,
-                    resource_version=self._resource_version,
-                )
-                for event in events:
-                    self._outQLock.acquire()
-                    self._outQ.put(event)
-                    self._outQLock.release()
-                    self._resource_version = event["object"].metadata.resource_version
-
-            except exceptions.ApiException:
-                print("K8 Exception: PodWatcher Error: {}".format(str(e)))
-
-            except Exception as e:
-                # dedicated thread so ensure we send any unhandled
-                # errors to stdout
-                print("Unhandled error in K8 PodWatcher thread: {}".format(str(e)))
-                print(traceback.format_exc())
-
-    def _log(self, msg):
-        print(msg)
+        if self._pod_filter is None or self._pod_filter.server_side:
+            return event
+        if self._pod_filter.matches(event["object"]):
+            return event
+        if event["type"] != "MODIFIED":
+            return None
+        if any(f.matches(event["object"]) for f in get_pod_filters()):
+            # left this filter for another filter
+            return None
+        try:
+            get_k8_object(event["object"].metadata.uid)
+        except CachedObjectNotFoundError:
+            return None
+        return {"type": "DELETED", "object": event["object"]}
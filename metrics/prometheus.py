@@ -0,0 +1,241 @@
+"""
+Prometheus metrics for aci-sync, counters, gauges and histograms served in
+the Prometheus text format at http://<host>:ACI_SYNC_METRICS_PORT/metrics.
+
+The metrics are declared by the modules they measure and registered on
+creation. A gauge can be given a function, called on each scrape, to read
+a queue depth or cache size without the hot path doing anything.
+"""
+import os
+import math
+import traceback
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from threading import Thread, Lock
+from time import monotonic
+
+# Port the /metrics endpoint listens on, 0 to disable
+metrics_port = int(os.environ.get("ACI_SYNC_METRICS_PORT", "0"))
+
+# Seconds, from a fast cache hit to a slow APIC round trip
+default_buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = []
+_registry_lock = Lock()
+_server = None
+
+
+class _Metric:
+    """
+    A metric family, one value per combination of label values
+    """
+
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        """
+        name:str Metric name, e.g. aci_sync_k8_events_total
+        documentation:str HELP text
+        labels:tuple Label names, values are passed positionally in the same order
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = Lock()
+        self._values = {}
+        with _registry_lock:
+            _registry.append(self)
+
+    def _key(self, label_values):
+        assert len(label_values) == len(self.labels), "{} expects labels {}".format(
+            self.name, self.labels
+        )
+        return tuple(str(v) for v in label_values)
+
+    def samples(self):
+        """
+        Returns [ (name suffix, { label: value }, value), ... ]
+        """
+        with self._lock:
+            values = list(self._values.items())
+        return [("", dict(zip(self.labels, key)), value) for key, value in values]
+
+    def render(self):
+        """
+        Returns the family in the Prometheus text format
+        """
+        lines = [
+            "# HELP {} {}".format(self.name, self.documentation.replace("\n", " ")),
+            "# TYPE {} {}".format(self.name, self.type),
+        ]
+        for suffix, labels, value in self.samples():
+            lines.append("{}{}{} {}".format(self.name, suffix, _labels(labels), _number(value)))
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """
+    A monotonically increasing count
+    """
+
+    type = "counter"
+
+    def inc(self, *label_values, amount=1):
+        key = self._key(label_values)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """
+    A value that goes up and down, set directly or read from func on each scrape
+    """
+
+    type = "gauge"
+
+    def __init__(self, name, documentation, labels=(), func=None):
+        """
+        func:func Returns the value, or { (label values): value } for a labelled gauge
+        """
+        super().__init__(name, documentation, labels)
+        self._func = func
+
+    def set(self, value, *label_values):
+        key = self._key(label_values)
+        with self._lock:
+            self._values[key] = value
+
+    def samples(self):
+        if self._func is None:
+            return super().samples()
+        values = self._func()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [
+            ("", dict(zip(self.labels, self._key(key))), value) for key, value in values.items()
+        ]
+
+
+class Histogram(_Metric):
+    """
+    Observations counted into cumulative buckets, with their count and sum
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=default_buckets):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, *label_values):
+        key = self._key(label_values)
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # [bucket counts..., sum]
+                counts = self._values[key] = [0] * len(self.buckets) + [0.0]
+            counts[i] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, *label_values):
+        """
+        Observes the seconds the with block takes, including when it raises
+        """
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.observe(monotonic() - start, *label_values)
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(counts)) for key, counts in self._values.items()]
+        samples = []
+        for key, counts in values:
+            labels = dict(zip(self.labels, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append(("_bucket", dict(labels, le=_number(bound)), cumulative))
+            samples.append(("_count", labels, cumulative))
+            samples.append(("_sum", labels, counts[-1]))
+        return samples
+
+
+def render():
+    """
+    Returns every registered metric in the Prometheus text format
+    """
+    with _registry_lock:
+        metrics = list(_registry)
+    families = []
+    for metric in metrics:
+        try:
+            families.append(metric.render())
+        except Exception as e:
+            # a failed gauge function drops its metric from the scrape only
+            print("Metrics error rendering {}: {}".format(metric.name, str(e)))
+            print(traceback.format_exc())
+    return "\n".join(families) + "\n"
+
+
+def start_metrics_server(port=None):
+    """
+    Serve /metrics from a dedicated thread, returns the server or None if disabled
+
+    port:int Defaults to ACI_SYNC_METRICS_PORT
+    """
+    global _server
+    port = metrics_port if port is None else port
+    if not port:
+        return None
+    _server = _MetricsServer(("", port), _MetricsRequestHandler)
+    Thread(target=_server.serve_forever, name="metrics", daemon=True).start()
+    print("Serving Prometheus metrics on port {}".format(port))
+    return _server
+
+
+class _MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scraped every few seconds, keep the access log out of the output
+        pass
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{{{}}}".format(
+        ",".join(
+            '{}="{}"'.format(
+                name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            )
+            for name, value in labels.items()
+        )
+    )
+
+
+def _number(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
@@ -0,0 +1,181 @@
+"""
+Desired state reconciliation of the managed APIC EEPG subnets.
+
+The K8 and APIC event handlers converge event by event, a missed event
+leaves drift. The reconciler periodically (and on demand) computes the
+l3extSubnet's every managed EEPG should hold from the K8 object cache,
+reads the annotated subnets the EEPG actually holds and applies only the
+difference in bulk.
+"""
+import os
+import traceback
+from threading import Event, Lock
+from time import monotonic
+from k8_helpers.k8_helpers import extract_k8_annotation
+from k8_helpers.k8_object import list_k8_objects
+from k8_helpers.k8_pods import get_cached_pod_deployment
+from k8_events.k8_events_helpers import subnet_batch, create_or_defer_eepg_subnet
+from k8_events.k8_events_helpers import delete_eepg_subnets
+from aci_helpers.aci_helpers import get_eepg_subnets
+from aci_helpers.aci_object import get_cached_managed_subtree
+from exceptions import ManagedObjectNotFoundError
+
+# Seconds between reconciliation runs, 0 only reconciles on request
+reconcile_interval = int(os.environ.get("ACI_RECONCILE_INTERVAL", "300"))
+
+_requested = Event()
+_reconcile_lock = Lock()
+
+
+def request_reconcile():
+    """
+    Request a reconciliation run, e.g. from a signal handler
+    """
+    _requested.set()
+
+
+def run_reconciler():
+    """
+    Dedicated Thread, reconciles every reconcile_interval seconds and on request
+    """
+    while True:
+        _requested.wait(timeout=reconcile_interval or None)
+        _requested.clear()
+        try:
+            reconcile()
+        except Exception as e:
+            # dedicated thread so ensure we send any unhandled
+            # errors to stdout
+            print("Unhandled error in reconciler thread: {}".format(str(e)))
+            print(traceback.format_exc())
+
+
+def reconcile():
+    """
+    Reconcile the l3extSubnet's of every managed EEPG with the K8 object cache.
+
+    The desired state is taken before and after reading the APIC, so objects
+    changed by in flight events are left to their event handlers: a subnet is
+    only added if desired in both snapshots and only removed if desired in neither.
+
+    Returns (added, removed) counts
+    """
+    with _reconcile_lock:
+        start = monotonic()
+        before = desired_subnets()
+        actual = {}
+        for eepg in set(before) | _watched_eepgs():
+            try:
+                actual[eepg] = actual_subnets(eepg)
+            except ManagedObjectNotFoundError:
+                # the EEPG is created by the deployment handlers
+                continue
+        read_done = monotonic()
+        after = desired_subnets()
+
+        adds = []
+        removes = []
+        for eepg, subnets in actual.items():
+            wanted = before.get(eepg, {})
+            still_wanted = after.get(eepg, {})
+            dn_data = {"tenant": eepg[0], "l3out": eepg[1], "epg": eepg[2]}
+            for ip in set(wanted) & set(still_wanted) - subnets:
+                adds.append((still_wanted[ip], ip, dn_data))
+            for ip in subnets - set(wanted) - set(still_wanted):
+                removes.append((ip, dn_data))
+
+        # a subnet whose EEPG is recreated later is picked up by the next run
+        with subnet_batch():
+            for name, ip, dn_data in adds:
+                create_or_defer_eepg_subnet(name, ip, dn_data, request_reconcile)
+        delete_eepg_subnets(removes)
+
+        print(
+            "Reconciled {} EEPGs, added {} removed {} subnets in {:.3f}s (APIC read {:.3f}s)".format(
+                len(actual), len(adds), len(removes), monotonic() - start, read_done - start
+            )
+        )
+        return len(adds), len(removes)
+
+
+def desired_subnets():
+    """
+    Returns the subnets each managed EEPG should hold from the K8 object cache
+
+    Returns:dict - { (tenant, l3out, epg): { ip: name } }, ip without mask
+    """
+    desired = {}
+    for dep in list_k8_objects("Deployment"):
+        eepg = _eepg(dep)
+        if eepg is not None:
+            desired.setdefault(eepg, {})
+
+    # (namespace, labels, eepg) of the cached pods for the service selectors
+    pods = []
+    for pod in list_k8_objects("Pod"):
+        eepg = _eepg(get_cached_pod_deployment(pod))
+        if eepg is None:
+            continue
+        pods.append((pod.namespace, pod.labels or {}, eepg))
+        if pod.pod_ip is not None:
+            desired.setdefault(eepg, {})[pod.pod_ip] = "{}::{}".format(pod.namespace, pod.name)
+
+    for svc in list_k8_objects("Service"):
+        if svc.service_type != "LoadBalancer" or not svc.lb_ingress or not svc.selector:
+            continue
+        selector = svc.selector.items()
+        eepgs = {
+            eepg
+            for namespace, labels, eepg in pods
+            if namespace == svc.namespace and selector <= labels.items()
+        }
+        for eepg in eepgs:
+            for ip in svc.lb_ingress:
+                desired.setdefault(eepg, {})[ip] = "{}::{}".format(svc.namespace, svc.name)
+
+    return desired
+
+
+def actual_subnets(eepg):
+    """
+    Returns the set of annotated l3extSubnet IPs (without mask) of the EEPG
+
+    eepg:tuple (tenant, l3out, epg)
+
+    Raises:
+    - ManagedObjectNotFoundError
+    """
+    eepg_mo = get_eepg_subnets(*eepg)
+    ips = set()
+    for child in eepg_mo.get("children", []):
+        subnet = child.get("l3extSubnet")
+        if subnet is not None and subnet["attributes"]["ip"].endswith("/32"):
+            ips.add(subnet["attributes"]["ip"][:-3])
+    return ips
+
+
+def _watched_eepgs():
+    """
+    Returns the EEPGs with cached managed objects, they may hold subnets
+    no longer desired after their deployment was removed from the K8 cache.
+    """
+    eepgs = set()
+    for mo in get_cached_managed_subtree("/uni"):
+        rns = mo.dn.split("/")
+        if len(rns) == 5 and rns[4].startswith("instP-"):
+            eepgs.add((rns[2][len("tn-") :], rns[3][len("out-") :], rns[4][len("instP-") :]))
+    return eepgs
+
+
+def _eepg(dep):
+    """
+    Returns the (tenant, l3out, epg) of an annotated Deployment K8Object, or None
+    """
+    if dep is None or dep.annotations is None:
+        return None
+    try:
+        dn_data = extract_k8_annotation(dep.annotations)
+    except Exception as e:
+        # the object does not have a haystacknetworks.com annotation
+        return None
+    return dn_data["tenant"], dn_data["l3out"], dn_data["epg"]
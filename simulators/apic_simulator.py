@@ -0,0 +1,1027 @@
+#!/usr/local/bin/python3.9
+"""
+Local ACI APIC simulator, a stand-in for an APIC for load and regression
+testing of aci-sync without a fabric. Standard library only.
+
+Implements the REST API and websocket used by aci-sync:
+    - aaaLogin / aaaRefresh / aaaLogout, the APIC-cookie token
+    - /api/mo/<dn> GET/POST/DELETE and /api/class/<class> GET with query-target,
+      target-subtree-class, query-target-filter, rsp-subtree, rsp-subtree-class
+      and rsp-subtree-filter (eq/ne/wcard filters only)
+    - subscription=yes, /api/subscriptionRefresh and the events pushed on the
+      /socket<token> websocket (RFC6455, unfragmented frames)
+
+Latency, REST error injection and websocket drops are configurable. Point
+aci-sync at it with ACI_APIC=127.0.0.1:8443 and ACI_APIC_SCHEME=http.
+
+Usage:
+    python3 simulators/apic_simulator.py --port 8443 --seed TEN_K8/L3O_K8/EPG_APP:10000
+"""
+import argparse
+import base64
+import hashlib
+import json
+import random
+import re
+import socket
+import ssl
+import struct
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Thread, Lock, RLock
+from time import sleep, monotonic
+from urllib.parse import urlsplit, parse_qsl, unquote
+
+# Class: RN format
+rn_formats = {
+    "fvTenant": "tn-{name}",
+    "l3extOut": "out-{name}",
+    "l3extInstP": "instP-{name}",
+    "l3extSubnet": "extsubnet-[{ip}]",
+}
+
+# Attributes every MO of the class holds when created
+class_defaults = {
+    "l3extSubnet": {"aggregate": "", "scope": "import-security"},
+    "l3extInstP": {"prefGrMemb": "exclude", "pcTag": "any"},
+}
+
+_websocket_guid = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+_filter_re = re.compile(r'^(eq|ne|wcard)\(\s*(\w+)\.(\w+)\s*,\s*"([^"]*)"\s*\)$')
+
+
+class APICError(Exception):
+    """
+    A REST error returned to the client as an APIC error body
+    """
+
+    def __init__(self, code, text):
+        super().__init__(text)
+        self.code = code
+        self.text = text
+
+
+class APICSimulator:
+    """
+    In memory APIC MO tree, sessions and subscriptions served over HTTP.
+
+    host:str Listen address
+    port:int Listen port
+    latency:float Seconds added to every REST request
+    jitter:float Up to +/- seconds of random latency
+    error_rate:float Fraction of REST requests failed with error_code
+    error_code:int HTTP code of an injected error
+    error_paths:str Regex, only matching REST paths are failed (default all but aaa*)
+    token_timeout:int refreshTimeoutSeconds of a login
+    subscription_timeout:int Seconds a subscription lives without a refresh
+    ws_drop_interval:float Seconds between closing every websocket, 0 to disable
+    certfile/keyfile:str Serve https/wss with this certificate
+    random_seed:int Seed for the latency/error injection
+    """
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=8443,
+        latency=0.0,
+        jitter=0.0,
+        error_rate=0.0,
+        error_code=503,
+        error_paths=None,
+        token_timeout=600,
+        subscription_timeout=90,
+        ws_drop_interval=0,
+        certfile=None,
+        keyfile=None,
+        random_seed=None,
+    ):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.error_paths = re.compile(error_paths if error_paths else r"^/api/(?!aaa)")
+        self.token_timeout = token_timeout
+        self.subscription_timeout = subscription_timeout
+        self.ws_drop_interval = ws_drop_interval
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self._random = random.Random(random_seed)
+
+        self._lock = RLock()
+        # dn: [class, attributes]
+        self._mos = {"uni": ["polUni", {"dn": "uni", "rn": "uni", "status": ""}]}
+        # dn: child dns, insertion ordered
+        self._children = {"uni": OrderedDict()}
+        # class: dns
+        self._classes = {"polUni": {"uni"}}
+
+        # token: { 'user': str, 'expires': monotonic, 'ws': _WebSocket }
+        self._sessions = {}
+        # id: { 'token': str, 'expires': monotonic, 'match': func(class, dn, attributes) }
+        self._subscriptions = {}
+        self._next_subscription = 72057594037927937
+
+        self._stats_lock = Lock()
+        self._stats = {"requests": {}, "errors_injected": 0, "events_pushed": 0}
+        self._server = None
+        # func(class, event attributes) called for every MO change, e.g. by a benchmark
+        self._listeners = []
+
+    # ----------------------------------------------------------------------------------------
+    # Server
+    # ----------------------------------------------------------------------------------------
+
+    def start(self):
+        """
+        Serve in a background thread, returns once listening
+        """
+        self._listen()
+        Thread(target=self._server.serve_forever, name="apic-simulator", daemon=True).start()
+        self._start_ws_dropper()
+        return self
+
+    def serve_forever(self):
+        self._listen()
+        self._start_ws_dropper()
+        self._server.serve_forever()
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        self.drop_websockets()
+
+    @property
+    def address(self):
+        """
+        host:port for ACI_APIC
+        """
+        port = self._server.server_address[1] if self._server is not None else self.port
+        return "{}:{}".format(self.host, port)
+
+    def _listen(self):
+        simulator = self
+
+        class Handler(_APICRequestHandler):
+            apic = simulator
+
+        self._server = _ThreadingHTTPServer((self.host, self.port), Handler)
+        if self.certfile:
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(self.certfile, self.keyfile)
+            self._server.socket = context.wrap_socket(self._server.socket, server_side=True)
+        print(
+            "APIC simulator listening on {}://{}".format(
+                "https" if self.certfile else "http", self.address
+            )
+        )
+
+    def _start_ws_dropper(self):
+        if self.ws_drop_interval <= 0:
+            return
+
+        def dropper():
+            while True:
+                sleep(self.ws_drop_interval)
+                print("APIC simulator dropping {} websockets".format(self.drop_websockets()))
+
+        Thread(target=dropper, name="apic-simulator-ws-drop", daemon=True).start()
+
+    def drop_websockets(self):
+        """
+        Close every open websocket, as an APIC restart or network outage. Returns the count.
+        """
+        with self._lock:
+            sockets = [s["ws"] for s in self._sessions.values() if s["ws"] is not None]
+        for ws in sockets:
+            ws.close()
+        return len(sockets)
+
+    def add_listener(self, listener):
+        """
+        listener:func(class, event attributes) Called for every MO created/modified/deleted
+        """
+        self._listeners.append(listener)
+
+    def _count(self, key):
+        with self._stats_lock:
+            self._stats["requests"][key] = self._stats["requests"].get(key, 0) + 1
+
+    def stats(self):
+        """
+        Returns { 'requests': { 'METHOD kind': count }, 'errors_injected': int,
+                  'events_pushed': int, 'mos': int, 'subscriptions': int, 'websockets': int }
+        """
+        with self._stats_lock:
+            stats = json.loads(json.dumps(self._stats))
+        with self._lock:
+            stats["mos"] = len(self._mos)
+            stats["subscriptions"] = len(self._subscriptions)
+            stats["websockets"] = len([s for s in self._sessions.values() if s["ws"] is not None])
+        return stats
+
+    # ----------------------------------------------------------------------------------------
+    # Sessions
+    # ----------------------------------------------------------------------------------------
+
+    def login(self, user):
+        token = uuid.uuid4().hex + uuid.uuid4().hex
+        with self._lock:
+            self._sessions[token] = {
+                "user": user,
+                "expires": monotonic() + self.token_timeout,
+                "ws": None,
+            }
+        return token
+
+    def refresh(self, token):
+        with self._lock:
+            self._session(token)["expires"] = monotonic() + self.token_timeout
+
+    def logout(self, token):
+        with self._lock:
+            session = self._sessions.pop(token, None)
+            for sub_id in [i for i, s in self._subscriptions.items() if s["token"] == token]:
+                del self._subscriptions[sub_id]
+        if session is not None and session["ws"] is not None:
+            session["ws"].close()
+
+    def _session(self, token):
+        session = self._sessions.get(token)
+        if session is None or session["expires"] < monotonic():
+            raise APICError(403, "Token was invalid (Error: Token timeout)")
+        return session
+
+    def _login_data(self, token, user):
+        return {
+            "totalCount": "1",
+            "imdata": [
+                {
+                    "aaaLogin": {
+                        "attributes": {
+                            "token": token,
+                            "userName": user,
+                            "refreshTimeoutSeconds": str(self.token_timeout),
+                        }
+                    }
+                }
+            ],
+        }
+
+    # ----------------------------------------------------------------------------------------
+    # Seeding
+    # ----------------------------------------------------------------------------------------
+
+    def seed(self, tenant, l3out, eepg=None, subnets=0, managed=True, first_ip="10.0.0.1"):
+        """
+        Create a tenant/l3out, optionally an EEPG holding a number of /32 subnets
+
+        tenant:str fvTenant name
+        l3out:str l3extOut name
+        eepg:str l3extInstP name
+        subnets:int Number of l3extSubnet's, consecutive addresses from first_ip
+        managed:bool Annotate the subnets as created by aci-sync
+        """
+        children = []
+        base = struct.unpack("!I", socket.inet_aton(first_ip))[0]
+        annotation = "orchestrator:aci-k8-haystack" if managed else ""
+        for i in range(subnets):
+            ip = socket.inet_ntoa(struct.pack("!I", base + i))
+            children.append(
+                {
+                    "l3extSubnet": {
+                        "attributes": {
+                            "ip": "{}/32".format(ip),
+                            "name": "seed::{}".format(i),
+                            "annotation": annotation,
+                        }
+                    }
+                }
+            )
+
+        l3out_mo = {"l3extOut": {"attributes": {"name": l3out}, "children": []}}
+        if eepg is not None:
+            l3out_mo["l3extOut"]["children"].append(
+                {"l3extInstP": {"attributes": {"name": eepg}, "children": children}}
+            )
+        self.apply("uni", {"fvTenant": {"attributes": {"name": tenant}, "children": [l3out_mo]}})
+
+    # ----------------------------------------------------------------------------------------
+    # MO tree
+    # ----------------------------------------------------------------------------------------
+
+    def query_mo(self, dn, query, token=None):
+        """
+        GET /api/mo/<dn>, returns the APIC response
+        """
+        target = query.get("query-target", "self")
+        with self._lock:
+            if dn not in self._mos:
+                dns = []
+            elif target == "self":
+                dns = [dn]
+            elif target == "children":
+                dns = list(self._children.get(dn, ()))
+            elif target == "subtree":
+                dns = list(self._walk(dn))
+            else:
+                raise APICError(400, "Invalid query-target {}".format(target))
+
+            classes = _split_classes(query.get("target-subtree-class"))
+            if target != "self" and classes:
+                dns = [d for d in dns if self._mos[d][0] in classes]
+
+            data = self._render_query(dns, query)
+            if query.get("subscription") == "yes":
+                dn_match = _dn_matcher(dn, target, classes)
+                data["subscriptionId"] = self._subscribe(token, dn_match, query)
+            return data
+
+    def query_class(self, mo_class, query, token=None):
+        """
+        GET /api/class/<class>, returns the APIC response
+        """
+        with self._lock:
+            dns = sorted(self._classes.get(mo_class, ()))
+            data = self._render_query(dns, query)
+            if query.get("subscription") == "yes":
+                data["subscriptionId"] = self._subscribe(
+                    token, lambda c, d: c == mo_class, query
+                )
+            return data
+
+    def _render_query(self, dns, query):
+        match = _filter(query.get("query-target-filter"))
+        dns = [d for d in dns if match(*self._mos[d])]
+        imdata = [self._render(d, query.get("rsp-subtree", "no"), query, True) for d in dns]
+        return {"totalCount": str(len(imdata)), "imdata": imdata}
+
+    def _render(self, dn, rsp_subtree, query, top=False):
+        mo_class, attributes = self._mos[dn]
+        attributes = dict(attributes)
+        if not top:
+            del attributes["dn"]
+        mo = {"attributes": attributes}
+
+        if rsp_subtree in ("children", "full"):
+            classes = _split_classes(query.get("rsp-subtree-class"))
+            match = _filter(query.get("rsp-subtree-filter"))
+            children = []
+            for child in self._children.get(dn, ()):
+                child_class, child_attributes = self._mos[child]
+                if classes and child_class not in classes:
+                    # a full subtree still descends through other classes
+                    if rsp_subtree == "full":
+                        children.extend(
+                            self._render(child, rsp_subtree, query).get("children", [])
+                        )
+                    continue
+                if not match(child_class, child_attributes):
+                    continue
+                sub = "full" if rsp_subtree == "full" else "no"
+                children.append({child_class: self._render(child, sub, query)})
+            if children:
+                mo["children"] = children
+
+        return {mo_class: mo} if top else mo
+
+    def _walk(self, dn):
+        yield dn
+        for child in list(self._children.get(dn, ())):
+            yield from self._walk(child)
+
+    def apply(self, url_dn, payload, rsp_subtree="no"):
+        """
+        POST /api/mo/<url_dn>, applies the payload tree atomically and pushes the events.
+
+        Returns the APIC response for the rsp-subtree option (no, full or modified)
+
+        Raises:
+        - APICError 400, the tree is not valid against the current MO tree
+        """
+        if not isinstance(payload, dict) or len(payload) != 1:
+            raise APICError(400, "Request payload must be a single MO")
+
+        events = []
+        with self._lock:
+            # validate the whole tree first so a POST is all or nothing
+            root_dn = self._resolve(url_dn, payload, True)
+            self._validate(url_dn, payload, True, set(), set())
+            modified = self._apply_tree(url_dn, payload, True, events)
+
+            if rsp_subtree == "full" and root_dn in self._mos:
+                imdata = [self._render(root_dn, "full", {}, True)]
+            elif rsp_subtree == "modified" and modified is not None:
+                imdata = [modified]
+            else:
+                imdata = []
+
+        self._push(events)
+        return {"totalCount": str(len(imdata)), "imdata": imdata}
+
+    def delete(self, dn):
+        """
+        DELETE /api/mo/<dn>, deletes the MO and its subtree, pushes the events.
+        """
+        events = []
+        with self._lock:
+            if dn in self._mos and dn != "uni":
+                self._delete_subtree(dn, events)
+        self._push(events)
+        return {"totalCount": "0", "imdata": []}
+
+    def _resolve(self, parent_dn, tree, root):
+        """
+        Returns the DN of the MO at the top of a payload tree
+        """
+        mo_class, mo = next(iter(tree.items()))
+        attributes = mo.get("attributes", {})
+        if "dn" in attributes:
+            return attributes["dn"].strip("/")
+
+        rn = attributes.get("rn")
+        if rn is None:
+            if mo_class == "polUni":
+                rn = "uni"
+            elif mo_class in rn_formats:
+                try:
+                    rn = rn_formats[mo_class].format(**attributes)
+                except KeyError as e:
+                    raise APICError(
+                        400, "Naming property {} of class {} missing".format(str(e), mo_class)
+                    )
+            else:
+                raise APICError(400, "Class {} requires a dn or rn".format(mo_class))
+
+        if root and (parent_dn == rn or parent_dn.endswith("/" + rn)):
+            return parent_dn
+        return "{}/{}".format(parent_dn, rn)
+
+    def _validate(self, parent_dn, tree, root, created, deleted):
+        mo_class, mo = next(iter(tree.items()))
+        dn = self._resolve(parent_dn, tree, root)
+        status = mo.get("attributes", {}).get("status", "")
+
+        def exists(d):
+            if any(d == x or d.startswith(x + "/") for x in deleted):
+                return d in created
+            return d in self._mos or d in created
+
+        if status == "deleted":
+            deleted.add(dn)
+            created.difference_update([d for d in created if d == dn or d.startswith(dn + "/")])
+            return
+
+        parent = _parent_dn(dn)
+        if parent is None or not exists(parent):
+            raise APICError(
+                400, "Unable to create/modify {}, the parent {} does not exist".format(dn, parent)
+            )
+        if dn in self._mos and self._mos[dn][0] != mo_class:
+            raise APICError(400, "DN {} is of class {}".format(dn, self._mos[dn][0]))
+        if status == "created" and exists(dn):
+            raise APICError(400, "Object {} already exists.".format(dn))
+        if status == "modified" and not exists(dn):
+            raise APICError(400, "configured object ({}) not found".format(dn))
+        created.add(dn)
+
+        for child in mo.get("children", []):
+            self._validate(dn, child, False, created, deleted)
+
+    def _apply_tree(self, parent_dn, tree, root, events):
+        """
+        Apply a validated payload tree, returns the 'modified' response tree or None
+        """
+        mo_class, mo = next(iter(tree.items()))
+        dn = self._resolve(parent_dn, tree, root)
+        attributes = dict(mo.get("attributes", {}))
+        status = attributes.pop("status", "")
+        attributes.pop("dn", None)
+        attributes.pop("rn", None)
+
+        if status == "deleted":
+            if dn not in self._mos:
+                return None
+            self._delete_subtree(dn, events)
+            return _response_mo(mo_class, dn, root, {"status": "deleted"}, [])
+
+        changed = None
+        if dn not in self._mos:
+            full = {"annotation": "", "descr": "", "name": ""}
+            full.update(class_defaults.get(mo_class, {}))
+            full.update(attributes)
+            full.update(dn=dn, rn=_last_rn(dn), modTs=_mod_ts(), childAction="", status="")
+            self._mos[dn] = [mo_class, full]
+            self._children.setdefault(dn, OrderedDict())
+            self._children[_parent_dn(dn)][dn] = None
+            self._classes.setdefault(mo_class, set()).add(dn)
+            changed = dict(full, status="created")
+            events.append((mo_class, dict(full, status="created"), full))
+        else:
+            current = self._mos[dn][1]
+            diff = {k: v for k, v in attributes.items() if current.get(k) != v}
+            if diff:
+                current.update(diff)
+                current["modTs"] = _mod_ts()
+                changed = dict(diff, status="modified")
+                event = dict(diff, dn=dn, rn=current["rn"], modTs=current["modTs"])
+                event.update(status="modified", childAction="")
+                events.append((mo_class, event, current))
+
+        children = []
+        for child in mo.get("children", []):
+            response = self._apply_tree(dn, child, False, events)
+            if response is not None:
+                children.append(response)
+
+        if changed is None and not children:
+            return None
+        return _response_mo(mo_class, dn, root, changed or {"status": "modified"}, children)
+
+    def _delete_subtree(self, dn, events):
+        for d in list(self._walk(dn)):
+            mo_class, attributes = self._mos.pop(d)
+            self._children.pop(d, None)
+            self._classes[mo_class].discard(d)
+            events.append((mo_class, dict(attributes, status="deleted"), attributes))
+        self._children[_parent_dn(dn)].pop(dn, None)
+
+    # ----------------------------------------------------------------------------------------
+    # Subscriptions and events
+    # ----------------------------------------------------------------------------------------
+
+    def _subscribe(self, token, dn_match, query):
+        """
+        Register a subscription for the session, returns the subscription ID
+        """
+        attribute_match = _filter(query.get("query-target-filter"))
+        sub_id = str(self._next_subscription)
+        self._next_subscription += 1
+        self._subscriptions[sub_id] = {
+            "token": token,
+            "expires": monotonic() + self.subscription_timeout,
+            "match": lambda c, d, a: dn_match(c, d) and attribute_match(c, a),
+        }
+        return sub_id
+
+    def refresh_subscription(self, sub_id, token):
+        with self._lock:
+            subscription = self._subscriptions.get(sub_id)
+            if subscription is None or subscription["expires"] < monotonic():
+                self._subscriptions.pop(sub_id, None)
+                raise APICError(400, "Subscription {} does not exist".format(sub_id))
+            subscription["expires"] = monotonic() + self.subscription_timeout
+
+    def _push(self, events):
+        """
+        Send the events to the websocket of every session subscribed to them
+
+        events:list (class, event attributes, MO attributes for the subscription filters)
+        """
+        if not events:
+            return
+        for listener in self._listeners:
+            for mo_class, event, attributes in events:
+                listener(mo_class, event)
+
+        messages = []
+        with self._lock:
+            now = monotonic()
+            for sub_id in [i for i, s in self._subscriptions.items() if s["expires"] < now]:
+                del self._subscriptions[sub_id]
+
+            for mo_class, event, attributes in events:
+                sessions = OrderedDict()
+                for sub_id, subscription in self._subscriptions.items():
+                    if subscription["match"](mo_class, attributes["dn"], attributes):
+                        sessions.setdefault(subscription["token"], []).append(sub_id)
+                for token, sub_ids in sessions.items():
+                    session = self._sessions.get(token)
+                    if session is None or session["ws"] is None:
+                        continue
+                    imdata = [{mo_class: {"attributes": event}}]
+                    messages.append((session["ws"], {"subscriptionId": sub_ids, "imdata": imdata}))
+
+        for ws, message in messages:
+            if ws.send_text(json.dumps(message)):
+                with self._stats_lock:
+                    self._stats["events_pushed"] += 1
+
+    def open_websocket(self, token, ws):
+        with self._lock:
+            session = self._session(token)
+            old = session["ws"]
+            session["ws"] = ws
+        if old is not None:
+            old.close()
+
+    def close_websocket(self, token, ws):
+        with self._lock:
+            session = self._sessions.get(token)
+            if session is not None and session["ws"] is ws:
+                session["ws"] = None
+
+    def inject(self, path):
+        """
+        Apply the latency, returns an APICError to fail the request with or None
+        """
+        delay = self.latency
+        if self.jitter:
+            delay += self._random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            sleep(delay)
+        if self.error_rate and self.error_paths.search(path):
+            if self._random.random() < self.error_rate:
+                with self._stats_lock:
+                    self._stats["errors_injected"] += 1
+                return APICError(self.error_code, "Injected error")
+        return None
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _APICRequestHandler(BaseHTTPRequestHandler):
+    """
+    HTTP request handler, the APIC REST API and websocket upgrade
+    """
+
+    protocol_version = "HTTP/1.1"
+    apic = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+    def _handle(self, method):
+        url = urlsplit(self.path)
+        path = unquote(url.path)
+        query = dict(parse_qsl(url.query, keep_blank_values=True))
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+
+        if method == "GET" and path.startswith("/socket"):
+            self.apic._count("GET socket")
+            return self._websocket(path[len("/socket") :])
+
+        if path.endswith(".json"):
+            path = path[: -len(".json")]
+        path = path.rstrip("/")
+
+        try:
+            if path == "/sim/stats":
+                return self._reply(200, self.apic.stats())
+
+            error = self.apic.inject(path)
+            if error is not None:
+                raise error
+            self._route(method, path, query, body)
+
+        except APICError as e:
+            self._reply(e.code, _error_data(e.code, e.text))
+        except Exception as e:
+            self._reply(500, _error_data(500, "Simulator error: {}".format(str(e))))
+
+    def _route(self, method, path, query, body):
+        apic = self.apic
+        token = self._token()
+
+        if path == "/api/aaaLogin" and method == "POST":
+            apic._count("POST aaaLogin")
+            user = json.loads(body or b"{}").get("aaaUser", {}).get("attributes", {}).get("name")
+            token = apic.login(user)
+            return self._reply(200, apic._login_data(token, user), token)
+
+        if path == "/api/aaaRefresh" and method == "GET":
+            apic._count("GET aaaRefresh")
+            apic.refresh(token)
+            return self._reply(200, apic._login_data(token, None), token)
+
+        if path == "/api/aaaLogout" and method == "POST":
+            apic._count("POST aaaLogout")
+            apic.logout(token)
+            return self._reply(200, {"totalCount": "0", "imdata": []})
+
+        # every other request requires a session
+        with apic._lock:
+            apic._session(token)
+
+        if path == "/api/subscriptionRefresh" and method == "GET":
+            apic._count("GET subscriptionRefresh")
+            apic.refresh_subscription(query.get("id"), token)
+            return self._reply(200, {"totalCount": "0", "imdata": []})
+
+        if path.startswith("/api/mo/"):
+            dn = path[len("/api/mo/") :]
+            apic._count("{} mo".format(method))
+            if method == "GET":
+                return self._reply(200, apic.query_mo(dn, query, token))
+            if method == "POST":
+                try:
+                    payload = json.loads(body)
+                except ValueError:
+                    raise APICError(400, "Invalid JSON payload")
+                return self._reply(200, apic.apply(dn, payload, query.get("rsp-subtree", "no")))
+            if method == "DELETE":
+                return self._reply(200, apic.delete(dn))
+
+        if path.startswith("/api/class/") and method == "GET":
+            apic._count("GET class")
+            return self._reply(200, apic.query_class(path[len("/api/class/") :], query, token))
+
+        raise APICError(400, "Unsupported request {} {}".format(method, path))
+
+    def _token(self):
+        for cookie in (self.headers.get("Cookie") or "").split(";"):
+            name, _, value = cookie.strip().partition("=")
+            if name == "APIC-cookie":
+                return value
+        return None
+
+    def _reply(self, code, data, token=None):
+        content = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        if token is not None:
+            self.send_header("Set-Cookie", "APIC-cookie={}; path=/; HttpOnly".format(token))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _websocket(self, token):
+        key = self.headers.get("Sec-WebSocket-Key")
+        if key is None or "websocket" not in (self.headers.get("Upgrade") or "").lower():
+            return self._reply(400, _error_data(400, "Websocket upgrade required"))
+        try:
+            with self.apic._lock:
+                self.apic._session(token)
+        except APICError as e:
+            return self._reply(e.code, _error_data(e.code, e.text))
+
+        accept = base64.b64encode(hashlib.sha1((key + _websocket_guid).encode()).digest())
+        self.send_response(101)
+        self.send_header("Upgrade", "websocket")
+        self.send_header("Connection", "Upgrade")
+        self.send_header("Sec-WebSocket-Accept", accept.decode())
+        self.end_headers()
+        self.wfile.flush()
+
+        ws = _WebSocket(self.connection, self.rfile, self.wfile)
+        self.apic.open_websocket(token, ws)
+        try:
+            ws.serve()
+        finally:
+            self.apic.close_websocket(token, ws)
+            self.close_connection = True
+
+
+class _WebSocket:
+    """
+    Server side of an upgraded websocket connection, unfragmented frames only
+    """
+
+    def __init__(self, connection, rfile, wfile):
+        self._connection = connection
+        self._rfile = rfile
+        self._wfile = wfile
+        self._lock = Lock()
+        self.closed = False
+
+    def serve(self):
+        """
+        Read client frames until closed, answering pings
+        """
+        while not self.closed:
+            try:
+                frame = self._read()
+            except (OSError, ValueError):
+                frame = None
+            if frame is None:
+                break
+            opcode, data = frame
+            if opcode == 0x9:
+                self._send(0xA, data)
+            elif opcode == 0x8:
+                self._send(0x8, data[:2])
+                break
+        self.close()
+
+    def send_text(self, text):
+        return self._send(0x1, text.encode())
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def _send(self, opcode, data):
+        length = len(data)
+        if length < 126:
+            header = struct.pack("!BB", 0x80 | opcode, length)
+        elif length < 65536:
+            header = struct.pack("!BBH", 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack("!BBQ", 0x80 | opcode, 127, length)
+        with self._lock:
+            if self.closed:
+                return False
+            try:
+                self._wfile.write(header + data)
+                self._wfile.flush()
+            except OSError:
+                self.closed = True
+                return False
+        return True
+
+    def _read(self):
+        head = self._rfile.read(2)
+        if len(head) < 2:
+            return None
+        opcode = head[0] & 0x0F
+        length = head[1] & 0x7F
+        if length == 126:
+            length = struct.unpack("!H", self._rfile.read(2))[0]
+        elif length == 127:
+            length = struct.unpack("!Q", self._rfile.read(8))[0]
+        mask = self._rfile.read(4) if head[1] & 0x80 else None
+        data = self._rfile.read(length)
+        if mask is not None:
+            data = bytes(b ^ mask[i % 4] for i, b in enumerate(data))
+        return opcode, data
+
+
+def _error_data(code, text):
+    return {
+        "totalCount": "1",
+        "imdata": [{"error": {"attributes": {"code": str(code), "text": text}}}],
+    }
+
+
+def _response_mo(mo_class, dn, root, attributes, children):
+    attributes = dict(attributes)
+    if root:
+        attributes["dn"] = dn
+    else:
+        attributes.pop("dn", None)
+        attributes["rn"] = _last_rn(dn)
+    mo = {"attributes": attributes}
+    if children:
+        mo["children"] = children
+    return {mo_class: mo}
+
+
+def _split_dn(dn):
+    """
+    Returns the RNs of a DN, '/' inside [] is part of the RN
+    """
+    rns = []
+    depth = 0
+    start = 0
+    for i, c in enumerate(dn):
+        if c == "[":
+            depth += 1
+        elif c == "]":
+            depth -= 1
+        elif c == "/" and depth == 0:
+            rns.append(dn[start:i])
+            start = i + 1
+    rns.append(dn[start:])
+    return [rn for rn in rns if rn]
+
+
+def _parent_dn(dn):
+    rns = _split_dn(dn)
+    return "/".join(rns[:-1]) if len(rns) > 1 else None
+
+
+def _last_rn(dn):
+    return _split_dn(dn)[-1]
+
+
+def _split_classes(classes):
+    return set(c for c in classes.split(",") if c) if classes else set()
+
+
+def _dn_matcher(dn, target, classes):
+    """
+    Returns func(class, dn) for the MOs a subscription on a /api/mo query covers
+    """
+
+    def match(mo_class, mo_dn):
+        if target == "self":
+            return mo_dn == dn
+        if classes and mo_class not in classes:
+            return False
+        if target == "children":
+            return _parent_dn(mo_dn) == dn
+        return mo_dn == dn or mo_dn.startswith(dn + "/")
+
+    return match
+
+
+def _filter(expression):
+    """
+    Returns func(class, attributes) for a query-target-filter/rsp-subtree-filter
+
+    Raises:
+    - APICError 400, an unsupported filter expression
+    """
+    if not expression:
+        return lambda mo_class, attributes: True
+    match = _filter_re.match(expression.strip())
+    if match is None:
+        raise APICError(400, "Unsupported filter {}".format(expression))
+    op, filter_class, prop, value = match.groups()
+
+    def f(mo_class, attributes):
+        if mo_class != filter_class:
+            return False
+        current = attributes.get(prop, "")
+        if op == "eq":
+            return current == value
+        if op == "ne":
+            return current != value
+        return value in current
+
+    return f
+
+
+def _mod_ts():
+    return datetime.now(timezone.utc).isoformat(timespec="milliseconds")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ACI APIC simulator")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8443)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added per request")
+    parser.add_argument("--jitter", type=float, default=0.0, help="+/- seconds of random latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of failed requests")
+    parser.add_argument("--error-code", type=int, default=503)
+    parser.add_argument("--error-paths", help="regex of the REST paths errors are injected into")
+    parser.add_argument("--token-timeout", type=int, default=600)
+    parser.add_argument("--subscription-timeout", type=int, default=90)
+    parser.add_argument(
+        "--ws-drop-interval", type=float, default=0, help="seconds between websocket drops"
+    )
+    parser.add_argument("--certfile", help="serve https/wss with this certificate")
+    parser.add_argument("--keyfile")
+    parser.add_argument("--random-seed", type=int)
+    parser.add_argument(
+        "--seed",
+        action="append",
+        default=[],
+        help="tenant/l3out[/eepg[:subnets]], repeatable",
+    )
+    args = parser.parse_args()
+
+    apic = APICSimulator(
+        host=args.host,
+        port=args.port,
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        error_code=args.error_code,
+        error_paths=args.error_paths,
+        token_timeout=args.token_timeout,
+        subscription_timeout=args.subscription_timeout,
+        ws_drop_interval=args.ws_drop_interval,
+        certfile=args.certfile,
+        keyfile=args.keyfile,
+        random_seed=args.random_seed,
+    )
+    for seed in args.seed:
+        path, _, count = seed.partition(":")
+        names = path.split("/")
+        if len(names) not in (2, 3):
+            parser.error("invalid --seed {}".format(seed))
+        apic.seed(*names, subnets=int(count or 0))
+        print("Seeded {}".format(seed))
+
+    try:
+        apic.serve_forever()
+    except KeyboardInterrupt:
+        apic.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+#!/usr/local/bin/python3.9
+"""
+End to end aci-sync benchmark against the APIC simulator and the fake K8
+API server with a synthetic workload, no fabric or cluster required.
+
+aci-sync runs as a subprocess, the simulators in this process. The latency
+reported is from a pod (or LoadBalancer) IP being assigned in K8 to its
+l3extSubnet being created on the simulated APIC.
+
+Usage:
+    python3 simulators/benchmark.py --namespaces 4 --deployments 10 --duration 60 --rate 5
+"""
+import argparse
+import math
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+from threading import Lock
+from time import sleep, monotonic
+from apic_simulator import APICSimulator
+from k8_simulator import K8Simulator
+from k8_churn import add_arguments, churn_generator
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values, p):
+    """
+    Nearest rank percentile of a sorted list, None if empty
+    """
+    if not values:
+        return None
+    rank = int(math.ceil(p / 100.0 * len(values)))
+    return values[max(0, min(len(values), rank) - 1)]
+
+
+class SubnetRecorder:
+    """
+    APIC simulator listener, the time each l3extSubnet IP was first created
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.created = {}
+
+    def __call__(self, mo_class, event):
+        if mo_class != "l3extSubnet" or event.get("status") != "created":
+            return
+        ip = event["ip"][:-3] if event["ip"].endswith("/32") else event["ip"]
+        with self._lock:
+            self.created.setdefault(ip, monotonic())
+
+
+def wait_for(ips, recorder, timeout):
+    """
+    Wait until every IP has an l3extSubnet, returns the IPs still missing
+    """
+    deadline = monotonic() + timeout
+    missing = set(ips)
+    while missing and monotonic() < deadline:
+        missing = {ip for ip in missing if ip not in recorder.created}
+        sleep(0.1)
+    return missing
+
+
+def report(title, ips, assigned, recorder):
+    """
+    Print the IP assignment to l3extSubnet creation latency of the IPs
+    """
+    latencies = sorted(
+        recorder.created[ip] - assigned[ip]
+        for ip in ips
+        if ip in recorder.created and recorder.created[ip] >= assigned[ip]
+    )
+    print("{}: {} IPs, {} subnets created".format(title, len(ips), len(latencies)))
+    if latencies:
+        print(
+            "\tlatency p50: {:.3f}s p90: {:.3f}s p99: {:.3f}s max: {:.3f}s".format(
+                percentile(latencies, 50),
+                percentile(latencies, 90),
+                percentile(latencies, 99),
+                latencies[-1],
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="aci-sync end to end benchmark")
+    parser.add_argument("--duration", type=float, default=60, help="seconds of churn")
+    parser.add_argument("--settle", type=float, default=30, help="seconds to wait for subnets")
+    parser.add_argument("--sync-timeout", type=float, default=300)
+    parser.add_argument("--apic-latency", type=float, default=0.0)
+    parser.add_argument("--apic-error-rate", type=float, default=0.0)
+    parser.add_argument("--k8-latency", type=float, default=0.0)
+    parser.add_argument("--log", default="aci-sync-benchmark.log", help="aci-sync output")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    apic = APICSimulator(port=0, latency=args.apic_latency, error_rate=args.apic_error_rate)
+    apic.start()
+    apic.seed(args.tenant, args.l3out)
+    recorder = SubnetRecorder()
+    apic.add_listener(recorder)
+
+    k8 = K8Simulator(port=0, latency=args.k8_latency).start()
+    kubeconfig = k8.write_kubeconfig(os.path.join(tempfile.mkdtemp(), "kubeconfig"))
+    churn = churn_generator(k8, args)
+    churn.setup()
+    # the initial pods are assigned their IPs before aci-sync starts
+    sleep(args.ip_delay + 0.5)
+    initial = set(churn.live_ips)
+
+    env = dict(
+        os.environ,
+        ACI_APIC=apic.address,
+        ACI_APIC_SCHEME="http",
+        ACI_USERNAME=os.environ.get("ACI_USERNAME", "benchmark"),
+        ACI_PASSWORD=os.environ.get("ACI_PASSWORD", "benchmark"),
+        KUBECONFIG=kubeconfig,
+        PYTHONUNBUFFERED="1",
+    )
+    log = open(args.log, "w")
+    start = monotonic()
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(repo_root, "aci-sync.py")],
+        cwd=repo_root,
+        env=env,
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+
+    try:
+        missing = wait_for(initial, recorder, args.sync_timeout)
+        sync_time = monotonic() - start
+        print(
+            "Initial sync: {} of {} subnets in {:.3f}s".format(
+                len(initial) - len(missing), len(initial), sync_time
+            )
+        )
+
+        churn_start = monotonic()
+        churn.run(args.duration, args.rate)
+        print("Churn: {} in {:.1f}s".format(churn.counts, monotonic() - churn_start))
+        churned = {ip for ip, t in churn.assigned.items() if t >= churn_start}
+        live = churned & churn.live_ips
+        missing = wait_for(live, recorder, args.settle)
+
+        report("Pod IPs", [ip for ip in churned if ip.startswith("10.")], churn.assigned, recorder)
+        report("LB IPs", [ip for ip in churned if ip.startswith("172.")], churn.assigned, recorder)
+        print("Live IPs without a subnet after {}s: {}".format(args.settle, len(missing)))
+        print("APIC simulator: {}".format(apic.stats()))
+        print("K8 simulator: {}".format(k8.stats()))
+
+    finally:
+        churn.stop()
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        log.close()
+        k8.stop()
+        apic.stop()
+
+
+if __name__ == "__main__":
+    main()
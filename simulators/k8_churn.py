@@ -0,0 +1,426 @@
+#!/usr/local/bin/python3.9
+"""
+Synthetic K8 workload for the fake K8 API server (k8_simulator.py).
+
+Creates annotated Deployments, their ReplicaSets, Pods and a LoadBalancer
+Service each, then churns them at a configurable rate:
+    - rollout     a new ReplicaSet replaces every pod of a deployment
+    - scale       a deployment is scaled to between 1 and max replicas
+    - lb          a service is reassigned a new LoadBalancer IP
+    - namespace   every object of a namespace is deleted, then recreated
+
+Pods are created Pending and are assigned an IP ip_delay seconds later, as
+the kubelet would, the assignment time of every IP is kept for benchmarks.
+
+Usage:
+    python3 simulators/k8_churn.py --kubeconfig /tmp/k8sim.kubeconfig --rate 5
+"""
+import argparse
+import heapq
+import json
+import random
+import socket
+import struct
+from threading import Thread, Lock, Event
+from time import sleep, monotonic
+from k8_simulator import K8Simulator
+
+annotation_key = "aci.haystacknetworks.com/l3o"
+
+# Action: relative weight
+default_mix = {"rollout": 1.0, "scale": 2.0, "lb": 1.0, "namespace": 0.1}
+
+
+class ChurnGenerator:
+    """
+    k8:K8Simulator
+    namespaces:int Number of namespaces, bench-0 ...
+    deployments:int Deployments per namespace, each annotated for its own EEPG
+    replicas:int Initial replicas per deployment
+    max_replicas:int Upper bound of a scale action
+    tenant/l3out:str The annotation tenant and l3out, the EEPG is EPG_<namespace>_<deployment>
+    ip_delay:float Seconds from pod creation to IP assignment
+    mix:dict Action weights, see default_mix
+    seed:int Random seed
+    """
+
+    def __init__(
+        self,
+        k8,
+        namespaces=2,
+        deployments=5,
+        replicas=3,
+        max_replicas=10,
+        tenant="TEN_K8",
+        l3out="L3O_K8",
+        ip_delay=0.5,
+        mix=None,
+        seed=None,
+    ):
+        self.k8 = k8
+        self.namespaces = ["bench-{}".format(i) for i in range(namespaces)]
+        self.deployments = ["app-{}".format(i) for i in range(deployments)]
+        self.replicas = replicas
+        self.max_replicas = max_replicas
+        self.tenant = tenant
+        self.l3out = l3out
+        self.ip_delay = ip_delay
+        self.mix = mix if mix is not None else dict(default_mix)
+        self._random = random.Random(seed)
+
+        self._lock = Lock()
+        # (namespace, deployment): { 'uid', 'rs', 'rs_uid', 'hash', 'pods': [names] }
+        self._state = {}
+        self._next_pod_ip = _ip_int("10.64.0.1")
+        self._next_lb_ip = _ip_int("172.16.0.1")
+        self._pod_counter = 0
+
+        # ip: monotonic time the IP was assigned to a pod or service
+        self.assigned = {}
+        # IPs of running pods and services
+        self.live_ips = set()
+        # (namespace, pod): ip
+        self._pod_ips = {}
+        self.counts = {action: 0 for action in default_mix}
+
+        # (due, namespace, pod) waiting for an IP
+        self._pending = []
+        self._pending_lock = Lock()
+        self._stop = Event()
+        Thread(target=self._assign_ips, name="k8-churn-ips", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    # ----------------------------------------------------------------------------------------
+    # Workload
+    # ----------------------------------------------------------------------------------------
+
+    def setup(self):
+        """
+        Create every namespace's deployments, returns the number of pods created
+        """
+        for namespace in self.namespaces:
+            self._create_namespace(namespace)
+        return len(self.namespaces) * len(self.deployments) * self.replicas
+
+    def run(self, duration, rate):
+        """
+        Churn for duration seconds (0 runs until stop()) at rate actions per second
+        """
+        actions = {
+            "rollout": self.rollout,
+            "scale": self.scale,
+            "lb": self.reassign_lb,
+            "namespace": self.delete_namespace,
+        }
+        names = [a for a in actions if self.mix.get(a, 0) > 0]
+        weights = [self.mix[a] for a in names]
+        end = monotonic() + duration if duration else None
+        interval = 1.0 / rate
+        next_action = monotonic()
+
+        while not self._stop.is_set() and (end is None or monotonic() < end):
+            action = self._random.choices(names, weights)[0]
+            namespace = self._random.choice(self.namespaces)
+            if action == "namespace":
+                actions[action](namespace)
+            else:
+                actions[action](namespace, self._random.choice(self.deployments))
+            self.counts[action] += 1
+
+            next_action += interval
+            delay = next_action - monotonic()
+            if delay > 0:
+                sleep(delay)
+
+    def rollout(self, namespace, deployment):
+        """
+        Replace every pod of the deployment with a pod of a new ReplicaSet
+        """
+        with self._lock:
+            state = self._state.get((namespace, deployment))
+            if state is None:
+                return
+            old_rs, old_pods = state["rs"], state["pods"]
+            replicas = max(1, len(old_pods))
+            self._new_replicaset(namespace, deployment, state, replicas)
+            for name in old_pods:
+                self._create_pod(namespace, deployment, state)
+                self._delete_pod(namespace, name)
+            self.k8.delete("replicasets", namespace, old_rs)
+
+    def scale(self, namespace, deployment, replicas=None):
+        """
+        Scale the deployment, to a random number of replicas by default
+        """
+        with self._lock:
+            state = self._state.get((namespace, deployment))
+            if state is None:
+                return
+            if replicas is None:
+                replicas = self._random.randint(1, self.max_replicas)
+            while len(state["pods"]) < replicas:
+                self._create_pod(namespace, deployment, state)
+            while len(state["pods"]) > replicas:
+                self._delete_pod(namespace, state["pods"].pop())
+            rs = self.k8.get("replicasets", namespace, state["rs"])
+            rs["spec"]["replicas"] = replicas
+            self.k8.update("replicasets", rs)
+
+    def reassign_lb(self, namespace, deployment):
+        """
+        Assign the deployment's LoadBalancer service a new ingress IP
+        """
+        with self._lock:
+            svc = self.k8.get("services", namespace, "{}-lb".format(deployment))
+            if svc is None:
+                return
+            for ingress in svc["status"]["loadBalancer"]["ingress"]:
+                self.live_ips.discard(ingress["ip"])
+            svc["status"]["loadBalancer"]["ingress"] = [{"ip": self._lb_ip()}]
+            self.k8.update("services", svc)
+
+    def delete_namespace(self, namespace):
+        """
+        Delete every object in the namespace, then recreate its deployments
+        """
+        with self._lock:
+            for svc in self.k8.list("services", namespace):
+                for ingress in svc["status"]["loadBalancer"]["ingress"]:
+                    self.live_ips.discard(ingress["ip"])
+            for resource in ("services", "pods", "replicasets", "deployments"):
+                for obj in self.k8.list(resource, namespace):
+                    self.k8.delete(resource, namespace, obj["metadata"]["name"])
+            for deployment in self.deployments:
+                self._state.pop((namespace, deployment), None)
+            for ns, name in [key for key in self._pod_ips if key[0] == namespace]:
+                self.live_ips.discard(self._pod_ips.pop((ns, name)))
+        self._create_namespace(namespace)
+
+    # ----------------------------------------------------------------------------------------
+    # Objects
+    # ----------------------------------------------------------------------------------------
+
+    def _create_namespace(self, namespace):
+        with self._lock:
+            for deployment in self.deployments:
+                self._create_deployment(namespace, deployment)
+
+    def _create_deployment(self, namespace, deployment):
+        labels = {"app": deployment}
+        annotation = {
+            "tenant": self.tenant,
+            "l3out": self.l3out,
+            "epg": "EPG_{}_{}".format(namespace, deployment).replace("-", "_"),
+        }
+        dep = self.k8.create(
+            "deployments",
+            {
+                "metadata": {
+                    "name": deployment,
+                    "namespace": namespace,
+                    "labels": labels,
+                    "annotations": {annotation_key: json.dumps(annotation)},
+                },
+                "spec": {
+                    "replicas": self.replicas,
+                    "selector": {"matchLabels": labels},
+                    "template": _template(labels),
+                },
+            },
+        )
+        state = {"uid": dep["metadata"]["uid"], "hash": 0, "pods": []}
+        self._state[(namespace, deployment)] = state
+        self._new_replicaset(namespace, deployment, state, self.replicas)
+        for i in range(self.replicas):
+            self._create_pod(namespace, deployment, state)
+
+        lb_ip = self._lb_ip()
+        self.k8.create(
+            "services",
+            {
+                "metadata": {"name": "{}-lb".format(deployment), "namespace": namespace},
+                "spec": {
+                    "type": "LoadBalancer",
+                    "selector": labels,
+                    "ports": [{"port": 80, "protocol": "TCP"}],
+                },
+                "status": {"loadBalancer": {"ingress": [{"ip": lb_ip}]}},
+            },
+        )
+
+    def _new_replicaset(self, namespace, deployment, state, replicas):
+        state["hash"] += 1
+        state["rs"] = "{}-{:08x}".format(deployment, state["hash"])
+        state["pods"] = []
+        labels = {"app": deployment, "pod-template-hash": "{:08x}".format(state["hash"])}
+        rs = self.k8.create(
+            "replicasets",
+            {
+                "metadata": {
+                    "name": state["rs"],
+                    "namespace": namespace,
+                    "labels": labels,
+                    "ownerReferences": [
+                        _owner("apps/v1", "Deployment", deployment, state["uid"])
+                    ],
+                },
+                "spec": {
+                    "replicas": replicas,
+                    "selector": {"matchLabels": labels},
+                    "template": _template(labels),
+                },
+            },
+        )
+        state["rs_uid"] = rs["metadata"]["uid"]
+
+    def _create_pod(self, namespace, deployment, state):
+        self._pod_counter += 1
+        name = "{}-{:05d}".format(state["rs"], self._pod_counter)
+        labels = {"app": deployment, "pod-template-hash": "{:08x}".format(state["hash"])}
+        self.k8.create(
+            "pods",
+            {
+                "metadata": {
+                    "name": name,
+                    "namespace": namespace,
+                    "labels": labels,
+                    "ownerReferences": [
+                        _owner("apps/v1", "ReplicaSet", state["rs"], state["rs_uid"])
+                    ],
+                },
+                "spec": _template(labels)["spec"],
+                "status": {"phase": "Pending"},
+            },
+        )
+        state["pods"].append(name)
+        with self._pending_lock:
+            heapq.heappush(self._pending, (monotonic() + self.ip_delay, namespace, name))
+
+    def _delete_pod(self, namespace, name):
+        self.k8.delete("pods", namespace, name)
+        ip = self._pod_ips.pop((namespace, name), None)
+        if ip is not None:
+            self.live_ips.discard(ip)
+
+    def _assign_ips(self):
+        """
+        Dedicated Thread, assigns the pending pods their IP once due
+        """
+        while not self._stop.is_set():
+            with self._pending_lock:
+                due = []
+                while self._pending and self._pending[0][0] <= monotonic():
+                    due.append(heapq.heappop(self._pending))
+            if not due:
+                sleep(0.01)
+                continue
+            with self._lock:
+                for _, namespace, name in due:
+                    pod = self.k8.get("pods", namespace, name)
+                    if pod is None:
+                        continue
+                    ip = _int_ip(self._next_pod_ip)
+                    self._next_pod_ip += 1
+                    pod["status"] = {"phase": "Running", "podIP": ip, "podIPs": [{"ip": ip}]}
+                    self.k8.update("pods", pod)
+                    self._pod_ips[(namespace, name)] = ip
+                    self.assigned[ip] = monotonic()
+                    self.live_ips.add(ip)
+
+    def _lb_ip(self):
+        ip = _int_ip(self._next_lb_ip)
+        self._next_lb_ip += 1
+        self.assigned[ip] = monotonic()
+        self.live_ips.add(ip)
+        return ip
+
+
+def _template(labels):
+    return {
+        "metadata": {"labels": labels},
+        "spec": {"containers": [{"name": "app", "image": "nginx"}]},
+    }
+
+
+def _owner(api_version, kind, name, uid):
+    return {"apiVersion": api_version, "kind": kind, "name": name, "uid": uid, "controller": True}
+
+
+def _ip_int(ip):
+    return struct.unpack("!I", socket.inet_aton(ip))[0]
+
+
+def _int_ip(value):
+    return socket.inet_ntoa(struct.pack("!I", value))
+
+
+def parse_mix(mix):
+    """
+    Returns the action weights of 'rollout=1,scale=2,lb=1,namespace=0.1'
+    """
+    weights = dict(default_mix)
+    for item in mix.split(","):
+        action, _, weight = item.partition("=")
+        if action.strip() not in default_mix:
+            raise ValueError("Unknown churn action {}".format(action))
+        weights[action.strip()] = float(weight)
+    return weights
+
+
+def add_arguments(parser):
+    """
+    The workload arguments, shared with the benchmark runner
+    """
+    parser.add_argument("--namespaces", type=int, default=2)
+    parser.add_argument("--deployments", type=int, default=5, help="per namespace")
+    parser.add_argument("--replicas", type=int, default=3, help="initial pods per deployment")
+    parser.add_argument("--max-replicas", type=int, default=10)
+    parser.add_argument("--tenant", default="TEN_K8")
+    parser.add_argument("--l3out", default="L3O_K8")
+    parser.add_argument("--ip-delay", type=float, default=0.5, help="seconds to assign a pod IP")
+    parser.add_argument("--rate", type=float, default=2.0, help="churn actions per second")
+    parser.add_argument("--mix", default="", help="e.g. rollout=1,scale=2,lb=1,namespace=0.1")
+    parser.add_argument("--random-seed", type=int)
+
+
+def churn_generator(k8, args):
+    return ChurnGenerator(
+        k8,
+        namespaces=args.namespaces,
+        deployments=args.deployments,
+        replicas=args.replicas,
+        max_replicas=args.max_replicas,
+        tenant=args.tenant,
+        l3out=args.l3out,
+        ip_delay=args.ip_delay,
+        mix=parse_mix(args.mix) if args.mix else None,
+        seed=args.random_seed,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake K8 API server with a synthetic workload")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6443)
+    parser.add_argument("--kubeconfig", default="k8sim.kubeconfig")
+    parser.add_argument("--duration", type=float, default=0, help="seconds of churn, 0 forever")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    k8 = K8Simulator(host=args.host, port=args.port).start()
+    print("Wrote {}".format(k8.write_kubeconfig(args.kubeconfig)))
+    churn = churn_generator(k8, args)
+    print("Created {} pods".format(churn.setup()))
+    try:
+        churn.run(args.duration, args.rate)
+    except KeyboardInterrupt:
+        pass
+    churn.stop()
+    k8.stop()
+    print("Churn actions: {}".format(churn.counts))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,557 @@
+#!/usr/local/bin/python3.9
+"""
+Fake K8 API server, serves the list/watch API aci-sync uses for Pods,
+Services, Deployments and ReplicaSets from memory. Standard library only.
+
+    - list with limit/continue served from a snapshot, labelSelector
+      (=, ==, !=, in, notin, exists, !exists) and fieldSelector (=, ==, !=)
+    - watch from a resourceVersion with selectors, objects leaving a selector
+      are sent as DELETED, allowWatchBookmarks and timeoutSeconds
+    - 410 Gone once a resourceVersion or continue token is older than the
+      retained event history
+
+Objects are created/updated/deleted in process through the K8Simulator
+methods, simulators/k8_churn.py runs the server with a synthetic workload.
+write_kubeconfig() writes a kubeconfig for aci-sync.
+"""
+import base64
+import copy
+import json
+import re
+import uuid
+from collections import deque, OrderedDict
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Thread, Condition, RLock
+from time import sleep, monotonic
+from urllib.parse import urlsplit, parse_qsl
+
+# resource: (API path prefix, apiVersion, kind)
+resources = {
+    "pods": ("/api/v1", "v1", "Pod"),
+    "services": ("/api/v1", "v1", "Service"),
+    "deployments": ("/apis/apps/v1", "apps/v1", "Deployment"),
+    "replicasets": ("/apis/apps/v1", "apps/v1", "ReplicaSet"),
+}
+
+_path_re = re.compile(
+    r"^(/api/v1|/apis/apps/v1)(?:/namespaces/([^/]+))?/(pods|services|deployments|replicasets)$"
+)
+_requirement_re = re.compile(r"^\s*([\w./-]+)\s+(in|notin)\s+\(([^)]*)\)\s*$")
+_comparison_re = re.compile(r"^\s*([\w./-]+)\s*(==|=|!=)\s*([\w./-]*)\s*$")
+_exists_re = re.compile(r"^\s*(!?)\s*([\w./-]+)\s*$")
+
+
+class K8Error(Exception):
+    """
+    An error returned to the client as a K8 Status
+    """
+
+    def __init__(self, code, reason, message):
+        super().__init__(message)
+        self.code = code
+        self.reason = reason
+        self.message = message
+
+    def status(self):
+        return {
+            "kind": "Status",
+            "apiVersion": "v1",
+            "metadata": {},
+            "status": "Failure",
+            "message": self.message,
+            "reason": self.reason,
+            "code": self.code,
+        }
+
+
+class K8Simulator:
+    """
+    In memory K8 objects and watch event history served over HTTP.
+
+    host:str Listen address
+    port:int Listen port
+    history:int Watch events retained, older resource versions are 410 Gone
+    watch_timeout:int Max seconds a watch is held open
+    bookmark_interval:float Seconds between BOOKMARK events on an idle watch
+    latency:float Seconds added to every list request
+    """
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=6443,
+        history=10000,
+        watch_timeout=300,
+        bookmark_interval=10,
+        latency=0.0,
+    ):
+        self.host = host
+        self.port = port
+        self.watch_timeout = watch_timeout
+        self.bookmark_interval = bookmark_interval
+        self.latency = latency
+
+        self._lock = RLock()
+        self._changed = Condition(self._lock)
+        self._rv = 1
+        # resource: { (namespace, name): object }
+        self._objects = {resource: {} for resource in resources}
+        # (rv, resource, type, object, previous object)
+        self._events = deque(maxlen=history)
+        # resource versions at or below this are no longer in _events
+        self._compacted = 0
+        # continue token: (expires, resource version, items)
+        self._snapshots = OrderedDict()
+
+        self._stats = {"lists": 0, "watches": 0, "watch_events": 0, "gone": 0}
+        self._server = None
+        self._stopped = False
+
+    # ----------------------------------------------------------------------------------------
+    # Server
+    # ----------------------------------------------------------------------------------------
+
+    def start(self):
+        """
+        Serve in a background thread, returns once listening
+        """
+        self._listen()
+        Thread(target=self._server.serve_forever, name="k8-simulator", daemon=True).start()
+        return self
+
+    def serve_forever(self):
+        self._listen()
+        self._server.serve_forever()
+
+    def stop(self):
+        self._stopped = True
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        with self._lock:
+            self._changed.notify_all()
+
+    @property
+    def address(self):
+        port = self._server.server_address[1] if self._server is not None else self.port
+        return "{}:{}".format(self.host, port)
+
+    def _listen(self):
+        simulator = self
+
+        class Handler(_K8RequestHandler):
+            k8 = simulator
+
+        self._server = _ThreadingHTTPServer((self.host, self.port), Handler)
+        print("K8 simulator listening on http://{}".format(self.address))
+
+    def write_kubeconfig(self, path):
+        """
+        Write a kubeconfig for this server to path (JSON is valid YAML), returns path
+        """
+        name = "k8-simulator"
+        config = {
+            "apiVersion": "v1",
+            "kind": "Config",
+            "clusters": [{"name": name, "cluster": {"server": "http://" + self.address}}],
+            "users": [{"name": name, "user": {"token": name}}],
+            "contexts": [{"name": name, "context": {"cluster": name, "user": name}}],
+            "current-context": name,
+        }
+        with open(path, "w") as f:
+            json.dump(config, f, indent=2)
+        return path
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["resource_version"] = self._rv
+            stats["objects"] = {r: len(objects) for r, objects in self._objects.items()}
+        return stats
+
+    # ----------------------------------------------------------------------------------------
+    # Objects
+    # ----------------------------------------------------------------------------------------
+
+    def create(self, resource, obj):
+        """
+        Create an object, returns it as stored
+
+        obj:dict K8 API JSON, metadata.namespace and metadata.name are required
+        """
+        with self._lock:
+            metadata = obj["metadata"]
+            key = (metadata["namespace"], metadata["name"])
+            if key in self._objects[resource]:
+                message = "{} {}/{} already exists".format(resource, *key)
+                raise K8Error(409, "AlreadyExists", message)
+            obj = copy.deepcopy(obj)
+            obj["metadata"].setdefault("uid", str(uuid.uuid4()))
+            obj["metadata"].setdefault("creationTimestamp", _timestamp())
+            return self._store(resource, key, obj, "ADDED", None)
+
+    def update(self, resource, obj):
+        """
+        Replace an object, returns it as stored
+        """
+        with self._lock:
+            metadata = obj["metadata"]
+            key = (metadata["namespace"], metadata["name"])
+            previous = self._objects[resource].get(key)
+            if previous is None:
+                raise K8Error(404, "NotFound", "{} {}/{} not found".format(resource, *key))
+            obj = copy.deepcopy(obj)
+            obj["metadata"]["uid"] = previous["metadata"]["uid"]
+            obj["metadata"]["creationTimestamp"] = previous["metadata"]["creationTimestamp"]
+            return self._store(resource, key, obj, "MODIFIED", previous)
+
+    def delete(self, resource, namespace, name):
+        """
+        Delete an object, returns the deleted object or None
+        """
+        with self._lock:
+            previous = self._objects[resource].pop((namespace, name), None)
+            if previous is None:
+                return None
+            obj = copy.deepcopy(previous)
+            self._rv += 1
+            obj["metadata"]["resourceVersion"] = str(self._rv)
+            self._append(self._rv, resource, "DELETED", obj, previous)
+            return copy.deepcopy(obj)
+
+    def get(self, resource, namespace, name):
+        with self._lock:
+            obj = self._objects[resource].get((namespace, name))
+            return copy.deepcopy(obj) if obj is not None else None
+
+    def list(self, resource, namespace=None):
+        with self._lock:
+            return [
+                copy.deepcopy(obj)
+                for (ns, name), obj in sorted(self._objects[resource].items())
+                if namespace is None or ns == namespace
+            ]
+
+    def compact(self):
+        """
+        Drop the watch event history, every watch resumed from an earlier
+        resource version gets a 410 Gone.
+        """
+        with self._lock:
+            self._events.clear()
+            self._compacted = self._rv
+            self._snapshots.clear()
+
+    def _store(self, resource, key, obj, event_type, previous):
+        self._rv += 1
+        obj["metadata"]["resourceVersion"] = str(self._rv)
+        self._objects[resource][key] = obj
+        self._append(self._rv, resource, event_type, obj, previous)
+        return copy.deepcopy(obj)
+
+    def _append(self, rv, resource, event_type, obj, previous):
+        if len(self._events) == self._events.maxlen:
+            self._compacted = self._events[0][0]
+        self._events.append((rv, resource, event_type, obj, previous))
+        self._changed.notify_all()
+
+    # ----------------------------------------------------------------------------------------
+    # List / Watch
+    # ----------------------------------------------------------------------------------------
+
+    def list_response(self, resource, namespace, query):
+        """
+        Returns a list response page
+        """
+        self._stats["lists"] += 1
+        limit = int(query.get("limit") or 0)
+        token = query.get("continue")
+        now = monotonic()
+        with self._lock:
+            for expired in [t for t, s in self._snapshots.items() if s[0] < now]:
+                del self._snapshots[expired]
+
+            if token:
+                snapshot = self._snapshots.pop(token, None)
+                if snapshot is None:
+                    self._stats["gone"] += 1
+                    raise K8Error(410, "Expired", "The provided continue parameter is too old")
+                rv, items = snapshot[1], snapshot[2]
+            else:
+                match = _matcher(namespace, query)
+                rv = self._rv
+                items = [
+                    obj for key, obj in sorted(self._objects[resource].items()) if match(obj)
+                ]
+
+            _continue = ""
+            if limit and len(items) > limit:
+                _continue = base64.urlsafe_b64encode(uuid.uuid4().bytes).decode()
+                self._snapshots[_continue] = (now + 300, rv, items[limit:])
+                items = items[:limit]
+            items = copy.deepcopy(items)
+
+        api_version, kind = resources[resource][1:]
+        return {
+            "kind": "{}List".format(kind),
+            "apiVersion": api_version,
+            "metadata": {"resourceVersion": str(rv), "continue": _continue},
+            "items": items,
+        }
+
+    def watch(self, resource, namespace, query, send):
+        """
+        Stream watch events to send(event:dict) until the timeout, send returns
+        False once the client has gone.
+        """
+        self._stats["watches"] += 1
+        match = _matcher(namespace, query)
+        bookmarks = query.get("allowWatchBookmarks") in ("true", "1")
+        timeout = self.watch_timeout
+        if query.get("timeoutSeconds"):
+            timeout = min(timeout, int(query["timeoutSeconds"]))
+        deadline = monotonic() + timeout
+        api_version, kind = resources[resource][1:]
+
+        with self._lock:
+            rv = int(query.get("resourceVersion") or 0)
+            pending = []
+            if rv == 0:
+                # no resource version, the current objects are sent as ADDED
+                rv = self._rv
+                pending = [
+                    {"type": "ADDED", "object": copy.deepcopy(obj)}
+                    for key, obj in sorted(self._objects[resource].items())
+                    if match(obj)
+                ]
+
+        last_sent = monotonic()
+        while True:
+            for event in pending:
+                event["object"].setdefault("kind", kind)
+                event["object"].setdefault("apiVersion", api_version)
+                if not send(event):
+                    return
+                self._stats["watch_events"] += 1
+                last_sent = monotonic()
+
+            now = monotonic()
+            if now >= deadline:
+                return
+            if bookmarks and now - last_sent >= self.bookmark_interval:
+                bookmark = {
+                    "type": "BOOKMARK",
+                    "object": {
+                        "kind": kind,
+                        "apiVersion": api_version,
+                        "metadata": {"resourceVersion": str(rv)},
+                    },
+                }
+                if not send(bookmark):
+                    return
+                last_sent = now
+
+            with self._lock:
+                if rv < self._compacted:
+                    self._stats["gone"] += 1
+                    message = "too old resource version: {} ({})".format(rv, self._compacted)
+                    gone = K8Error(410, "Expired", message)
+                    send({"type": "ERROR", "object": gone.status()})
+                    return
+                if self._rv == rv:
+                    wait = deadline - now
+                    if bookmarks:
+                        wait = min(wait, self.bookmark_interval)
+                    self._changed.wait(timeout=max(0.01, wait))
+                if self._stopped:
+                    return
+                pending = []
+                for event_rv, event_resource, event_type, obj, previous in reversed(self._events):
+                    if event_rv <= rv:
+                        break
+                    if event_resource != resource:
+                        continue
+                    event_type = _filtered_type(event_type, match, obj, previous)
+                    if event_type is not None:
+                        pending.append({"type": event_type, "object": copy.deepcopy(obj)})
+                pending.reverse()
+                rv = max(rv, self._rv)
+
+
+def _filtered_type(event_type, match, obj, previous):
+    """
+    Returns the event type a watch with a selector sees, or None
+    """
+    if event_type == "ADDED":
+        return "ADDED" if match(obj) else None
+    if event_type == "DELETED":
+        return "DELETED" if match(previous) else None
+    was, now = match(previous), match(obj)
+    if was and now:
+        return "MODIFIED"
+    if now:
+        return "ADDED"
+    if was:
+        return "DELETED"
+    return None
+
+
+def _matcher(namespace, query):
+    """
+    Returns func(object) for the namespace, labelSelector and fieldSelector
+
+    Raises:
+    - K8Error 400, an invalid selector
+    """
+    labels = _label_selector(query.get("labelSelector", ""))
+    fields = _field_selector(query.get("fieldSelector", ""))
+
+    def match(obj):
+        metadata = obj["metadata"]
+        if namespace is not None and metadata["namespace"] != namespace:
+            return False
+        return labels(metadata.get("labels") or {}) and fields(obj)
+
+    return match
+
+
+def _split_selector(selector):
+    """
+    Split on the commas outside of () sets
+    """
+    parts, depth, start = [], 0, 0
+    for i, c in enumerate(selector):
+        if c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+        elif c == "," and depth == 0:
+            parts.append(selector[start:i])
+            start = i + 1
+    parts.append(selector[start:])
+    return [p for p in parts if p.strip()]
+
+
+def _label_selector(selector):
+    requirements = []
+    for part in _split_selector(selector):
+        match = _requirement_re.match(part)
+        if match is not None:
+            key, op, values = match.groups()
+            values = set(v.strip() for v in values.split(",") if v.strip())
+            if op == "in":
+                requirements.append(lambda l, k=key, v=values: l.get(k) in v)
+            else:
+                requirements.append(lambda l, k=key, v=values: l.get(k) not in v)
+            continue
+        match = _comparison_re.match(part)
+        if match is not None:
+            key, op, value = match.groups()
+            if op == "!=":
+                requirements.append(lambda l, k=key, v=value: l.get(k) != v)
+            else:
+                requirements.append(lambda l, k=key, v=value: l.get(k) == v)
+            continue
+        match = _exists_re.match(part)
+        if match is not None:
+            negate, key = match.groups()
+            requirements.append(lambda l, k=key, n=bool(negate): (k in l) != n)
+            continue
+        raise K8Error(400, "BadRequest", "unable to parse requirement: {}".format(part))
+    return lambda labels: all(r(labels) for r in requirements)
+
+
+def _field_selector(selector):
+    requirements = []
+    for part in _split_selector(selector):
+        match = _comparison_re.match(part)
+        if match is None:
+            raise K8Error(400, "BadRequest", "invalid field selector: {}".format(part))
+        path, op, value = match.groups()
+        if op == "!=":
+            requirements.append(lambda o, p=path, v=value: _field(o, p) != v)
+        else:
+            requirements.append(lambda o, p=path, v=value: _field(o, p) == v)
+    return lambda obj: all(r(obj) for r in requirements)
+
+
+def _field(obj, path):
+    for name in path.split("."):
+        obj = obj.get(name) if isinstance(obj, dict) else None
+    return "" if obj is None else str(obj)
+
+
+def _timestamp():
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _K8RequestHandler(BaseHTTPRequestHandler):
+    """
+    HTTP request handler, the K8 list/watch API
+    """
+
+    protocol_version = "HTTP/1.1"
+    k8 = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = dict(parse_qsl(url.query, keep_blank_values=True))
+        try:
+            if url.path == "/sim/stats":
+                return self._reply(200, self.k8.stats())
+
+            match = _path_re.match(url.path)
+            if match is None or resources[match.group(3)][0] != match.group(1):
+                raise K8Error(404, "NotFound", "the server could not find the requested resource")
+            prefix, namespace, resource = match.groups()
+
+            if query.get("watch") in ("true", "1"):
+                return self._watch(resource, namespace, query)
+
+            if self.k8.latency > 0:
+                sleep(self.k8.latency)
+            self._reply(200, self.k8.list_response(resource, namespace, query))
+
+        except K8Error as e:
+            self._reply(e.code, e.status())
+
+    def _reply(self, code, data):
+        content = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _watch(self, resource, namespace, query):
+        # validate the selectors before the stream starts
+        _matcher(namespace, query)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def send(event):
+            line = json.dumps(event).encode() + b"\n"
+            try:
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+                self.wfile.flush()
+            except OSError:
+                return False
+            return True
+
+        self.k8.watch(resource, namespace, query, send)
+        try:
+            self.wfile.write(b"0\r\n\r\n")
+        except OSError:
+            self.close_connection = True
@@ -0,0 +1,327 @@
+"""
+Lightweight tracing of the K8 and APIC events through aci-sync, from the
+watcher receipt through the dispatcher queue, the handlers, the APIC helper
+calls and each APIC REST request.
+
+A sampled event carries its root span in event["trace"], the thread
+handling the event resumes it so the spans started on that thread become its
+children. APIC callbacks and the bulk subnet pushes run later or for many
+events, their spans are linked to the spans of the originating K8 events.
+
+Spans are exported as OTLP JSON by a background thread to a file
+(ACI_SYNC_TRACE_FILE, one export request per line) and/or an OTLP/HTTP
+collector (ACI_SYNC_TRACE_OTLP_ENDPOINT). Tracing is off unless one is set.
+"""
+import os
+import json
+import atexit
+import random
+import traceback
+import urllib.request
+from contextlib import contextmanager
+from functools import wraps
+from queue import Queue, Empty
+from threading import Thread, Lock, local
+from time import time
+
+# Local file the spans are appended to as OTLP JSON lines
+trace_file = os.environ.get("ACI_SYNC_TRACE_FILE", "")
+# OTLP/HTTP JSON traces endpoint, e.g. http://otel-collector:4318/v1/traces
+trace_otlp_endpoint = os.environ.get("ACI_SYNC_TRACE_OTLP_ENDPOINT", "")
+# Fraction of events traced, 0 to 1
+trace_sample_rate = float(os.environ.get("ACI_SYNC_TRACE_SAMPLE_RATE", "0.01"))
+
+enabled = bool(trace_file or trace_otlp_endpoint) and trace_sample_rate > 0
+
+# Max spans per export request
+export_batch_size = 512
+
+_local = local()
+_queue = Queue()
+_exporter = None
+_exporter_lock = Lock()
+
+
+class Span:
+    """
+    A timed operation in a trace, ended once
+    """
+
+    __slots__ = (
+        "name",
+        "trace_id",
+        "span_id",
+        "parent_id",
+        "start",
+        "end",
+        "attributes",
+        "links",
+        "error",
+    )
+
+    def __init__(self, name, trace_id, parent_id=None, attributes=None, links=(), start=None):
+        """
+        trace_id:str 32 hex digits
+        parent_id:str Parent span ID as 16 hex digits, None for a root span
+        links:list (trace ID, span ID) of related spans in other traces
+        start:float Epoch seconds, defaults to now
+        """
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = "{:016x}".format(random.getrandbits(64))
+        self.parent_id = parent_id
+        self.start = start if start is not None else time()
+        self.end = None
+        self.attributes = dict(attributes) if attributes else {}
+        self.links = list(links)
+        self.error = None
+
+    def context(self):
+        """
+        Returns (trace ID, span ID), to link a later span to this one
+        """
+        return (self.trace_id, self.span_id)
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def finish(self, error=None):
+        """
+        End the span and queue it for export, a span is only ended once
+        """
+        if self.end is not None:
+            return
+        self.end = time()
+        if error is not None:
+            self.error = str(error)
+        _export(self)
+
+
+def start_trace(span_name, **attributes):
+    """
+    Returns a new root span if the event is sampled, else None. The span is
+    not made current, it is resumed by the thread handling the event.
+    """
+    if not enabled or random.random() >= trace_sample_rate:
+        return None
+    return Span(span_name, "{:032x}".format(random.getrandbits(128)), attributes=attributes)
+
+
+def current_context():
+    """
+    Returns the (trace ID, span ID) of this thread's current span, None if not tracing
+    """
+    current = getattr(_local, "span", None)
+    return current.context() if current is not None else None
+
+
+@contextmanager
+def span(span_name, **attributes):
+    """
+    A child span of this thread's current span for the with block, yields
+    None without a current span
+    """
+    parent = getattr(_local, "span", None)
+    if parent is None:
+        yield None
+        return
+    with _activate(Span(span_name, parent.trace_id, parent.span_id, attributes)) as s:
+        yield s
+
+
+@contextmanager
+def linked_span(span_name, contexts, **attributes):
+    """
+    A span linked to the spans of contexts for the with block. The span is a
+    child of the current span, else of the first context, yields None if
+    there is neither.
+
+    contexts:list (trace ID, span ID) or None
+    """
+    contexts = [c for c in contexts if c is not None]
+    parent = getattr(_local, "span", None)
+    if parent is not None:
+        trace_id, parent_id = parent.context()
+    elif contexts:
+        trace_id, parent_id = contexts[0]
+    else:
+        yield None
+        return
+    with _activate(Span(span_name, trace_id, parent_id, attributes, links=contexts)) as s:
+        yield s
+
+
+@contextmanager
+def resume(*roots):
+    """
+    Make the first event root span current for the with block, the time each
+    root waited since the watcher receipt is recorded as a 'queued' span.
+    The roots are not ended, see finish().
+
+    roots:Span Root spans from start_trace(), None for events not sampled
+    """
+    roots = [root for root in roots if root is not None]
+    if not roots:
+        yield None
+        return
+    for root in roots:
+        Span("queued", root.trace_id, root.span_id, start=root.start).finish()
+    previous = getattr(_local, "span", None)
+    _local.span = roots[0]
+    try:
+        yield roots[0]
+    finally:
+        _local.span = previous
+
+
+def finish(root, **attributes):
+    """
+    End an event root span, None is ignored
+    """
+    if root is None:
+        return
+    root.attributes.update(attributes)
+    root.finish()
+
+
+def traced(func):
+    """
+    Decorator, the function runs in a child span of the current span when tracing
+    """
+    name = func.__name__
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if getattr(_local, "span", None) is None:
+            return func(*args, **kwargs)
+        with span(name):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+@contextmanager
+def _activate(s):
+    previous = getattr(_local, "span", None)
+    _local.span = s
+    try:
+        yield s
+    except BaseException as e:
+        s.error = "{}: {}".format(type(e).__name__, str(e))
+        raise
+    finally:
+        _local.span = previous
+        s.finish()
+
+
+def _export(s):
+    global _exporter
+    if _exporter is None:
+        with _exporter_lock:
+            if _exporter is None:
+                _exporter = Thread(target=_export_spans, name="trace-exporter", daemon=True)
+                _exporter.start()
+                atexit.register(_close)
+                print(
+                    "Tracing {:.1%} of events to {}".format(
+                        trace_sample_rate,
+                        " and ".join(t for t in [trace_file, trace_otlp_endpoint] if t),
+                    )
+                )
+    _queue.put(s)
+
+
+def _export_spans():
+    """
+    Dedicated Thread, exports the ended spans in batches
+    """
+    stop = False
+    while not stop:
+        try:
+            spans = [_queue.get()]
+            while len(spans) < export_batch_size:
+                try:
+                    spans.append(_queue.get(timeout=1))
+                except Empty:
+                    break
+            stop = None in spans
+            spans = [s for s in spans if s is not None]
+            if not spans:
+                continue
+
+            body = json.dumps(otlp_json(spans), separators=(",", ":"))
+            if trace_file:
+                with open(trace_file, "a") as f:
+                    f.write(body + "\n")
+            if trace_otlp_endpoint:
+                request = urllib.request.Request(
+                    trace_otlp_endpoint,
+                    data=body.encode(),
+                    headers={"Content-Type": "application/json"},
+                )
+                urllib.request.urlopen(request, timeout=10).close()
+        except Exception as e:
+            # dedicated thread so ensure we send any unhandled
+            # errors to stdout, the batch is dropped
+            print("Unhandled error in trace exporter thread: {}".format(str(e)))
+            print(traceback.format_exc())
+
+
+def otlp_json(spans):
+    """
+    Returns the spans as an OTLP JSON ExportTraceServiceRequest
+    """
+    return {
+        "resourceSpans": [
+            {
+                "resource": {"attributes": _otlp_attributes({"service.name": "aci-sync"})},
+                "scopeSpans": [
+                    {
+                        "scope": {"name": "aci-sync"},
+                        "spans": [_otlp_span(s) for s in spans],
+                    }
+                ],
+            }
+        ]
+    }
+
+
+def _otlp_span(s):
+    span_json = {
+        "traceId": s.trace_id,
+        "spanId": s.span_id,
+        "name": s.name,
+        # SPAN_KIND_INTERNAL
+        "kind": 1,
+        "startTimeUnixNano": str(int(s.start * 1e9)),
+        "endTimeUnixNano": str(int(s.end * 1e9)),
+        "attributes": _otlp_attributes(s.attributes),
+    }
+    if s.parent_id is not None:
+        span_json["parentSpanId"] = s.parent_id
+    if s.links:
+        span_json["links"] = [{"traceId": t, "spanId": i} for t, i in s.links]
+    if s.error is not None:
+        # STATUS_CODE_ERROR
+        span_json["status"] = {"code": 2, "message": s.error}
+    return span_json
+
+
+def _otlp_attributes(attributes):
+    values = []
+    for key, value in attributes.items():
+        if isinstance(value, bool):
+            value = {"boolValue": value}
+        elif isinstance(value, int):
+            value = {"intValue": str(value)}
+        elif isinstance(value, float):
+            value = {"doubleValue": value}
+        else:
+            value = {"stringValue": str(value)}
+        values.append({"key": key, "value": value})
+    return values
+
+
+def _close():
+    _queue.put(None)
+    _exporter.join(timeout=10)